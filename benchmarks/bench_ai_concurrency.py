@@ -0,0 +1,127 @@
+"""
+/ai の同時実行中に on_message の処理遅延を測定するベンチマーク。
+
+偽のGeminiクライアント（一定時間で応答する）を使い、N件の /ai 呼び出しが
+処理中の状態で on_message を一定間隔で実行し、その遅延を計測します。
+
+    python benchmarks/bench_ai_concurrency.py --concurrent 20 --latency 2.0
+
+--mode blocking を指定すると、旧実装と同じく同期API (client.models.generate_content)
+をコルーチン内で直接呼び出した場合の遅延を計測します。
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import natu_bot  # noqa: E402
+
+
+class FakeAsyncModels:
+    """client.aio.models の代用。指定時間だけ非同期に待機して応答します。"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def generate_content(self, model, contents, config=None):
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(text="fake response")
+
+
+class FakeSyncModels:
+    """client.models の代用。指定時間だけスレッドをブロックして応答します。"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.latency)
+        return SimpleNamespace(text="fake response")
+
+
+class FakeGeminiClient:
+    def __init__(self, latency: float):
+        self.models = FakeSyncModels(latency)
+        self.aio = SimpleNamespace(models=FakeAsyncModels(latency))
+
+
+def make_fake_message(index: int):
+    """on_message に渡すための最小限のメッセージオブジェクトを作成します。"""
+    author = SimpleNamespace(
+        bot=False,
+        id=100000 + index,
+        name=f"bench-user-{index}",
+        guild_permissions=SimpleNamespace(administrator=False),
+    )
+    return SimpleNamespace(
+        id=index,
+        author=author,
+        guild=SimpleNamespace(id=1),
+        channel=SimpleNamespace(id=10, name="bench"),
+        content=f"benchmark message {index}",
+    )
+
+
+async def fake_ai_call(client: FakeGeminiClient, mode: str):
+    if mode == "blocking":
+        # 旧実装の再現: コルーチン内で同期APIを直接呼ぶ
+        return client.models.generate_content(model=natu_bot.GEMINI_MODEL, contents=[])
+    return await natu_bot.generate_gemini_content(client, "benchmark")
+
+
+async def run(concurrent: int, latency: float, interval: float, mode: str) -> list[float]:
+    async def noop_process_commands(message):
+        return None
+
+    # Discordへの接続を必要とするコマンド処理は無効化する
+    natu_bot.bot.process_commands = noop_process_commands
+
+    client = FakeGeminiClient(latency)
+    ai_tasks = [asyncio.create_task(fake_ai_call(client, mode)) for _ in range(concurrent)]
+
+    latencies = []
+    index = 0
+    scheduled = time.perf_counter()
+    while True:
+        # 予定時刻から on_message の処理完了までを遅延として記録する
+        # （イベントループが停止していた時間もここに含まれる）
+        await natu_bot.on_message(make_fake_message(index))
+        latencies.append(time.perf_counter() - scheduled)
+        if all(task.done() for task in ai_tasks):
+            break
+        index += 1
+        scheduled = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+
+    await asyncio.gather(*ai_tasks)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrent", type=int, default=20, help="同時に実行する /ai 呼び出し数")
+    parser.add_argument("--latency", type=float, default=1.0, help="偽Geminiの応答時間（秒）")
+    parser.add_argument("--interval", type=float, default=0.01, help="on_message の実行間隔（秒）")
+    parser.add_argument("--mode", choices=("async", "blocking"), default="async")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run(args.concurrent, args.latency, args.interval, args.mode))
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = sorted(value * 1000 for value in latencies)
+    p99 = latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.99))]
+    print(f"mode={args.mode} concurrent={args.concurrent} latency={args.latency}s "
+          f"max_concurrency={natu_bot.GEMINI_MAX_CONCURRENCY}")
+    print(f"on_message samples: {len(latencies_ms)}  total: {elapsed:.2f}s")
+    print(f"on_message latency ms: median={statistics.median(latencies_ms):.3f} "
+          f"p99={p99:.3f} max={latencies_ms[-1]:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+禁止ワード照合のマイクロベンチマーク。
+
+旧実装の「for word in BANNED_WORDS: if word in content」ループと、
+BannedWordMatcher (Aho-Corasick) の1メッセージあたりの照合時間を、
+禁止ワード数 10 / 1,000 / 50,000 件で比較します。
+filter 列は TextNormalizer による正規化を含めた BannedWordFilter の処理時間です。
+
+    python benchmarks/bench_banned_words.py --messages 2000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from natu_bot import BannedWordFilter, BannedWordMatcher  # noqa: E402
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789あいうえおかきくけこさしすせそたちつてと広告宣伝荒"
+
+
+def random_word(rng: random.Random) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(3, 10)))
+
+
+def make_messages(rng: random.Random, count: int, words: list[str]) -> list[str]:
+    """平均150文字程度のメッセージを作成し、約5%に禁止ワードを混ぜます。"""
+    messages = []
+    for _ in range(count):
+        text = "".join(rng.choice(ALPHABET + "    ") for _ in range(rng.randint(20, 280)))
+        if rng.random() < 0.05:
+            position = rng.randint(0, len(text))
+            text = text[:position] + rng.choice(words) + text[position:]
+        messages.append(text)
+    return messages
+
+
+def naive_search(words, content: str):
+    for word in words:
+        if word in content:
+            return word
+    return None
+
+
+def measure(fn, messages: list[str]) -> float:
+    """1メッセージあたりの平均処理時間（マイクロ秒）を返します。"""
+    start = time.perf_counter()
+    for message in messages:
+        fn(message)
+    return (time.perf_counter() - start) / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000, help="照合するメッセージ数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'terms':>7} {'build ms':>9} {'add ms':>7} "
+          f"{'naive us/msg':>13} {'search us/msg':>14} {'find_all us/msg':>16} {'filter us/msg':>14}")
+    for term_count in (10, 1_000, 50_000):
+        words = list({random_word(rng) for _ in range(term_count)})
+        word_set = set(words)
+        messages = make_messages(rng, args.messages, words)
+
+        start = time.perf_counter()
+        matcher = BannedWordMatcher(words)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        matcher.add(random_word(rng) + "_new")
+        add_ms = (time.perf_counter() - start) * 1000
+
+        naive_us = measure(lambda content: naive_search(word_set, content), messages)
+        search_us = measure(matcher.search, messages)
+        find_all_us = measure(matcher.find_all, messages)
+        filter_us = measure(BannedWordFilter(words).find_all, messages)
+        print(f"{len(words):>7} {build_ms:>9.1f} {add_ms:>7.2f} "
+              f"{naive_us:>13.1f} {search_us:>14.1f} {find_all_us:>16.1f} {filter_us:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+類似メッセージ検知 (NearDuplicateIndex) のベンチマーク。
+
+通常の会話に、一部を書き換えたコピペ（文字の置換・挿入、末尾のURLやメンションの変更）を
+混ぜた合成コーパスを作り、1件あたりの登録時間・メモリ使用量と検出精度を測定します。
+比較として、正規化後の完全一致（ハッシュ）による検出率も表示します。
+
+    python benchmarks/bench_near_duplicates.py --messages 50000 --templates 20
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from natu_bot import NearDuplicateIndex, TextNormalizer  # noqa: E402
+
+SYLLABLES = (
+    "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわん"
+    "がぎぐげござじずぜぞだでどばびぶべぼ"
+)
+LATIN = "abcdefghijklmnopqrstuvwxyz"
+EDIT_CHARACTERS = LATIN + "あいうえお!?ー 　"
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list[str]:
+    """ひらがな・英字の疑似単語からなる語彙を作成します。"""
+    words = []
+    for _ in range(size):
+        if rng.random() < 0.6:
+            words.append("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))))
+        else:
+            words.append("".join(rng.choice(LATIN) for _ in range(rng.randint(2, 8))))
+    return words
+
+
+def random_sentence(rng: random.Random, vocabulary: list[str], weights: list[float], low: int, high: int) -> str:
+    return " ".join(rng.choices(vocabulary, weights, k=rng.randint(low, high)))
+
+
+def mutate(rng: random.Random, text: str, rate: float) -> str:
+    """文字単位の置換・挿入・削除を rate の割合で加え、末尾を差し替えます。"""
+    chars = list(text)
+    for _ in range(max(1, int(len(chars) * rate))):
+        position = rng.randrange(len(chars))
+        operation = rng.random()
+        if operation < 0.4:
+            chars[position] = rng.choice(EDIT_CHARACTERS)
+        elif operation < 0.8:
+            chars.insert(position, rng.choice(EDIT_CHARACTERS))
+        elif len(chars) > 1:
+            del chars[position]
+    suffix = rng.choice(("", f" https://example.com/{rng.randrange(10**6)}", f" <@{rng.randrange(10**17)}>"))
+    return "".join(chars) + suffix
+
+
+def make_corpus(rng: random.Random, messages: int, templates: int, spam_ratio: float, edit_rate: float):
+    """(内容, テンプレート番号 or None) の列を返します。"""
+    vocabulary = make_vocabulary(rng, 5000)
+    # 単語の出現頻度は Zipf 分布に近づける（よく使われる単語ほど多く出現する）
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    spam_templates = [random_sentence(rng, vocabulary, weights, 15, 40) for _ in range(templates)]
+    corpus = []
+    for _ in range(messages):
+        if rng.random() < spam_ratio:
+            template = rng.randrange(templates)
+            corpus.append((mutate(rng, spam_templates[template], edit_rate), template))
+        else:
+            corpus.append((random_sentence(rng, vocabulary, weights, 3, 25), None))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50_000, help="メッセージ数")
+    parser.add_argument("--templates", type=int, default=20, help="コピペの元になる文章の数")
+    parser.add_argument("--spam-ratio", type=float, default=0.1, help="コピペの割合")
+    parser.add_argument("--edit-rate", type=float, default=0.05, help="コピペ1件あたりに加える編集の割合")
+    parser.add_argument("--rate", type=float, default=200.0, help="1秒あたりのメッセージ数（合成時刻）")
+    parser.add_argument("--window", type=float, default=300.0, help="時間枠（秒）")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = make_corpus(rng, args.messages, args.templates, args.spam_ratio, args.edit_rate)
+    normalizer = TextNormalizer()
+    index = NearDuplicateIndex(normalizer, window_seconds=args.window)
+
+    clusters = []
+    start = time.perf_counter()
+    for number, (content, _) in enumerate(corpus):
+        clusters.append(index.add(1, 10, number, number, content, now=number / args.rate))
+    elapsed = time.perf_counter() - start
+
+    # 既存のまとまりに加わった投稿の割合。コピペでは検出率、通常の投稿では誤検出率になる
+    spam_total = spam_joined = 0
+    normal_total = normal_merged = 0
+    seen_clusters = set()
+    for (content, template), cluster in zip(corpus, clusters):
+        if cluster is None:
+            continue
+        merged = id(cluster) in seen_clusters
+        seen_clusters.add(id(cluster))
+        if template is None:
+            normal_total += 1
+            normal_merged += merged
+        else:
+            spam_total += 1
+            spam_joined += merged
+
+    # 比較: 正規化後の完全一致による検出率
+    exact_seen = set()
+    exact_hits = exact_total = 0
+    for content, template in corpus:
+        key = normalizer.normalize(content)
+        if template is not None:
+            exact_total += 1
+            exact_hits += key in exact_seen
+        exact_seen.add(key)
+
+    stats = index.stats()
+    print(f"messages: {len(corpus):,}  indexed: {stats['total_added']:,}  "
+          f"templates: {args.templates}  edit_rate: {args.edit_rate}")
+    print(f"add: {elapsed / len(corpus) * 1e6:.1f} us/msg  "
+          f"entries: {stats['entries']:,}  buckets: {stats['buckets']:,}  "
+          f"memory: {stats['memory_bytes'] / 1024:,.0f} KiB  evicted: {stats['total_evicted']:,}")
+    print(f"minhash recall: {spam_joined / max(1, spam_total):.3f} ({spam_joined:,}/{spam_total:,})  "
+          f"false merge rate: {normal_merged / max(1, normal_total):.4f} ({normal_merged:,}/{normal_total:,})")
+    print(f"exact-hash recall: {exact_hits / max(1, exact_total):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+レート制限のベンチマーク。
+
+毎秒10,000件のメッセージ（多数のユーザーに分散）を合成時刻で流し、
+旧実装（リストの再構築）と SlidingWindowRateLimiter の処理速度・メモリ使用量を比較します。
+合成時刻を使うため、実時間を待たずに数分間分のトラフィックを再現できます。
+
+    python benchmarks/bench_rate_limiter.py --seconds 300 --users 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from natu_bot import (  # noqa: E402
+    RATE_LIMIT_MESSAGES,
+    RATE_LIMIT_SWEEP_INTERVAL_SECONDS,
+    RATE_LIMIT_WINDOW_SECONDS,
+    SlidingWindowRateLimiter,
+)
+
+
+def make_events(rng: random.Random, seconds: int, rate: int, users: int, active: int):
+    """(合成時刻, user_id) の列を作成します。アクティブなユーザーは時間とともに入れ替わります。"""
+    events = []
+    for second in range(seconds):
+        # 10秒ごとにアクティブなユーザーの集合をずらし、離脱したユーザーを発生させる
+        base = (second // 10) * (active // 4)
+        for index in range(rate):
+            user_id = (base + rng.randrange(active)) % users
+            events.append((second + index / rate, user_id))
+    return events
+
+
+def run_legacy(events) -> tuple[float, int, int, int]:
+    """旧実装: 投稿ごとにリストへ追加し、内包表記で作り直す（削除処理なし）。"""
+    spam_tracking = {}
+    violations = 0
+    start = time.perf_counter()
+    for now, user_id in events:
+        if user_id not in spam_tracking:
+            spam_tracking[user_id] = []
+        spam_tracking[user_id].append(now)
+        time_limit = now - RATE_LIMIT_WINDOW_SECONDS
+        spam_tracking[user_id] = [ts for ts in spam_tracking[user_id] if ts > time_limit]
+        if len(spam_tracking[user_id]) > RATE_LIMIT_MESSAGES:
+            violations += 1
+            spam_tracking[user_id] = []
+    elapsed = time.perf_counter() - start
+
+    memory = sys.getsizeof(spam_tracking)
+    for user_id, timestamps in spam_tracking.items():
+        memory += sys.getsizeof(user_id) + sys.getsizeof(timestamps) + 24 * len(timestamps)
+    return elapsed, violations, memory, len(spam_tracking)
+
+
+def run_limiter(events) -> tuple[float, int, dict]:
+    limiter = SlidingWindowRateLimiter(RATE_LIMIT_MESSAGES, RATE_LIMIT_WINDOW_SECONDS)
+    violations = 0
+    next_sweep = RATE_LIMIT_SWEEP_INTERVAL_SECONDS
+    start = time.perf_counter()
+    for now, user_id in events:
+        if now >= next_sweep:
+            limiter.sweep(now)
+            next_sweep += RATE_LIMIT_SWEEP_INTERVAL_SECONDS
+        if limiter.hit(user_id, now) > RATE_LIMIT_MESSAGES:
+            violations += 1
+            limiter.reset(user_id)
+    elapsed = time.perf_counter() - start
+    return elapsed, violations, limiter.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=int, default=300, help="再現するトラフィックの長さ（合成時刻の秒数）")
+    parser.add_argument("--rate", type=int, default=10_000, help="毎秒のメッセージ数")
+    parser.add_argument("--users", type=int, default=50_000, help="ユーザーIDの総数")
+    parser.add_argument("--active", type=int, default=2_000, help="同時にアクティブなユーザー数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    events = make_events(random.Random(args.seed), args.seconds, args.rate, args.users, args.active)
+    print(f"events: {len(events):,} ({args.rate:,} msg/s x {args.seconds}s)")
+
+    elapsed, violations, memory, tracked = run_legacy(events)
+    print(f"legacy : {len(events) / elapsed:>12,.0f} msg/s  violations={violations:,}  "
+          f"tracked_users={tracked:,}  memory={memory / 1024:,.0f} KiB")
+
+    elapsed, violations, stats = run_limiter(events)
+    print(f"limiter: {len(events) / elapsed:>12,.0f} msg/s  violations={violations:,}  "
+          f"tracked_users={stats['tracked_keys']:,}  memory={stats['memory_bytes'] / 1024:,.0f} KiB  "
+          f"swept={stats['total_swept']:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,26 @@
 import os
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import asyncio
-from typing import Optional
+import bisect
+import functools
+import itertools
+import sys
+import time
+import hashlib
+import hmac
+import io
+import heapq
+import json
+import operator
+from array import array
+import signal
+import sqlite3
+import threading
+import unicodedata
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, NamedTuple
 import aiohttp
 from aiohttp import web
 import aiohttp_cors 
@@ -12,14 +30,16 @@ from datetime import datetime, timezone, timedelta
 from google import genai
 from google.genai.errors import APIError
 
-# ---------------------------
-# 監視対象チャンネル一覧
-# ---------------------------
-monitoring_channels = set()
-monitoring_log_channel_id = None
 # ---------------------------
 # --- 環境設定 ---
 # ---------------------------
+def env_flag(name: str, default: bool = False) -> bool:
+    """環境変数を真偽値として読み取ります ("1", "true", "yes", "on" を真とみなす)。"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
 DISCORD_TOKEN = os.environ.get("DISCORD_TOKEN")
 GEMINI_API_KEY_PRIMARY = os.environ.get("GEMINI_API_KEY") # Primary Key
 GEMINI_API_KEY_SECONDARY = os.environ.get("GEMINI_API_KEY_SECONDARY") # Secondary Key
@@ -29,6 +49,9 @@ TARGET_USER_ID_FOR_LOGS = int(os.environ.get("TARGET_USER_ID_FOR_LOGS", 0))
 
 PORT = int(os.environ.get("PORT", 8080)) 
 
+# 永続化データ (SQLiteファイルなど) の保存先ディレクトリ
+BOT_DATA_DIR = os.environ.get("BOT_DATA_DIR", "data")
+
 # 通知チャンネルIDの取得と変換
 NOTIFICATION_CHANNEL_ID = os.environ.get("NOTIFICATION_CHANNEL_ID")
 if NOTIFICATION_CHANNEL_ID:
@@ -49,260 +72,4420 @@ AI_SYSTEM_PROMPT = (
 )
 
 # ----------------------------------------------------------------------
-# ★ 禁止ワードリスト (インメモリで管理)
-# Bot再起動で初期値に戻ります。
+# ★ メトリクス (Prometheus テキスト形式)
+# カウンターとヒストグラムはメモリ上の数値に加算するだけで、/metrics へのアクセス時にまとめて出力する。
+# キャッシュの件数などはアクセス時にコールバックで取得するため、通常の処理には負荷がかからない。
+# ----------------------------------------------------------------------
+METRICS_PREFIX = "natu_bot_"
+# 処理時間のヒストグラムのバケット上限（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_metric_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value != value:
+        return "NaN"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_metric_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_metric_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{escape_metric_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    """登録されたメトリクスを Prometheus のテキスト形式で出力します。"""
+
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"WARNING: メトリクス {metric.name} の取得に失敗しました: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+
+class Metric:
+    """ラベルの値ごとに子オブジェクトを持つメトリクスの基底クラス。"""
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), registry: Optional[MetricsRegistry] = None):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, object] = {}
+        (registry or metrics_registry).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """ラベルの値に対応する子を返します。ホットパスでは戻り値を保持して使い回してください。"""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(Metric):
+    """単調に増加する値。名前は _total で終えてください。"""
+    kind = "counter"
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().value += amount
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{format_metric_labels(self.labelnames, values)} {format_metric_value(child.value)}"
+            for values, child in self._children.items()
+        ]
+
+
+class HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: tuple):
+        self.upper_bounds = upper_bounds
+        # 各バケットに入った件数（累積ではない）。最後の要素は +Inf
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    """値の分布。バケットの件数は出力時に累積します。"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 registry: Optional[MetricsRegistry] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                labels = format_metric_labels(self.labelnames, values, f'le="{format_metric_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_metric_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {format_metric_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackGauge(Metric):
+    """出力時に callback() を呼んで値を取得するゲージ。ラベルがある場合は {ラベル値のタプル: 値} を返してください。"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback, labelnames: tuple = (), registry: Optional[MetricsRegistry] = None):
+        self.callback = callback
+        super().__init__(name, help_text, labelnames, registry)
+
+    def samples(self) -> list[str]:
+        result = self.callback()
+        if not self.labelnames:
+            return [f"{self.name} {format_metric_value(float(result))}"]
+        return [
+            f"{self.name}{format_metric_labels(self.labelnames, values)} {format_metric_value(float(value))}"
+            for values, value in result.items()
+        ]
+
+
+event_duration = Histogram("event_duration_seconds", "Discordイベントハンドラーの処理時間", ("event",))
+event_errors = Counter("event_errors_total", "Discordイベントハンドラーで発生した例外の数", ("event",))
+
+
+def instrument_event(handler):
+    """イベントハンドラーの処理時間と例外の数を記録するデコレーター。@bot.event の下に付けてください。"""
+    duration = event_duration.labels(handler.__name__)
+    errors = event_errors.labels(handler.__name__)
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            duration.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+# ----------------------------------------------------------------------
+# ★ イベントループの監視とサンプリングプロファイラー
+# イベントループのスレッドで一定間隔の sleep を繰り返し、予定より遅れて再開した時間を遅延として記録する。
+# 別スレッドの見張り役が、予定の時刻を SLOW_CALLBACK_THRESHOLD_SECONDS 過ぎても再開しないことに気付いたら、
+# その時点のイベントループのスタックを取得する（＝ループを止めている処理のスタック）。
+# プロファイラーは指定した秒数だけイベントループのスタックを一定間隔で採取し、
+# flamegraph.pl や speedscope で読み込める collapsed stacks 形式で出力する。
+# ----------------------------------------------------------------------
+LOOP_MONITOR_ENABLED = env_flag("LOOP_MONITOR_ENABLED", True)
+# イベントループの遅延を測定する間隔（秒）とヒストグラムのバケット上限（秒）
+# 遅いコールバックの検出もこの間隔に依存するため、SLOW_CALLBACK_THRESHOLD_SECONDS より短くする
+EVENT_LOOP_LAG_INTERVAL_SECONDS = 0.1
+EVENT_LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+# 遅延の指数移動平均の平滑化係数
+LOOP_LAG_EWMA_ALPHA = 0.1
+# この時間（秒）以上イベントループが止まったら、遅いコールバックとして記録する
+SLOW_CALLBACK_THRESHOLD_SECONDS = float(os.environ.get("SLOW_CALLBACK_THRESHOLD_SECONDS", 0.25))
+# 見張り役のスレッドが確認する間隔（秒）と、保持する遅いコールバックの件数
+LOOP_WATCHDOG_INTERVAL_SECONDS = 0.05
+SLOW_CALLBACK_HISTORY = 20
+# プロファイラーのサンプリング間隔（秒）と、1回に実行できる最大秒数
+PROFILER_SAMPLE_INTERVAL_SECONDS = 0.005
+PROFILER_MAX_SECONDS = 60
+# /debug/* へのアクセスに必要なトークン（Authorization: Bearer <token>）。未設定なら /debug/* は無効
+DEBUG_ROUTE_TOKEN = os.environ.get("DEBUG_ROUTE_TOKEN")
+# イベントループの待機中を示すスタックの末尾（プロファイルの集計でアイドルとして扱う）
+LOOP_IDLE_FRAMES = ("selectors.py:select", "selectors.py:poll")
+
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds", "イベントループの遅延（予定した時刻から実際に再開するまでの時間）",
+    buckets=EVENT_LOOP_LAG_BUCKETS
+)
+slow_callbacks_total = Counter("slow_callbacks_total", "イベントループが閾値以上止まった回数")
+
+
+def collapse_stack(frame, with_lines: bool = False) -> str:
+    """フレームから、根元から順に ; で区切ったスタック文字列を作成します。"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        if with_lines:
+            name += f":{frame.f_lineno}"
+        names.append(name)
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+def format_collapsed_stacks(counts: dict[str, int]) -> str:
+    """{スタック: 件数} を collapsed stacks 形式（1行に「スタック 件数」）にします。"""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+
+class SlowCallback(NamedTuple):
+    """イベントループが止まっていた1回分の記録。"""
+    detected_at: float
+    duration: float
+    stack: str
+
+
+class LoopHealthMonitor:
+    """
+    イベントループの遅延の測定、遅いコールバックの検出、サンプリングプロファイラーを提供します。
+    
+    start() はイベントループのスレッドから呼び出してください。
+    """
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.slow_callbacks: deque[SlowCallback] = deque(maxlen=SLOW_CALLBACK_HISTORY)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        # 遅延の指数移動平均（準備完了の判定に使う）
+        self.ewma_lag = 0.0
+        self.profiling = False
+        self._loop_thread_id: Optional[int] = None
+        # 次に sleep から再開する予定の時刻 (time.monotonic)
+        self._expected_wakeup = time.monotonic()
+        # 見張り役が取得したスタック（予定時刻と組で保持し、再開時に記録する）
+        self._captured: Optional[tuple[float, str]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            self._expected_wakeup = expected
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.ewma_lag += LOOP_LAG_EWMA_ALPHA * (lag - self.ewma_lag)
+            event_loop_lag.observe(lag)
+
+            captured = self._captured
+            if captured is not None and captured[0] == expected:
+                self._captured = None
+                self._record_slow_callback(lag, captured[1])
+
+    def _record_slow_callback(self, duration: float, stack: str):
+        self.slow_callbacks.append(SlowCallback(time.time(), duration, stack))
+        slow_callbacks_total.inc()
+        tail = " <- ".join(reversed(stack.split(";")[-3:]))
+        print(f"WARNING: イベントループが {duration:.3f} 秒間停止していました: {tail}")
+
+    def _loop_frame(self):
+        return sys._current_frames().get(self._loop_thread_id)
+
+    def _watch(self):
+        """見張り役のスレッド。予定時刻を過ぎても再開しないイベントループのスタックを取得します。"""
+        while True:
+            time.sleep(LOOP_WATCHDOG_INTERVAL_SECONDS)
+            expected = self._expected_wakeup
+            if time.monotonic() - expected < self.threshold:
+                continue
+            captured = self._captured
+            if captured is not None and captured[0] == expected:
+                continue
+            frame = self._loop_frame()
+            if frame is not None:
+                self._captured = (expected, collapse_stack(frame, with_lines=True))
+
+    def _sample(self, seconds: float, interval: float) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = self._loop_frame()
+            if frame is not None:
+                stack = collapse_stack(frame)
+                counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(interval)
+        return counts
+
+    async def profile(self, seconds: float, interval: float = PROFILER_SAMPLE_INTERVAL_SECONDS) -> dict[str, int]:
+        """
+        seconds 秒間イベントループのスタックを採取し、{スタック: サンプル数} を返します。
+        
+        採取する側のスレッドはイベントループのスレッドがGILを手放したとき（主に select() の待機中）
+        にしか動けないため、サンプルは待機中に大きく偏ります。await で細かく制御を返すPythonの
+        処理はほとんど写らず、見えるのはGILを手放す呼び出し（time.sleep や I/O）と、
+        sys.getswitchinterval() より長くループを止める処理だけです。処理中・待機中の割合の推定には使えません。
+        """
+        if self._loop_thread_id is None:
+            raise RuntimeError("イベントループの監視が開始されていません。")
+        if self.profiling:
+            raise RuntimeError("プロファイラーは既に実行中です。")
+        self.profiling = True
+        try:
+            return await asyncio.to_thread(self._sample, min(seconds, PROFILER_MAX_SECONDS), interval)
+        finally:
+            self.profiling = False
+
+    def stats(self) -> dict:
+        return {
+            "last_lag_seconds": round(self.last_lag, 6),
+            "ewma_lag_seconds": round(self.ewma_lag, 6),
+            "max_lag_seconds": round(self.max_lag, 6),
+            "slow_callbacks": [
+                {"detected_at": item.detected_at, "duration_seconds": round(item.duration, 6), "stack": item.stack}
+                for item in self.slow_callbacks
+            ],
+        }
+
+
+loop_health_monitor = LoopHealthMonitor(EVENT_LOOP_LAG_INTERVAL_SECONDS, SLOW_CALLBACK_THRESHOLD_SECONDS)
+
+
+def summarize_profile(counts: dict[str, int], limit: int = 8) -> tuple[int, int, list[tuple[str, int]]]:
+    """(全サンプル数, アイドルのサンプル数, 末尾のフレームごとの上位) を返します。"""
+    total = sum(counts.values())
+    idle = 0
+    leaves: dict[str, int] = {}
+    for stack, count in counts.items():
+        leaf = stack.rsplit(";", 1)[-1]
+        if leaf in LOOP_IDLE_FRAMES:
+            idle += count
+            continue
+        leaves[leaf] = leaves.get(leaf, 0) + count
+    top = sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return total, idle, top
+
+
+# ----------------------------------------------------------------------
+# ★ 禁止ワードリスト
+# サーバーごとのリストは BannedWordRegistry で管理する（/blockword で編集）。
+# まだリストを編集していないサーバーには、この既定のリストを使う。
 # ----------------------------------------------------------------------
-BANNED_WORDS = set([
+DEFAULT_BANNED_WORDS = frozenset([
     "あらし", "広告", "宣伝", "discord.gg", "https://discord.gg"
 ])
 
+
+class BannedWordMatch(NamedTuple):
+    """禁止ワードの検出結果。start/end は検査したテキスト上の位置（end は含まない）。"""
+    start: int
+    end: int
+    word: str
+
+
+class BannedWordMatcher:
+    """
+    Aho-Corasick法による禁止ワードの複数パターン照合器です。
+    
+    メッセージ長に比例する1回の走査ですべての禁止ワードを検出します。
+    add/remove は失敗リンクの逆引き索引を使って影響を受けるノードだけを更新するため、
+    オートマトン全体を作り直す必要はありません。
+    """
+
+    def __init__(self, words=()):
+        self._build(set(word for word in words if word))
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.words
+
+    def __iter__(self):
+        return iter(self.words)
+
+    # --- 構築 ---
+
+    def _new_node(self, parent: int, char: str) -> int:
+        node = len(self._goto)
+        self._goto.append({})
+        self._parent.append(parent)
+        self._char.append(char)
+        self._depth.append(self._depth[parent] + 1 if node else 0)
+        self._fail.append(0)
+        self._output.append(-1)
+        self._terminal.append(None)
+        return node
+
+    def _insert_path(self, word: str) -> tuple[int, list[int]]:
+        """トライ木に word の経路を作成し、(終端ノード, 新規作成したノードのリスト) を返します。"""
+        goto = self._goto
+        node = 0
+        created = []
+        for char in word:
+            next_node = goto[node].get(char)
+            if next_node is None:
+                next_node = self._new_node(node, char)
+                goto[node][char] = next_node
+                created.append(next_node)
+            node = next_node
+        return node, created
+
+    def _build(self, words: set):
+        """すべての単語からオートマトンを一括で構築します。"""
+        self.words: set[str] = set()
+        self._goto: list[dict[str, int]] = []
+        self._parent: list[int] = []
+        self._char: list[str] = []
+        self._depth: list[int] = []
+        self._fail: list[int] = []
+        self._output: list[int] = []  # 失敗リンクをたどった先で最も近い終端ノード（なければ-1）
+        self._terminal: list[Optional[str]] = []
+        # 失敗リンクの逆引き {失敗先ノード: {ノードの文字: {ノード, ...}}}
+        self._fail_children: dict[int, dict[str, set[int]]] = {}
+        self._removed = 0
+        self._new_node(0, "")
+
+        for word in words:
+            node, _ = self._insert_path(word)
+            self._terminal[node] = word
+            self.words.add(word)
+
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        terminal = self._terminal
+        queue = deque()
+        for child in goto[0].values():
+            self._link(child, 0)
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                target = goto[state].get(char, 0)
+                self._link(child, target)
+                output[child] = target if terminal[target] is not None else output[target]
+                queue.append(child)
+
+    def _link(self, node: int, target: int):
+        """node の失敗リンクを target に設定し、逆引き索引を更新します。"""
+        self._fail_children.setdefault(target, {}).setdefault(self._char[node], set()).add(node)
+        self._fail[node] = target
+
+    def _unlink(self, node: int):
+        by_char = self._fail_children[self._fail[node]]
+        siblings = by_char[self._char[node]]
+        siblings.discard(node)
+        if not siblings:
+            del by_char[self._char[node]]
+
+    def _ends_with(self, node: int, suffix_node: int) -> bool:
+        """node の文字列が suffix_node の文字列で終わる（真の接尾辞である）かを判定します。"""
+        if self._depth[node] <= self._depth[suffix_node]:
+            return False
+        parent = self._parent
+        char = self._char
+        while suffix_node:
+            if char[node] != char[suffix_node]:
+                return False
+            node = parent[node]
+            suffix_node = parent[suffix_node]
+        return True
+
+    def _fail_descendants(self, node: int):
+        """失敗リンクの木で node の子孫を、終端ノードより下はたどらずに列挙します。"""
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            for children in self._fail_children.get(current, {}).values():
+                for child in children:
+                    yield child
+                    if self._terminal[child] is None:
+                        stack.append(child)
+
+    # --- 更新 ---
+
+    def add(self, word: str) -> bool:
+        """単語を追加します。既に登録済みの場合は False を返します。"""
+        if not word or word in self.words:
+            return False
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        terminal = self._terminal
+
+        node, created = self._insert_path(word)
+        for new_node in created:
+            parent = self._parent[new_node]
+            char = self._char[new_node]
+            target = 0
+            if parent:
+                state = fail[parent]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                target = goto[state].get(char, 0)
+            # 既存ノードのうち、新しいノードが最長の接尾辞になるものの失敗リンクを付け替える
+            candidates = self._fail_children.get(target, {}).get(char, ())
+            moved = [other for other in candidates if self._ends_with(other, new_node)]
+            self._link(new_node, target)
+            output[new_node] = target if terminal[target] is not None else output[target]
+            for other in moved:
+                self._unlink(other)
+                self._link(other, new_node)
+
+        terminal[node] = word
+        self.words.add(word)
+        for descendant in self._fail_descendants(node):
+            output[descendant] = node
+        return True
+
+    def remove(self, word: str) -> bool:
+        """単語を削除します。登録されていない場合は False を返します。"""
+        if word not in self.words:
+            return False
+        node = 0
+        for char in word:
+            node = self._goto[node][char]
+        self.words.discard(word)
+        self._terminal[node] = None
+        replacement = self._output[node]
+        for descendant in self._fail_descendants(node):
+            if self._output[descendant] == node:
+                self._output[descendant] = replacement
+
+        # 使われないノードが増えすぎたら作り直してメモリを回収する
+        self._removed += 1
+        if self._removed > max(len(self.words), 64):
+            self._build(self.words)
+        return True
+
+    # --- 照合 ---
+
+    def find_all(self, text: str) -> list[BannedWordMatch]:
+        """text に含まれるすべての禁止ワードを、出現位置とともに返します（終了位置の昇順）。"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        terminal = self._terminal
+        matches = []
+        state = 0
+        for index, char in enumerate(text):
+            transitions = goto[state]
+            while state and char not in transitions:
+                state = fail[state]
+                transitions = goto[state]
+            state = transitions.get(char, 0)
+            node = state if terminal[state] is not None else output[state]
+            while node > 0:
+                word = terminal[node]
+                matches.append(BannedWordMatch(index + 1 - len(word), index + 1, word))
+                node = output[node]
+        return matches
+
+    def search(self, text: str) -> Optional[BannedWordMatch]:
+        """最初に見つかった禁止ワードを返します。見つからない場合は None を返します。"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        terminal = self._terminal
+        state = 0
+        for index, char in enumerate(text):
+            transitions = goto[state]
+            while state and char not in transitions:
+                state = fail[state]
+                transitions = goto[state]
+            state = transitions.get(char, 0)
+            node = state if terminal[state] is not None else output[state]
+            if node > 0:
+                word = terminal[node]
+                return BannedWordMatch(index + 1 - len(word), index + 1, word)
+        return None
+
+
+# ----------------------------------------------------------------------
+# ★ 禁止ワード照合用のテキスト正規化
+# 全角/半角、カタカナ/ひらがな、大文字/小文字、見た目の似た文字、不可視文字、
+# 区切り文字の挿入（例: "discord .gg", "広 告"）による回避を防ぐ。
+# ----------------------------------------------------------------------
+
+# 見た目がラテン文字と紛らわしい文字（大文字は casefold 済みの小文字で登録）
+CONFUSABLE_CHARACTERS = {
+    # キリル文字
+    "а": "a", "в": "b", "е": "e", "ё": "e", "к": "k", "м": "m", "н": "h", "о": "o",
+    "р": "p", "с": "c", "т": "t", "у": "y", "х": "x", "ѕ": "s", "і": "i", "ї": "i",
+    "ј": "j", "ԁ": "d", "ӏ": "l", "ɡ": "g",
+    # ギリシャ文字
+    "α": "a", "β": "b", "ε": "e", "η": "n", "ι": "i", "κ": "k", "ν": "v", "ο": "o",
+    "ρ": "p", "τ": "t", "υ": "u", "χ": "x", "ω": "w",
+}
+
+# 小書きのかなを通常のかなに揃える（ひらがなに変換した後に適用）
+SMALL_KANA = {
+    "ぁ": "あ", "ぃ": "い", "ぅ": "う", "ぇ": "え", "ぉ": "お", "っ": "つ",
+    "ゃ": "や", "ゅ": "ゆ", "ょ": "よ", "ゎ": "わ", "ゕ": "か", "ゖ": "け",
+}
+
+# 削除する文字の Unicode カテゴリ（先頭1文字）: 区切り(Z), 句読点(P), 記号(S), 制御/書式(C), 結合文字(M)
+STRIPPED_CATEGORIES = frozenset("ZPSCM")
+
+
+class NormalizationTable(dict):
+    """
+    str.translate 用の変換表 {コードポイント: 正規化後の文字列}。
+    
+    表に無い文字は初回参照時に変換して追加するため、translate() は常にC実装の速度で動作します。
+    """
+
+    # 表に保持する文字数の上限（未知の文字を大量に送られても際限なく増えないように）
+    MAX_SIZE = 65536
+
+    def __missing__(self, code: int) -> str:
+        value = TextNormalizer.convert(chr(code))
+        if len(self) < self.MAX_SIZE:
+            self[code] = value
+        return value
+
+
+class TextNormalizer:
+    """
+    禁止ワード照合用にテキストを正規化します。
+    
+    1文字ごとの変換結果を表に保持し、str.translate で一括変換します。
+    元のテキスト上の位置への対応表は、禁止ワードが見つかった場合にだけ作成します。
+    """
+
+    def __init__(self):
+        self.table = NormalizationTable()
+        # よく使われる範囲は起動時に計算しておく
+        ranges = (
+            (0x0000, 0x0250),   # ASCII・ラテン文字
+            (0x0370, 0x0530),   # ギリシャ文字・キリル文字
+            (0x2000, 0x2070),   # 一般句読点（ゼロ幅文字など）
+            (0x3000, 0x3100),   # CJK記号・ひらがな・カタカナ
+            (0xFE00, 0xFE10),   # 異体字セレクタ
+            (0xFF00, 0xFFF0),   # 全角英数・半角カナ
+        )
+        for start, end in ranges:
+            for code in range(start, end):
+                self.table[code] = self.convert(chr(code))
+
+    @staticmethod
+    def convert(char: str) -> str:
+        """1文字を正規化します（変換表に無い文字に対してのみ呼ばれる）。"""
+        result = []
+        # 互換文字を分解し（全角→半角、半角カナ→全角など）、濁点などの結合文字を分離する
+        for decomposed in unicodedata.normalize("NFD", unicodedata.normalize("NFKC", char)):
+            if unicodedata.category(decomposed)[0] in STRIPPED_CATEGORIES:
+                continue
+            for folded in decomposed.casefold():
+                code = ord(folded)
+                if 0x30A1 <= code <= 0x30F6 or code in (0x30FD, 0x30FE):
+                    # カタカナ → ひらがな
+                    folded = chr(code - 0x60)
+                folded = SMALL_KANA.get(folded, folded)
+                result.append(CONFUSABLE_CHARACTERS.get(folded, folded))
+        return "".join(result)
+
+    def normalize(self, text: str) -> str:
+        """text を正規化した文字列を返します。"""
+        return text.translate(self.table)
+
+    def offset_map(self, text: str) -> list[int]:
+        """正規化後の各文字が、元の text のどの位置の文字に由来するかのリストを返します。"""
+        table = self.table
+        offsets = []
+        for index, char in enumerate(text):
+            mapped = table[ord(char)]
+            if len(mapped) == 1:
+                offsets.append(index)
+            elif mapped:
+                offsets.extend([index] * len(mapped))
+        return offsets
+
+
+class BannedWordFilter:
+    """
+    正規化したテキストに対して禁止ワードを照合します。
+    
+    登録された禁止ワードは正規化した形で BannedWordMatcher に登録され、
+    検出結果の位置は元のメッセージ上の位置に変換して返されます。
+    """
+
+    def __init__(self, words=(), normalizer: Optional[TextNormalizer] = None):
+        self.normalizer = normalizer or TextNormalizer()
+        # {正規化後の単語: {登録された単語, ...}}
+        self._originals: dict[str, set[str]] = {}
+        for word in words:
+            key = self.normalizer.normalize(word)
+            if key:
+                self._originals.setdefault(key, set()).add(word)
+        # 初期の単語は1語ずつ add() せず、正規化後の単語の集合からオートマトンを一括で構築する
+        self.matcher = BannedWordMatcher(self._originals)
+
+    def __len__(self) -> int:
+        return len(self.matcher)
+
+    def add(self, word: str) -> bool:
+        """単語を追加します。正規化すると空になる単語は登録できず、False を返します。"""
+        key = self.normalizer.normalize(word)
+        if not key:
+            return False
+        self._originals.setdefault(key, set()).add(word)
+        self.matcher.add(key)
+        return True
+
+    def remove(self, word: str) -> bool:
+        key = self.normalizer.normalize(word)
+        originals = self._originals.get(key)
+        if not originals or word not in originals:
+            return False
+        originals.discard(word)
+        if not originals:
+            del self._originals[key]
+            self.matcher.remove(key)
+        return True
+
+    def find_all(self, text: str) -> list[BannedWordMatch]:
+        """text に含まれる禁止ワードを、元のテキスト上の位置と登録された単語で返します。"""
+        found = self.matcher.find_all(self.normalizer.normalize(text))
+        if not found:
+            return []
+        offsets = self.normalizer.offset_map(text)
+        matches = []
+        for match in found:
+            word = min(self._originals[match.word])
+            matches.append(BannedWordMatch(offsets[match.start], offsets[match.end - 1] + 1, word))
+        return matches
+
+
+# 禁止ワード照合とレイド検知（同一内容の判定）で共有する正規化器
+text_normalizer = TextNormalizer()
+
 # ----------------------------------------------------------------------
 # ★ メッセージレート制限設定とデータ構造
 # ----------------------------------------------------------------------
-# ユーザーごとのメッセージ投稿履歴を保持 {user_id: [timestamp1, timestamp2, ...]}
-spam_tracking = {} 
 # 1分間（60秒）に許容される最大メッセージ数
 RATE_LIMIT_MESSAGES = 30
 # レート制限をチェックする時間枠（秒）
 RATE_LIMIT_WINDOW_SECONDS = 60
-# ----------------------------------------------------------------------
+# 一定時間投稿のないユーザーの履歴を削除する間隔（秒）
+RATE_LIMIT_SWEEP_INTERVAL_SECONDS = 60
 
-# ----------------------------------------------------------------------
-# ★ 一時BAN管理用データ構造 (インメモリ)
-# {guild_id: {user_id: unban_datetime_utc}}
-# Bot再起動でリセットされる点に注意
-# ----------------------------------------------------------------------
-time_bans = {} 
 
-# Botの設定 (Intentsの設定が必要)
-# メンバーリストの取得とプレゼンス（ステータス）の取得のために、Intentを設定
-intents = discord.Intents.default()
-intents.message_content = True 
-intents.members = True     # on_messageでメンバーの権限をチェックするために必要
-intents.presences = True   # メンバーのオンライン状態（Botステータス確認）のために必要
-intents.bans = True        # BAN/UNBAN操作のために必要
-bot = commands.Bot(command_prefix='!', intents=intents)
+class RateLimitState:
+    """1キー分のレート制限の状態。"""
+    __slots__ = ("timestamps", "start")
 
+    def __init__(self):
+        # time.monotonic() の投稿時刻（古い順）。timestamps[start:] が時間枠内の投稿
+        self.timestamps = array("d")
+        self.start = 0
 
-# 利用可能なAPIキーのリスト
-GEMINI_API_KEYS = [
-    GEMINI_API_KEY_PRIMARY,
-    GEMINI_API_KEY_SECONDARY,
-    GEMINI_API_KEY_THIRD,
-    GEMINI_API_KEY_FOURTH,
-]
-GEMINI_API_KEYS = [key for key in GEMINI_API_KEYS if key] # Noneや空文字列を除外
+    def count(self) -> int:
+        return len(self.timestamps) - self.start
 
-def get_gemini_client(api_key: str) -> genai.Client:
-    """指定されたAPIキーでGeminiクライアントを作成する"""
-    return genai.Client(api_key=api_key)
+    def last(self) -> float:
+        return self.timestamps[-1] if self.timestamps else 0.0
 
-async def check_api_key_and_get_models(api_key: str) -> tuple[bool, Optional[list[str]]]:
+
+class SlidingWindowRateLimiter:
     """
-    APIキーの有効性をチェックし、有効な場合は利用可能なモデルのリストを取得する。
+    スライディングウィンドウ方式のレート制限です。
     
-    NOTE: この関数はAPIキーが有効であるか（API呼び出しが可能か）をチェックするために利用します。
+    キーごとに直近 limit + 1 件までの投稿時刻を float 配列で保持し、先頭位置をずらすことで
+    古い投稿を償却 O(1) で取り除きます。一定時間投稿のないキーは sweep() で削除されます。
     """
-    if not api_key:
-        return False, None
 
-    client = get_gemini_client(api_key)
-    
-    # モデルリストの取得を非同期で実行するために、スレッドプールエグゼキュータを使用する
-    # Google GenAI SDKのlist_modelsは同期関数であるため
-    loop = asyncio.get_event_loop()
-    
-    try:
-        # list_modelsを非同期で実行
-        # 接続が成功し、有効なキーであることを確認する
-        models_response = await loop.run_in_executor(
-            None, # デフォルトのスレッドプールエグゼキュータを使用
-            client.models.list
-        )
-        
-        # モデル名のみを抽出（ここでは使用しないが、成功の証拠として取得）
-        model_names = [model.name for model in models_response]
-        return True, model_names
-        
-    except APIError as e:
-        # APIキーが無効、またはレートリミット超過などのエラーが発生した場合
-        print(f"API Key Check Error: {e}")
-        return False, None
-    except Exception as e:
-        # その他の予期せぬエラー
-        print(f"Unexpected Error during API Key Check: {e}")
-        return False, None
+    # 取り除いた先頭部分がこの件数を超えたら配列を詰め直す
+    COMPACT_THRESHOLD = 16
+
+    def __init__(self, limit: int, window_seconds: float):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self._states: dict = {}
+        self.total_hits = 0
+        self.total_swept = 0
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def hit(self, key, now: Optional[float] = None) -> int:
+        """key の投稿を記録し、時間枠内の投稿数（最大 limit + 1）を返します。"""
+        if now is None:
+            now = time.monotonic()
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = RateLimitState()
+        timestamps = state.timestamps
+        start = state.start
+        cutoff = now - self.window_seconds
+        end = len(timestamps)
+        while start < end and timestamps[start] <= cutoff:
+            start += 1
+        timestamps.append(now)
+        # 上限を超えた分は判定に不要なので、古いものから捨てる
+        start = max(start, end + 1 - (self.limit + 1))
+        if start >= self.COMPACT_THRESHOLD or (start and start * 2 >= len(timestamps)):
+            del timestamps[:start]
+            start = 0
+        state.start = start
+        self.total_hits += 1
+        return len(timestamps) - start
+
+    def reset(self, key):
+        """key の履歴を消去します（連鎖的な警告を防ぐため）。"""
+        self._states.pop(key, None)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """時間枠内に投稿のないキーを削除し、削除した件数を返します。"""
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.window_seconds
+        idle = [key for key, state in self._states.items() if state.last() <= cutoff]
+        for key in idle:
+            del self._states[key]
+        self.total_swept += len(idle)
+        return len(idle)
+
+    def memory_bytes(self) -> int:
+        """保持している状態のおおよそのメモリ使用量（バイト）を返します。"""
+        total = sys.getsizeof(self._states)
+        for key, state in self._states.items():
+            total += sys.getsizeof(key) + sys.getsizeof(state) + sys.getsizeof(state.timestamps)
+        return total
+
+    def stats(self) -> dict:
+        return {
+            "tracked_keys": len(self._states),
+            "tracked_timestamps": sum(state.count() for state in self._states.values()),
+            "memory_bytes": self.memory_bytes(),
+            "total_hits": self.total_hits,
+            "total_swept": self.total_swept,
+        }
 
-# --------------------------
-# --- コマンド群: /genai コマンド ---
-# --------------------------
 
-@bot.tree.command(name="genai", description="Gemini APIキーの有効性を確認し、クォータの情報を表示します。")
-async def genai_status(interaction: discord.Interaction):
-    """Gemini APIキーの有効性、クォータに関する情報を表示します。"""
-    
-    await interaction.response.defer(ephemeral=True) # 時間がかかる可能性があるので遅延応答
+class RateLimitWindow(NamedTuple):
+    """レート制限の時間枠（window_seconds 秒間に limit 件まで）。"""
+    limit: int
+    window_seconds: int
 
-    if not GEMINI_API_KEYS:
-        embed = discord.Embed(
-            title="Gemini APIステータス",
-            description="⚠️ Gemini APIキーが設定されていません。環境変数を確認してください。",
-            color=discord.Color.red()
-        )
-        await interaction.followup.send(embed=embed, ephemeral=True)
-        return
+    def describe(self) -> str:
+        return f"{self.limit}件/{self.window_seconds}秒"
 
-    results = []
-    # すべてのキーに対して非同期でチェックを実行
-    tasks = [check_api_key_and_get_models(key) for key in GEMINI_API_KEYS]
-    results = await asyncio.gather(*tasks)
 
-    description = f"現在**{len(GEMINI_API_KEYS)}**個のキーが設定されています。\n\n"
-    
-    # API使用状況に関する注釈を追加
-    quota_note = (
-        "**【重要】残りの使用回数（クォータ）について:**\n"
-        "Gemini APIのSDKでは、現在の**残りの使用回数を直接取得することはできません。**\n"
-        "クォータの正確な情報は、Google AI StudioまたはGoogle Cloud Consoleの課金ダッシュボードでご確認ください。\n"
-        "以下のステータスは、APIキーが現在**有効であり、認証に成功しているか**を示しています。\n"
-        "レート制限に達した場合、Botはエラーを報告します。\n\n"
-    )
-    
-    description += quota_note
-    
-    valid_key_count = 0
+class RateLimitViolation(NamedTuple):
+    """レート制限の超過結果。"""
+    window: RateLimitWindow
+    count: int
+    key: tuple
+    policy: tuple
+
+
+class GuildRateLimitPolicies:
+    """1サーバー分のレート制限ポリシー（サーバー全体・チャンネル別・ロール別）。"""
+    __slots__ = ("guild", "channels", "roles", "role_ids")
+
+    def __init__(self):
+        self.guild: Optional[tuple] = None
+        self.channels: dict[int, tuple] = {}
+        self.roles: dict[int, tuple] = {}
+        # ポリシーが設定されたロールのID（roles を変更するたびに作り直す）
+        self.role_ids: tuple[int, ...] = ()
+
+
+class RateLimitPolicyEngine:
+    """
+    サーバー/チャンネル/ロールごとのレート制限ポリシーを解決し、投稿数を記録します。
     
-    for i, (is_valid, _) in enumerate(results): # モデルリストは使用しないため、_ で受け取る
-        key_label = f"キー #{i + 1}"
-        
-        if is_valid:
-            description += f"✅ **{key_label}**: **有効** (APIに接続成功)\n"
-            valid_key_count += 1
+    ポリシーは1つ以上の時間枠（例: 短時間のバースト + 長時間の持続）からなり、
+    どれか1つでも超過すると違反になります。優先順位はチャンネル > ロール > サーバー > 既定値です。
+    投稿数はサーバーごと（チャンネル別ポリシーの場合はチャンネルごと）にユーザー単位で数えます。
+    """
+
+    def __init__(self, default_policy: tuple):
+        self.default_policy = default_policy
+        self._guilds: dict[int, GuildRateLimitPolicies] = {}
+        # 時間枠ごとのレート制限（同じ時間枠を使うポリシー間で共有する）
+        self._limiters: dict[RateLimitWindow, SlidingWindowRateLimiter] = {}
+
+    def __len__(self) -> int:
+        return sum(len(limiter) for limiter in self._limiters.values())
+
+    def _limiter(self, window: RateLimitWindow) -> SlidingWindowRateLimiter:
+        limiter = self._limiters.get(window)
+        if limiter is None:
+            limiter = self._limiters[window] = SlidingWindowRateLimiter(window.limit, window.window_seconds)
+        return limiter
+
+    def resolve(self, guild_id: int, channel_id: int, member) -> tuple[tuple, tuple]:
+        """メッセージに適用するポリシーと、投稿数を数えるキーを返します。"""
+        user_id = member.id
+        policies = self._guilds.get(guild_id)
+        if policies is not None:
+            policy = policies.channels.get(channel_id)
+            if policy is not None:
+                return policy, (guild_id, channel_id, user_id)
+            get_role = getattr(member, "get_role", None)
+            if policies.role_ids and get_role is not None:
+                # メンバーの全ロールではなく、ポリシーのあるロールだけを確認し、上位のロールを優先する
+                best = None
+                for role_id in policies.role_ids:
+                    role = get_role(role_id)
+                    if role is not None and (best is None or role > best):
+                        best = role
+                if best is not None:
+                    return policies.roles[best.id], (guild_id, user_id)
+            if policies.guild is not None:
+                return policies.guild, (guild_id, user_id)
+        return self.default_policy, (guild_id, user_id)
+
+    def check(self, guild_id: int, channel_id: int, member, now: Optional[float] = None) -> Optional[RateLimitViolation]:
+        """投稿を記録し、いずれかの時間枠を超過した場合は違反内容を返します。"""
+        if now is None:
+            now = time.monotonic()
+        policy, key = self.resolve(guild_id, channel_id, member)
+        violation = None
+        for window in policy:
+            count = self._limiter(window).hit(key, now)
+            if count > window.limit and violation is None:
+                violation = RateLimitViolation(window, count, key, policy)
+        return violation
+
+    def reset(self, violation: RateLimitViolation):
+        """違反したユーザーの履歴を消去します（連鎖的な警告を防ぐため）。"""
+        for window in violation.policy:
+            self._limiter(window).reset(violation.key)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        return sum(limiter.sweep(now) for limiter in self._limiters.values())
+
+    def set_policy(self, guild_id: int, policy: Optional[tuple], channel_id: Optional[int] = None, role_id: Optional[int] = None):
+        """ポリシーを設定します。policy に None を指定すると設定を解除します。"""
+        policies = self._guilds.setdefault(guild_id, GuildRateLimitPolicies())
+        if channel_id is not None:
+            target = policies.channels
+            target_id = channel_id
+        elif role_id is not None:
+            target = policies.roles
+            target_id = role_id
         else:
-            description += f"❌ **{key_label}**: **無効/認証失敗** (API接続エラー)\n"
-            
-    embed = discord.Embed(
-        title="🤖 Gemini API 接続ステータス",
-        description=description,
-        color=discord.Color.blue() if valid_key_count > 0 else discord.Color.red()
-    )
+            policies.guild = policy
+            target = None
+        if target is not None:
+            if policy is None:
+                target.pop(target_id, None)
+            else:
+                target[target_id] = policy
+        policies.role_ids = tuple(policies.roles)
+        if policies.guild is None and not policies.channels and not policies.roles:
+            del self._guilds[guild_id]
+
+    def guild_policies(self, guild_id: int) -> Optional[GuildRateLimitPolicies]:
+        return self._guilds.get(guild_id)
+
+    def stats(self) -> dict:
+        limiter_stats = [limiter.stats() for limiter in self._limiters.values()]
+        return {
+            "tracked_keys": sum(item["tracked_keys"] for item in limiter_stats),
+            "memory_bytes": sum(item["memory_bytes"] for item in limiter_stats),
+            "total_hits": sum(item["total_hits"] for item in limiter_stats),
+            "total_swept": sum(item["total_swept"] for item in limiter_stats),
+        }
+
+
+def describe_rate_limit_policy(policy: tuple) -> str:
+    return " + ".join(window.describe() for window in policy)
+
+
+# 既定のポリシー（RATE_LIMIT_BURST_MESSAGES を設定すると短時間のバースト制限を追加する）
+RATE_LIMIT_BURST_MESSAGES = int(os.environ.get("RATE_LIMIT_BURST_MESSAGES", 0))
+RATE_LIMIT_BURST_WINDOW_SECONDS = int(os.environ.get("RATE_LIMIT_BURST_WINDOW_SECONDS", 5))
+DEFAULT_RATE_LIMIT_POLICY = (
+    ((RateLimitWindow(RATE_LIMIT_BURST_MESSAGES, RATE_LIMIT_BURST_WINDOW_SECONDS),) if RATE_LIMIT_BURST_MESSAGES > 0 else ())
+    + (RateLimitWindow(RATE_LIMIT_MESSAGES, RATE_LIMIT_WINDOW_SECONDS),)
+)
+
+# ユーザーごとのメッセージ投稿履歴とレート制限ポリシー
+spam_tracking = RateLimitPolicyEngine(DEFAULT_RATE_LIMIT_POLICY)
 
-    await interaction.followup.send(embed=embed, ephemeral=True)
 
 # ----------------------------------------------------------------------
-# Geminiクライアントの初期化とフォールバックリストの作成
+# ★ チャンネルごとの直近メッセージのリングバッファ
+# スパム一括削除の際に channel.history を取得せず、削除対象のIDを特定するために使う。
+# 1件あたり16バイト（メッセージID + 投稿者ID）で、チャンネル数・件数ともに上限を設ける。
 # ----------------------------------------------------------------------
+RECENT_MESSAGES_PER_CHANNEL = int(os.environ.get("RECENT_MESSAGES_PER_CHANNEL", 200))
+RECENT_MESSAGES_MAX_CHANNELS = int(os.environ.get("RECENT_MESSAGES_MAX_CHANNELS", 1000))
+
+
+class ChannelMessageBuffer:
+    """1チャンネル分の直近メッセージ（ID と投稿者ID）のリングバッファ。"""
+    __slots__ = ("message_ids", "author_ids", "head", "size", "since_id")
+
+    def __init__(self, capacity: int, since_id: int):
+        self.message_ids = array("Q", bytes(8 * capacity))
+        self.author_ids = array("Q", bytes(8 * capacity))
+        self.head = 0  # 次に書き込む位置
+        self.size = 0
+        # このIDより後のメッセージはすべてバッファに記録されている
+        self.since_id = since_id
+
+    def append(self, message_id: int, author_id: int):
+        capacity = len(self.message_ids)
+        if self.size == capacity:
+            # 最も古い記録を上書きするため、網羅している範囲が狭まる（mark_gap で進めた位置より前には戻さない）
+            self.since_id = max(self.since_id, self.message_ids[self.head])
+        else:
+            self.size += 1
+        self.message_ids[self.head] = message_id
+        self.author_ids[self.head] = author_id
+        self.head = (self.head + 1) % capacity
+
+    def newest_first(self):
+        """(メッセージID, 投稿者ID) を新しい順に返します。"""
+        capacity = len(self.message_ids)
+        for offset in range(1, self.size + 1):
+            index = (self.head - offset) % capacity
+            yield self.message_ids[index], self.author_ids[index]
+
+
+class RecentMessageBuffer:
+    """チャンネルごとの直近メッセージの記録。チャンネル数が上限を超えると最も使われていないものから破棄します。"""
+
+    def __init__(self, per_channel: int, max_channels: int):
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self._channels: OrderedDict[int, ChannelMessageBuffer] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def record(self, channel_id: int, message_id: int, author_id: int):
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            # 記録を開始する直前のメッセージまでは網羅していない
+            buffer = self._channels[channel_id] = ChannelMessageBuffer(self.per_channel, message_id - 1)
+            if len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+        buffer.append(message_id, author_id)
 
-# 利用可能なAPIキーのリストと名前
-API_KEY_CONFIGS = [
-    (GEMINI_API_KEY_PRIMARY, 'Primary'),
-    (GEMINI_API_KEY_SECONDARY, 'Secondary'),
-    (GEMINI_API_KEY_THIRD, 'Third'),
-    (GEMINI_API_KEY_FOURTH, 'Fourth'),
-]
+    def recent_by_author(self, channel_id: int, author_id: int, after_id: int) -> Optional[list[int]]:
+        """
+        after_id より後に author_id が投稿したメッセージIDを新しい順に返します。
+        
+        バッファがその期間を網羅していない場合（キャッシュミス）は None を返します。
+        """
+        buffer = self._channels.get(channel_id)
+        if buffer is None or buffer.since_id > after_id:
+            self.misses += 1
+            return None
+        message_ids = []
+        for message_id, message_author_id in buffer.newest_first():
+            if message_id <= after_id:
+                break
+            if message_author_id == author_id:
+                message_ids.append(message_id)
+        self.hits += 1
+        return message_ids
+
+    def mark_gap(self, since_id: int):
+        """
+        Gatewayの切断・再接続の際に呼び出し、すべてのチャンネルで網羅している範囲を since_id より後に狭めます。
+        
+        切断中に投稿されたメッセージは記録されていないため、それを含む期間の問い合わせはキャッシュミスにする。
+        """
+        for buffer in self._channels.values():
+            buffer.since_id = max(buffer.since_id, since_id)
+
+    def forget(self, channel_id: int, message_ids):
+        """削除済みのメッセージを記録から外します（投稿者IDを0にする）。"""
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        targets = set(message_ids)
+        for index in range(len(buffer.message_ids)):
+            if buffer.message_ids[index] in targets:
+                buffer.author_ids[index] = 0
 
-gemini_clients = []
+    def memory_bytes(self) -> int:
+        return len(self._channels) * self.per_channel * 16
 
-def initialize_gemini_clients():
-    """設定されたAPIキーに基づいてGeminiクライアントを初期化し、リストに格納します。"""
-    global gemini_clients
-    clients = []
-    
-    for api_key, name in API_KEY_CONFIGS:
-        if api_key:
-            try:
-                client = genai.Client(api_key=api_key)
-                clients.append({'client': client, 'name': name})
-                print(f"Gemini Client ({name}) の初期化に成功しました。")
-            except Exception as e:
-                print(f"WARNING: Gemini Client ({name}) の初期化に失敗しました: {e}")
-            
-    gemini_clients = clients
-    return len(gemini_clients) > 0
 
-initialize_gemini_clients() # Bot起動時にクライアントを初期化
+recent_messages = RecentMessageBuffer(RECENT_MESSAGES_PER_CHANNEL, RECENT_MESSAGES_MAX_CHANNELS)
+
+
+def current_snowflake() -> int:
+    """現在時刻に投稿されたメッセージが取り得る最大のIDを返します。"""
+    return discord.utils.time_snowflake(datetime.now(timezone.utc), high=True)
 
 
 # ----------------------------------------------------------------------
-# DMログ送信ヘルパー関数
+# ★ メッセージ一括削除エンジン
+# スパム対策の一括削除と /purge で共有する。2週間以内のメッセージは100件ずつ一括削除し、
+# それより古いメッセージは個別に削除する。いずれも同時実行数を制限して並行に実行する
+# （レート制限への到達時の待機は discord.py がルートごとに行う）。
 # ----------------------------------------------------------------------
+# Discordの一括削除APIで一度に削除できる最大件数
+BULK_DELETE_CHUNK_SIZE = 100
+# 一括削除APIで削除できるメッセージの期限（少し余裕を持たせる）
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+# 同時に実行する一括削除/個別削除の最大数
+PURGE_BULK_CONCURRENCY = int(os.environ.get("PURGE_BULK_CONCURRENCY", 2))
+PURGE_SINGLE_CONCURRENCY = int(os.environ.get("PURGE_SINGLE_CONCURRENCY", 5))
+
+
+class PurgeResult(NamedTuple):
+    """一括削除の結果。"""
+    requested: int
+    deleted: int
+    bulk_requests: int
+    single_requests: int
+
+    @property
+    def failed(self) -> int:
+        return self.requested - self.deleted
+
+
+class MessageDeletionEngine:
+    """大量のメッセージを、一括削除（100件単位）と個別削除に振り分けて並行に削除します。"""
+
+    def __init__(self, bulk_concurrency: int, single_concurrency: int):
+        self._bulk_semaphore = asyncio.Semaphore(max(1, bulk_concurrency))
+        self._single_semaphore = asyncio.Semaphore(max(1, single_concurrency))
+
+    async def delete(self, channel, messages) -> PurgeResult:
+        """messages（Message / PartialMessage）を削除し、結果を返します。"""
+        unique = {m.id: m for m in messages}
+        ordered = [unique[message_id] for message_id in sorted(unique)]
+        cutoff_id = discord.utils.time_snowflake(datetime.now(timezone.utc) - BULK_DELETE_MAX_AGE)
+        recent = [m for m in ordered if m.id > cutoff_id]
+        old = [m for m in ordered if m.id <= cutoff_id]
+
+        chunks = [recent[i:i + BULK_DELETE_CHUNK_SIZE] for i in range(0, len(recent), BULK_DELETE_CHUNK_SIZE)]
+        results = await asyncio.gather(
+            *(self._delete_chunk(channel, chunk) for chunk in chunks),
+            *(self._delete_single(m) for m in old)
+        )
+        return PurgeResult(
+            requested=len(ordered),
+            deleted=sum(results),
+            bulk_requests=sum(1 for chunk in chunks if len(chunk) > 1),
+            single_requests=len(old) + sum(1 for chunk in chunks if len(chunk) == 1)
+        )
 
-async def send_dm_log(message: str, embed: Optional[discord.Embed] = None):
-    """指定されたユーザーにDMとしてログを送信します。"""
-    if TARGET_USER_ID_FOR_LOGS:
+    async def _delete_chunk(self, channel, chunk: list) -> int:
+        if len(chunk) == 1:
+            return await self._delete_single(chunk[0])
         try:
-            # Botのキャッシュからユーザーを取得
-            user = bot.get_user(TARGET_USER_ID_FOR_LOGS)
-            if user is None:
-                # キャッシュにない場合はフェッチを試みる
-                user = await bot.fetch_user(TARGET_USER_ID_FOR_LOGS)
-
-            if user:
-                await user.send(content=message, embed=embed)
-            else:
-                print(f"ERROR: ユーザーID {TARGET_USER_ID_FOR_LOGS} が見つかりませんでした。DMログを送信できません。")
-        except Exception as e:
-            print(f"ERROR: DMログの送信中に予期せぬエラーが発生しました: {e}")
+            async with self._bulk_semaphore:
+                await channel.delete_messages(chunk)
+            return len(chunk)
+        except discord.HTTPException as e:
+            # 一括削除の権限がない、または期限切れのメッセージが含まれる場合は個別に削除を試みる
+            print(f"WARNING: 一括削除に失敗したため個別削除に切り替えます ({len(chunk)}件): {e}")
+            results = await asyncio.gather(*(self._delete_single(m) for m in chunk))
+            return sum(results)
+
+    async def _delete_single(self, message) -> int:
+        try:
+            async with self._single_semaphore:
+                await message.delete()
+            return 1
+        except discord.HTTPException:
+            # 既に削除されている（NotFound）・権限がない（Forbidden）場合も含め、削除できなかったものとして数える
+            return 0
+
+
+message_deletion_engine = MessageDeletionEngine(PURGE_BULK_CONCURRENCY, PURGE_SINGLE_CONCURRENCY)
 
 
 # ----------------------------------------------------------------------
-# ★ 自動BAN解除タスク
+# ★ レイド（多数のアカウントによる荒らし）検知
+# ユーザー単位のレート制限では捉えられない「多数の新規アカウントが少しずつ投稿する」攻撃を、
+# サーバー単位の時間窓カウンター（参加数・新規アカウントの投稿数・同じ内容の投稿者数）で検知する。
+# 検知するとレイドモードに入り、スローモード（またはチャンネルのロック）を設定して
+# （RAID_AUTO_BAN が有効なら新規アカウントをまとめてBANし）、管理者には開始時と終了時の要約だけを送る。
 # ----------------------------------------------------------------------
+RAID_DETECTION_ENABLED = env_flag("RAID_DETECTION_ENABLED", True)
+# 各カウンターの時間枠（秒）
+RAID_WINDOW_SECONDS = int(os.environ.get("RAID_WINDOW_SECONDS", 30))
+# 時間枠内の参加人数がこの値に達したらレイドとみなす
+RAID_JOIN_THRESHOLD = int(os.environ.get("RAID_JOIN_THRESHOLD", 10))
+# 時間枠内の新規アカウントの投稿数と投稿者数が、ともにこの値に達したらレイドとみなす
+RAID_NEW_ACCOUNT_MESSAGE_THRESHOLD = int(os.environ.get("RAID_NEW_ACCOUNT_MESSAGE_THRESHOLD", 25))
+RAID_NEW_ACCOUNT_AUTHOR_THRESHOLD = int(os.environ.get("RAID_NEW_ACCOUNT_AUTHOR_THRESHOLD", 5))
+# 時間枠内に同じ内容（正規化後）を投稿したユーザー数がこの値に達したらレイドとみなす
+RAID_DUPLICATE_AUTHOR_THRESHOLD = int(os.environ.get("RAID_DUPLICATE_AUTHOR_THRESHOLD", 8))
+# 同じ内容の判定対象とする最小文字数（正規化後）。挨拶や定型のリアクション（「おめでとう」など）を除外する
+RAID_DUPLICATE_MIN_LENGTH = int(os.environ.get("RAID_DUPLICATE_MIN_LENGTH", 20))
+# 1サーバーあたりに保持する投稿内容の最大数と、1つの内容あたりに保持する投稿数
+RAID_MAX_TRACKED_CONTENTS = 2000
+RAID_MAX_ENTRIES_PER_CONTENT = 200
+# アカウント作成からこの日数以内、またはサーバー参加からこの時間以内のメンバーを新規アカウントとみなす
+RAID_NEW_ACCOUNT_DAYS = int(os.environ.get("RAID_NEW_ACCOUNT_DAYS", 7))
+RAID_NEW_MEMBER_HOURS = int(os.environ.get("RAID_NEW_MEMBER_HOURS", 24))
+# 最後に不審な活動を検知してからこの時間（秒）が経過するとレイドモードを解除する
+RAID_MODE_DURATION_SECONDS = int(os.environ.get("RAID_MODE_DURATION_SECONDS", 600))
+# レイドモード中のチャンネルへの対処: "slowmode"（スローモード） または "lock"（@everyone の発言を禁止）
+RAID_LOCKDOWN_ACTION = os.environ.get("RAID_LOCKDOWN_ACTION", "slowmode").strip().lower()
+RAID_SLOWMODE_SECONDS = int(os.environ.get("RAID_SLOWMODE_SECONDS", 30))
+# レイドに関与した新規アカウントを自動でBANするか。誤検知で一般の新規メンバーを巻き込まないよう、
+# 既定では無効にしてチャンネルの制限だけを行う（BAN対象の人数は管理者への要約に表示する）
+RAID_AUTO_BAN = env_flag("RAID_AUTO_BAN", False)
+# BANと同時に削除する直近の投稿の期間（秒）
+RAID_BAN_DELETE_MESSAGE_SECONDS = int(os.environ.get("RAID_BAN_DELETE_MESSAGE_SECONDS", 3600))
+# 一括BAN APIで一度にBANできる最大人数
+BULK_BAN_CHUNK_SIZE = 200
+# レイドモード中に、保留中のBANとチャンネルの制限を反映する間隔（秒）
+RAID_ACTION_INTERVAL_SECONDS = 5
+
+
+class GuildRaidState:
+    """1サーバー分のレイド検知の状態。"""
+    __slots__ = (
+        "joins", "new_account_messages", "contents",
+        "started_at", "reason", "active_until",
+        "suspects", "ban_attempted", "banned", "ban_failed",
+        "pending_channels", "restricted_channels", "suppressed_logs", "lock",
+    )
 
-async def unban_user_after_delay(guild_id: int, user_id: int, delay_seconds: float):
-    """指定された遅延後にユーザーのBANを解除するタスクです。"""
-    # delay_seconds が負または0の場合は即時終了
-    if delay_seconds <= 0:
-        return
-        
-    try:
-        await asyncio.sleep(delay_seconds)
-        
-        guild = bot.get_guild(guild_id)
-        if not guild:
-            print(f"ERROR: Guild ID {guild_id} が見つかりません。自動BAN解除できませんでした。")
-            return
-            
-        user = discord.Object(id=user_id)
-        
-        # BANリストをチェックし、該当ユーザーがいれば解除
-        try:
-            await guild.fetch_ban(user)
-        except discord.NotFound:
-            # ユーザーがBANリストにいない場合は何もしない
-            print(f"INFO: User ID {user_id} は既にBANリストにいませんでした。自動BAN解除処理をスキップ。")
+    def __init__(self):
+        # (時刻, ユーザーID)
+        self.joins: deque = deque()
+        # (時刻, ユーザーID, チャンネルID)
+        self.new_account_messages: deque = deque()
+        # {内容のハッシュ: deque[(時刻, ユーザーID, チャンネルID, 新規アカウントか)]}（最近使われた順）
+        self.contents: OrderedDict[int, deque] = OrderedDict()
+        # レイドモードの開始時刻（レイドモードでなければ None）と検知理由
+        self.started_at: Optional[datetime] = None
+        self.reason = ""
+        # この時刻（time.monotonic()）を過ぎるとレイドモードを解除する
+        self.active_until = 0.0
+        # BAN対象の新規アカウントと、その処理状況
+        self.suspects: set[int] = set()
+        self.ban_attempted: set[int] = set()
+        self.banned: set[int] = set()
+        self.ban_failed: set[int] = set()
+        # 制限をかける予定のチャンネルと、制限済みのチャンネル {チャンネルID: 元の設定}
+        self.pending_channels: set[int] = set()
+        self.restricted_channels: dict = {}
+        # レイドモード中に送信を省略した個別のDMログの件数
+        self.suppressed_logs = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.started_at is not None
+
+    def is_idle(self, cutoff: float) -> bool:
+        return (
+            not self.active
+            and (not self.joins or self.joins[-1][0] <= cutoff)
+            and (not self.new_account_messages or self.new_account_messages[-1][0] <= cutoff)
+            and not self.contents
+        )
+
+
+def evict_older_than(entries: deque, cutoff: float):
+    """時刻順の deque から、cutoff 以前の要素を取り除きます。"""
+    while entries and entries[0][0] <= cutoff:
+        entries.popleft()
+
+
+class RaidDetector:
+    """
+    サーバー単位の時間窓カウンターでレイドを検知します。
+    
+    record_join() / record_message() はレイドモードに入ったときだけ検知理由を返し、
+    実際の対処（スローモード・BAN）は呼び出し側がまとめて行います。
+    1メッセージあたりの処理は正規化1回と deque への追加程度で、on_message の中で実行できます。
+    """
+
+    def __init__(self, normalizer: TextNormalizer):
+        self.normalizer = normalizer
+        self.window_seconds = RAID_WINDOW_SECONDS
+        self.new_account_age = timedelta(days=RAID_NEW_ACCOUNT_DAYS)
+        self.new_member_age = timedelta(hours=RAID_NEW_MEMBER_HOURS)
+        self._states: dict[int, GuildRaidState] = {}
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def state(self, guild_id: int) -> Optional[GuildRaidState]:
+        return self._states.get(guild_id)
+
+    def _state(self, guild_id: int) -> GuildRaidState:
+        state = self._states.get(guild_id)
+        if state is None:
+            state = self._states[guild_id] = GuildRaidState()
+        return state
+
+    def is_active(self, guild_id: int) -> bool:
+        state = self._states.get(guild_id)
+        return state is not None and state.active
+
+    def active_states(self) -> list[tuple[int, GuildRaidState]]:
+        return [(guild_id, state) for guild_id, state in self._states.items() if state.active]
+
+    def is_new_account(self, member) -> bool:
+        """アカウント作成（IDから算出）またはサーバー参加が最近のメンバーかどうかを返します。"""
+        now = datetime.now(timezone.utc)
+        if now - discord.utils.snowflake_time(member.id) < self.new_account_age:
+            return True
+        joined_at = getattr(member, "joined_at", None)
+        return joined_at is not None and now - joined_at < self.new_member_age
+
+    def record_join(self, member, now: Optional[float] = None) -> Optional[str]:
+        """参加を記録し、レイドモードに入った場合は検知理由を返します。"""
+        if now is None:
+            now = time.monotonic()
+        state = self._state(member.guild.id)
+        state.joins.append((now, member.id))
+        evict_older_than(state.joins, now - self.window_seconds)
+        if state.active:
+            # 参加が続いている間はレイドモードを延長する（投稿した時点でBAN対象になる）
+            if self.is_new_account(member):
+                state.active_until = now + RAID_MODE_DURATION_SECONDS
+            return None
+        if len(state.joins) >= RAID_JOIN_THRESHOLD:
+            return self._trigger(state, now, f"{self.window_seconds}秒間に{len(state.joins)}人が参加", (), ())
+        return None
+
+    def record_message(self, message, now: Optional[float] = None) -> Optional[str]:
+        """投稿を記録し、レイドモードに入った場合は検知理由を返します。"""
+        if now is None:
+            now = time.monotonic()
+        state = self._state(message.guild.id)
+        cutoff = now - self.window_seconds
+        author_id = message.author.id
+        channel_id = message.channel.id
+        new_account = self.is_new_account(message.author)
+
+        if new_account:
+            state.new_account_messages.append((now, author_id, channel_id))
+            evict_older_than(state.new_account_messages, cutoff)
+            if state.active:
+                # レイドモード中に投稿した新規アカウントはBAN対象とし、チャンネルも制限する
+                self._trigger(state, now, state.reason, (author_id,), (channel_id,))
+                return None
+
+        # 同じ内容（正規化後）の投稿を数える
+        duplicates = None
+        content = message.content
+        if len(content) >= RAID_DUPLICATE_MIN_LENGTH:
+            normalized = self.normalizer.normalize(content)
+            if len(normalized) >= RAID_DUPLICATE_MIN_LENGTH:
+                key = hash(normalized)
+                duplicates = state.contents.get(key)
+                if duplicates is None:
+                    duplicates = state.contents[key] = deque(maxlen=RAID_MAX_ENTRIES_PER_CONTENT)
+                    if len(state.contents) > RAID_MAX_TRACKED_CONTENTS:
+                        state.contents.popitem(last=False)
+                else:
+                    state.contents.move_to_end(key)
+                duplicates.append((now, author_id, channel_id, new_account))
+                evict_older_than(duplicates, cutoff)
+
+        if state.active:
+            return None
+
+        if duplicates is not None and len(duplicates) >= RAID_DUPLICATE_AUTHOR_THRESHOLD:
+            authors = {entry[1] for entry in duplicates}
+            if len(authors) >= RAID_DUPLICATE_AUTHOR_THRESHOLD:
+                return self._trigger(
+                    state, now,
+                    f"{self.window_seconds}秒間に{len(authors)}人が同じ内容を投稿",
+                    {entry[1] for entry in duplicates if entry[3]},
+                    {entry[2] for entry in duplicates}
+                )
+
+        entries = state.new_account_messages
+        if new_account and len(entries) >= RAID_NEW_ACCOUNT_MESSAGE_THRESHOLD:
+            authors = {entry[1] for entry in entries}
+            if len(authors) >= RAID_NEW_ACCOUNT_AUTHOR_THRESHOLD:
+                return self._trigger(
+                    state, now,
+                    f"{self.window_seconds}秒間に新規アカウント{len(authors)}人が{len(entries)}件投稿",
+                    authors,
+                    {entry[2] for entry in entries}
+                )
+        return None
+
+    def _trigger(self, state: GuildRaidState, now: float, reason: str, suspects, channels) -> Optional[str]:
+        state.suspects.update(suspects)
+        state.pending_channels.update(channels)
+        state.active_until = now + RAID_MODE_DURATION_SECONDS
+        if state.active:
+            return None
+        state.started_at = datetime.now(timezone.utc)
+        state.reason = reason
+        return reason
+
+    def suppress_log(self, guild_id: int) -> bool:
+        """レイドモード中なら個別のDMログを省略したものとして数え、True を返します。"""
+        state = self._states.get(guild_id)
+        if state is None or not state.active:
+            return False
+        state.suppressed_logs += 1
+        return True
+
+    def finish(self, guild_id: int) -> Optional[GuildRaidState]:
+        """レイドモードを終了し、終了した状態を返します（カウンターもリセットする）。"""
+        return self._states.pop(guild_id, None)
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """時間枠を過ぎた投稿内容と、活動のないサーバーの状態を削除します。"""
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.window_seconds
+        removed = 0
+        for guild_id, state in list(self._states.items()):
+            stale = [key for key, entries in state.contents.items() if entries[-1][0] <= cutoff]
+            for key in stale:
+                del state.contents[key]
+            if state.is_idle(cutoff):
+                del self._states[guild_id]
+                removed += 1
+        return removed
+
+
+raid_detector = RaidDetector(text_normalizer)
+
+
+def describe_raid_lockdown() -> str:
+    if RAID_LOCKDOWN_ACTION == "lock":
+        return "チャンネルのロック（@everyone の発言を禁止）"
+    return f"スローモード（{RAID_SLOWMODE_SECONDS}秒）"
+
+
+async def restrict_raid_channel(guild: discord.Guild, channel: discord.TextChannel, state: GuildRaidState):
+    """レイドモード中のチャンネルにスローモードまたはロックを設定し、元の設定を記録します。"""
+    reason = f"レイド検知: {state.reason}"
+    if RAID_LOCKDOWN_ACTION == "lock":
+        overwrite = channel.overwrites_for(guild.default_role)
+        previous = discord.PermissionOverwrite.from_pair(*overwrite.pair())
+        overwrite.send_messages = False
+        overwrite.send_messages_in_threads = False
+        await channel.set_permissions(guild.default_role, overwrite=overwrite, reason=reason)
+    else:
+        previous = channel.slowmode_delay
+        if previous >= RAID_SLOWMODE_SECONDS:
             return
+        await channel.edit(slowmode_delay=RAID_SLOWMODE_SECONDS, reason=reason)
+    state.restricted_channels[channel.id] = previous
 
-        # BANを解除
-        await guild.unban(user, reason="自動タイムBAN解除")
-        
-        # ログと通知
-        print(f"SUCCESS: User ID {user_id} のBANが {guild.name} で自動解除されました。")
-        
-        # DMログ通知
-        embed = discord.Embed(
-            title="✅ 自動タイムBAN解除ログ",
-            description=f"ユーザーID `{user_id}` のBANがサーバー `{guild.name}` で自動解除されました。",
-            color=discord.Color.green()
-        )
-        embed.add_field(name="解除されたユーザー", value=f"<@{user_id}>", inline=False)
-        embed.add_field(name="BAN期間", value=f"{delay_seconds / 3600:.2f} 時間", inline=False)
-        embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
 
-        await send_dm_log(f"**🟢 自動BAN解除:** User ID `{user_id}` のBANが自動解除されました。", embed=embed)
-                           
-        # 内部状態から削除
-        if guild_id in time_bans and user_id in time_bans[guild_id]:
-            del time_bans[guild_id][user_id]
-            if not time_bans[guild_id]:
-                del time_bans[guild_id]
+async def restore_raid_channel(guild: discord.Guild, channel: discord.TextChannel, previous):
+    """restrict_raid_channel で変更したチャンネルの設定を元に戻します。"""
+    reason = "レイドモード解除"
+    if isinstance(previous, discord.PermissionOverwrite):
+        await channel.set_permissions(
+            guild.default_role, overwrite=None if previous.is_empty() else previous, reason=reason
+        )
+    else:
+        await channel.edit(slowmode_delay=previous, reason=reason)
+
+
+async def apply_raid_actions(guild: discord.Guild, state: GuildRaidState):
+    """保留中のチャンネル制限と、新規アカウントの一括BANを反映します。"""
+    async with state.lock:
+        channel_ids, state.pending_channels = state.pending_channels, set()
+        for channel_id in channel_ids:
+            if channel_id in state.restricted_channels:
+                continue
+            channel = guild.get_channel(channel_id)
+            if not isinstance(channel, discord.TextChannel):
+                continue
+            try:
+                await restrict_raid_channel(guild, channel, state)
+            except discord.Forbidden:
+                print(f"ERROR: チャンネル {channel.name} の設定を変更する権限がありません。Botの権限を確認してください。")
+            except discord.HTTPException as e:
+                print(f"ERROR: レイド対策のチャンネル設定中にエラーが発生しました: {e}")
 
-    except discord.Forbidden:
+        if not RAID_AUTO_BAN:
+            return
+        user_ids = sorted(state.suspects - state.ban_attempted)
+        state.ban_attempted.update(user_ids)
+        for start in range(0, len(user_ids), BULK_BAN_CHUNK_SIZE):
+            chunk = [discord.Object(id=user_id) for user_id in user_ids[start:start + BULK_BAN_CHUNK_SIZE]]
+            try:
+                result = await guild.bulk_ban(
+                    chunk,
+                    reason=f"レイド検知による自動BAN: {state.reason}",
+                    delete_message_seconds=RAID_BAN_DELETE_MESSAGE_SECONDS
+                )
+                state.banned.update(user.id for user in result.banned)
+                state.ban_failed.update(user.id for user in result.failed)
+                for user in result.banned:
+                    audit_log.record(guild.id, "raid_ban", user_id=user.id, reason=state.reason)
+            except discord.HTTPException as e:
+                print(f"ERROR: レイド参加者の一括BANに失敗しました ({len(chunk)}人): {e}")
+                state.ban_failed.update(user.id for user in chunk)
+
+
+def build_raid_embed(guild: discord.Guild, state: GuildRaidState, title: str, color: discord.Color) -> discord.Embed:
+    embed = discord.Embed(title=title, description=f"サーバー: **{guild.name}** (ID: {guild.id})", color=color)
+    embed.add_field(name="検知理由", value=state.reason, inline=False)
+    embed.add_field(name="対処", value=describe_raid_lockdown(), inline=True)
+    if RAID_AUTO_BAN:
+        ban_text = f"{len(state.banned)}人"
+        if state.ban_failed:
+            ban_text += f"（失敗 {len(state.ban_failed)}人）"
+    else:
+        ban_text = f"自動BAN無効（対象 {len(state.suspects)}人）"
+    embed.add_field(name="BAN", value=ban_text, inline=True)
+    channels = " ".join(f"<#{channel_id}>" for channel_id in list(state.restricted_channels)[:20])
+    embed.add_field(name="制限したチャンネル", value=channels or "なし", inline=False)
+    embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
+    return embed
+
+
+# 実行中のレイド対処タスク（参照を保持しておかないとタスクがGCで消えることがある）
+raid_action_tasks: set[asyncio.Task] = set()
+
+
+def start_raid_mode(guild: discord.Guild, reason: str):
+    """
+    レイドモードを開始します。
+    
+    on_message / on_member_join から呼ばれるため、ここでは記録だけを行い、
+    チャンネルの制限・BAN・管理者への通知はバックグラウンドのタスクに任せてすぐに戻ります。
+    """
+    state = raid_detector.state(guild.id)
+    if state is None:
+        return
+    print(f"WARNING: レイドを検知しました。サーバー: {guild.name}, 理由: {reason}")
+    audit_log.record(guild.id, "raid_start", reason=reason)
+    task = asyncio.get_running_loop().create_task(run_raid_start_actions(guild, state))
+    raid_action_tasks.add(task)
+    task.add_done_callback(raid_action_tasks.discard)
+
+
+async def run_raid_start_actions(guild: discord.Guild, state: GuildRaidState):
+    """レイドモード開始時の対処を反映し、管理者に要約を1件だけ送信します。"""
+    try:
+        await apply_raid_actions(guild, state)
+    except Exception as e:
+        # 残った対処は raid_mode_watchdog が次の周期で再度反映する
+        print(f"ERROR: レイドモード開始時の対処中に予期せぬエラーが発生しました: {e}")
+    embed = build_raid_embed(guild, state, "🚨 レイドを検知しました", discord.Color.dark_red())
+    embed.add_field(
+        name="自動解除",
+        value=f"不審な活動が {RAID_MODE_DURATION_SECONDS}秒間なければ解除します。以降の個別ログは解除時にまとめて報告します。",
+        inline=False
+    )
+    send_dm_log(f"**🚨 レイド検知:** {guild.name} でレイドモードを開始しました。", embed=embed, priority=LOG_PRIORITY_HIGH)
+
+
+async def end_raid_mode(guild: discord.Guild, state: GuildRaidState):
+    """チャンネルの設定を元に戻してレイドモードを終了し、期間中の要約を送信します。"""
+    async with state.lock:
+        raid_detector.finish(guild.id)
+        for channel_id, previous in state.restricted_channels.items():
+            channel = guild.get_channel(channel_id)
+            if not isinstance(channel, discord.TextChannel):
+                continue
+            try:
+                await restore_raid_channel(guild, channel, previous)
+            except discord.HTTPException as e:
+                print(f"ERROR: チャンネル {channel.name} の設定を元に戻せませんでした: {e}")
+
+    duration = datetime.now(timezone.utc) - state.started_at
+    print(f"INFO: レイドモードを解除しました。サーバー: {guild.name}, BAN: {len(state.banned)}人")
+    audit_log.record(
+        guild.id, "raid_end", reason=state.reason, banned=len(state.banned),
+        duration_seconds=int(duration.total_seconds()), channels=list(state.restricted_channels)
+    )
+    embed = build_raid_embed(guild, state, "✅ レイドモードを解除しました", discord.Color.green())
+    embed.add_field(name="継続時間", value=f"{int(duration.total_seconds())}秒", inline=True)
+    embed.add_field(name="省略した個別ログ", value=f"{state.suppressed_logs}件", inline=True)
+    send_dm_log(f"**✅ レイドモード解除:** {guild.name}", embed=embed, priority=LOG_PRIORITY_HIGH)
+
+
+@tasks.loop(seconds=RAID_ACTION_INTERVAL_SECONDS)
+async def raid_mode_watchdog():
+    """レイドモード中のサーバーに保留中の対処を反映し、期限を過ぎたレイドモードを解除します。"""
+    now = time.monotonic()
+    for guild_id, state in raid_detector.active_states():
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            raid_detector.finish(guild_id)
+            continue
+        try:
+            if state.active_until <= now:
+                await end_raid_mode(guild, state)
+            elif state.pending_channels or state.suspects - state.ban_attempted:
+                await apply_raid_actions(guild, state)
+        except Exception as e:
+            print(f"ERROR: レイドモードの処理中に予期せぬエラーが発生しました: {e}")
+
+
+# ----------------------------------------------------------------------
+# ★ 類似メッセージ（コピペの使い回し）検知
+# 一部だけ書き換えたコピペを複数のチャンネルに投稿するスパムを、MinHash と LSH で検出する。
+# 正規化したメッセージを文字 n-gram（shingle）に分け、1回のハッシュ計算で作れる
+# One Permutation MinHash を署名とし、署名を帯（band）に分けたキーで候補を絞り込む。
+# 時間枠を過ぎた投稿は古い順に取り除き、保持する件数にも上限を設ける。
+# ----------------------------------------------------------------------
+NEAR_DUPLICATE_ENABLED = env_flag("NEAR_DUPLICATE_ENABLED", True)
+# 時間枠内に類似した投稿をしたユーザーがこの人数に達したら対処する
+# （1人の連投はユーザーごとのレート制限で扱い、ここでは人数だけを数える）
+NEAR_DUPLICATE_THRESHOLD = int(os.environ.get("NEAR_DUPLICATE_THRESHOLD", 5))
+NEAR_DUPLICATE_WINDOW_SECONDS = int(os.environ.get("NEAR_DUPLICATE_WINDOW_SECONDS", 300))
+# 対処の方法: "flag"（管理者への通知のみ） または "delete"（類似した投稿をすべて削除）
+# 定型文の共有などを誤って削除しないよう、既定では通知のみとする
+NEAR_DUPLICATE_ACTION = os.environ.get("NEAR_DUPLICATE_ACTION", "flag").strip().lower()
+# 判定対象とする最小文字数（正規化後）。短いメッセージは偶然似てしまうため対象外とする
+NEAR_DUPLICATE_MIN_LENGTH = int(os.environ.get("NEAR_DUPLICATE_MIN_LENGTH", 20))
+# 類似とみなす署名の一致率（Jaccard係数の推定値）
+NEAR_DUPLICATE_SIMILARITY = float(os.environ.get("NEAR_DUPLICATE_SIMILARITY", 0.5))
+# 保持する投稿の最大数（1件あたり約1.5KB）
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.environ.get("NEAR_DUPLICATE_MAX_ENTRIES", 10000))
+# shingle の文字数、MinHash の署名の長さ（2の累乗）、LSH の帯の数
+MINHASH_SHINGLE_SIZE = 3
+MINHASH_BINS = 32
+MINHASH_BANDS = 8
+# 1つの帯のバケットから類似度を確認する候補の最大数（新しいものから）
+NEAR_DUPLICATE_CANDIDATES_PER_BUCKET = 4
+
+
+class NearDuplicateEntry:
+    """索引に登録された1件の投稿。"""
+    __slots__ = ("timestamp", "guild_id", "channel_id", "message_id", "author_id", "signature", "cluster", "handled")
+
+    def __init__(self, timestamp: float, guild_id: int, channel_id: int, message_id: int, author_id: int, signature: array):
+        self.timestamp = timestamp
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.author_id = author_id
+        self.signature = signature
+        self.cluster: Optional[NearDuplicateCluster] = None
+        # 削除などの対処が済んでいるか
+        self.handled = False
+
+
+class NearDuplicateCluster:
+    """互いに類似した投稿のまとまり。entries は時間枠内の投稿（古い順）です。"""
+    __slots__ = ("entries", "authors", "sample", "flagged")
+
+    def __init__(self, sample: str):
+        # コピペの連投中は大きくなるため、先頭からの削除が O(1) の deque を使う
+        self.entries: deque[NearDuplicateEntry] = deque()
+        # 時間枠内の投稿者ごとの投稿数 {ユーザーID: 件数}。len() が投稿者の人数
+        self.authors: dict[int, int] = {}
+        # 通知に使う最初の投稿の内容（先頭のみ）
+        self.sample = sample
+        # しきい値を超えて通知済みか（通知は1つのまとまりにつき1回）
+        self.flagged = False
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, entry: NearDuplicateEntry):
+        self.entries.append(entry)
+        self.authors[entry.author_id] = self.authors.get(entry.author_id, 0) + 1
+
+    def pop_oldest(self) -> NearDuplicateEntry:
+        entry = self.entries.popleft()
+        remaining = self.authors[entry.author_id] - 1
+        if remaining:
+            self.authors[entry.author_id] = remaining
+        else:
+            del self.authors[entry.author_id]
+        return entry
+
+
+class NearDuplicateIndex:
+    """
+    MinHash の署名と LSH のバケットによる類似メッセージの索引です。
+    
+    add() は投稿を登録し、類似した投稿のまとまり（NearDuplicateCluster）を返します。
+    候補の確認は帯ごとに数件までに抑えるため、同じコピペが大量に投稿されても1件あたりの処理量は一定です。
+    """
+
+    # 空の bin を表す値（32ビットの値より大きい）
+    EMPTY = 1 << 32
+
+    def __init__(
+        self,
+        normalizer: TextNormalizer,
+        window_seconds: float = NEAR_DUPLICATE_WINDOW_SECONDS,
+        similarity: float = NEAR_DUPLICATE_SIMILARITY,
+        max_entries: int = NEAR_DUPLICATE_MAX_ENTRIES,
+        min_length: int = NEAR_DUPLICATE_MIN_LENGTH,
+        shingle_size: int = MINHASH_SHINGLE_SIZE,
+        bins: int = MINHASH_BINS,
+        bands: int = MINHASH_BANDS,
+    ):
+        if bins & (bins - 1) or bins % bands:
+            raise ValueError("bins は2の累乗かつ bands の倍数である必要があります。")
+        self.normalizer = normalizer
+        self.window_seconds = window_seconds
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.min_length = min_length
+        self.shingle_size = shingle_size
+        self.bins = bins
+        self.bands = bands
+        self._bin_shift = bins.bit_length() - 1
+        self._band_bytes = bins // bands * 4
+        # 登録順（＝時刻順）の投稿と、LSH のバケット {帯のキー: 投稿 または deque([投稿, ...])}
+        # ほとんどのバケットは1件だけなので、その場合は deque を作らずに投稿を直接格納する
+        self._entries: deque[NearDuplicateEntry] = deque()
+        self._buckets: dict = {}
+        self.total_added = 0
+        self.total_evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def signature(self, text: str) -> Optional[array]:
+        """正規化したテキストの MinHash 署名を返します。短すぎるテキストは None を返します。"""
+        normalized = self.normalizer.normalize(text)
+        if len(normalized) < self.min_length:
+            return None
+        size = self.shingle_size
+        shingles = {hash(normalized[i:i + size]) for i in range(len(normalized) - size + 1)}
+
+        # One Permutation MinHash: ハッシュの下位ビットで bin を決め、残りのビットの最小値を取る
+        bins = self.bins
+        mask = bins - 1
+        shift = self._bin_shift
+        values = [self.EMPTY] * bins
+        for shingle in shingles:
+            index = shingle & mask
+            value = (shingle >> shift) & 0xFFFFFFFF
+            if value < values[index]:
+                values[index] = value
+
+        # 空の bin は右隣の空でない bin の値で埋める（距離ごとに値を変える）
+        if self.EMPTY in values:
+            for index in range(bins):
+                if values[index] != self.EMPTY:
+                    continue
+                for distance in range(1, bins):
+                    borrowed = values[(index + distance) % bins]
+                    if borrowed != self.EMPTY:
+                        values[index] = (borrowed + distance * 0x9E3779B1) & 0xFFFFFFFF
+                        break
+        return array("I", values)
+
+    def estimate_similarity(self, a: array, b: array) -> float:
+        return sum(map(operator.eq, a, b)) / self.bins
+
+    def _band_keys(self, guild_id: int, signature: array) -> list[int]:
+        raw = signature.tobytes()
+        width = self._band_bytes
+        return [hash((guild_id, band, raw[band * width:(band + 1) * width])) for band in range(self.bands)]
+
+    def add(
+        self, guild_id: int, channel_id: int, message_id: int, author_id: int, content: str,
+        now: Optional[float] = None
+    ) -> Optional[NearDuplicateCluster]:
+        """投稿を登録し、その投稿が属するまとまりを返します。判定対象外の投稿は None を返します。"""
+        if now is None:
+            now = time.monotonic()
+        self._evict(now)
+        signature = self.signature(content)
+        if signature is None:
+            return None
+
+        keys = self._band_keys(guild_id, signature)
+        cluster = None
+        buckets = self._buckets
+        checked = set()
+        for key in keys:
+            bucket = buckets.get(key)
+            if bucket is None:
+                continue
+            if type(bucket) is NearDuplicateEntry:
+                candidates = (bucket,)
+            else:
+                candidates = itertools.islice(reversed(bucket), NEAR_DUPLICATE_CANDIDATES_PER_BUCKET)
+            for candidate in candidates:
+                # 複数の帯で一致した候補は1回だけ確認する
+                if candidate.cluster in checked:
+                    continue
+                checked.add(candidate.cluster)
+                if self.estimate_similarity(signature, candidate.signature) >= self.similarity:
+                    cluster = candidate.cluster
+                    break
+            if cluster is not None:
+                break
+        if cluster is None:
+            cluster = NearDuplicateCluster(content[:100])
+
+        entry = NearDuplicateEntry(now, guild_id, channel_id, message_id, author_id, signature)
+        entry.cluster = cluster
+        cluster.append(entry)
+        self._entries.append(entry)
+        for key in keys:
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = entry
+            elif type(bucket) is NearDuplicateEntry:
+                buckets[key] = deque((bucket, entry))
+            else:
+                bucket.append(entry)
+        self.total_added += 1
+        if len(self._entries) > self.max_entries:
+            self._remove_oldest()
+        return cluster
+
+    def _evict(self, now: float):
+        cutoff = now - self.window_seconds
+        entries = self._entries
+        while entries and entries[0].timestamp <= cutoff:
+            self._remove_oldest()
+
+    def _remove_oldest(self):
+        entry = self._entries.popleft()
+        # 登録順に取り除くので、まとまり・バケットの中でも常に先頭にある
+        entry.cluster.pop_oldest()
+        for key in self._band_keys(entry.guild_id, entry.signature):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            if bucket is entry:
+                del self._buckets[key]
+                continue
+            if type(bucket) is NearDuplicateEntry:
+                continue
+            if bucket[0] is entry:
+                bucket.popleft()
+            elif entry in bucket:
+                bucket.remove(entry)
+            if len(bucket) == 1:
+                self._buckets[key] = bucket[0]
+        self.total_evicted += 1
+
+    def sweep(self, now: Optional[float] = None):
+        """時間枠を過ぎた投稿を取り除きます（投稿が途絶えたときのため）。"""
+        self._evict(time.monotonic() if now is None else now)
+
+    def memory_bytes(self) -> int:
+        """保持している索引のおおよそのメモリ使用量（バイト）を返します。"""
+        total = sys.getsizeof(self._entries) + sys.getsizeof(self._buckets)
+        clusters = {}
+        for entry in self._entries:
+            total += sys.getsizeof(entry) + sys.getsizeof(entry.signature)
+            clusters[id(entry.cluster)] = entry.cluster
+        for cluster in clusters.values():
+            total += (
+                sys.getsizeof(cluster) + sys.getsizeof(cluster.entries)
+                + sys.getsizeof(cluster.authors) + sys.getsizeof(cluster.sample)
+            )
+        total += sum(sys.getsizeof(bucket) for bucket in self._buckets.values() if type(bucket) is deque)
+        # バケットのキー（int）の分
+        total += len(self._buckets) * 32
+        return total
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "buckets": len(self._buckets),
+            "memory_bytes": self.memory_bytes(),
+            "total_added": self.total_added,
+            "total_evicted": self.total_evicted,
+        }
+
+
+near_duplicate_index = NearDuplicateIndex(text_normalizer)
+
+
+async def handle_near_duplicates(message: discord.Message, cluster: NearDuplicateCluster):
+    """投稿者の人数がしきい値に達したまとまりについて、削除と管理者への通知を行います。"""
+    first_time = not cluster.flagged
+    cluster.flagged = True
+
+    deleted_count = 0
+    if NEAR_DUPLICATE_ACTION == "delete":
+        # まだ削除していない投稿をチャンネルごとにまとめて削除する
+        targets: dict[int, list[int]] = {}
+        for entry in cluster.entries:
+            if not entry.handled and entry.guild_id == message.guild.id:
+                entry.handled = True
+                targets.setdefault(entry.channel_id, []).append(entry.message_id)
+        for channel_id, message_ids in targets.items():
+            channel = message.guild.get_channel_or_thread(channel_id)
+            if channel is None:
+                continue
+            result = await message_deletion_engine.delete(
+                channel, [channel.get_partial_message(message_id) for message_id in message_ids]
+            )
+            deleted_count += result.deleted
+            recent_messages.forget(channel_id, message_ids)
+
+    if deleted_count or first_time:
+        audit_log.record(
+            message.guild.id, "near_duplicate", user_id=message.author.id, channel_id=message.channel.id,
+            deleted=deleted_count, similar=len(cluster), content=message.content[:500]
+        )
+    if not first_time:
+        return
+    authors = cluster.authors
+    channels = {entry.channel_id for entry in cluster.entries}
+    print(f"MOD: 類似した投稿を検知しました。サーバー: {message.guild.name}, 件数: {len(cluster)}, 投稿者: {len(authors)}人")
+    if raid_detector.suppress_log(message.guild.id):
+        return
+    embed = discord.Embed(
+        title="📑 類似メッセージの連投を検知",
+        description=f"{NEAR_DUPLICATE_WINDOW_SECONDS}秒以内に類似した投稿が {len(cluster)} 件ありました。",
+        color=discord.Color.dark_orange()
+    )
+    embed.add_field(name="投稿者", value=f"{len(authors)}人", inline=True)
+    embed.add_field(
+        name="対処",
+        value=f"{deleted_count} 件を削除（以降の類似投稿も削除します）" if NEAR_DUPLICATE_ACTION == "delete" else "通知のみ",
+        inline=True
+    )
+    embed.add_field(name="チャンネル", value=" ".join(f"<#{channel_id}>" for channel_id in list(channels)[:20]), inline=False)
+    embed.add_field(name="内容 (最初の投稿)", value=f"`{cluster.sample}`", inline=False)
+    embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
+    send_dm_log(f"**📑 類似メッセージ連投:** {message.guild.name} で同じ内容の投稿が繰り返されています。", embed=embed)
+
+
+@tasks.loop(seconds=RATE_LIMIT_SWEEP_INTERVAL_SECONDS)
+async def sweep_rate_limit_state():
+    """投稿の途絶えたユーザーのレート制限履歴、レイド検知と類似メッセージ検知の状態を定期的に削除します。"""
+    spam_tracking.sweep()
+    raid_detector.sweep()
+    near_duplicate_index.sweep()
+# ----------------------------------------------------------------------
+
+
+# ----------------------------------------------------------------------
+# ★ シャーディングとマルチプロセス構成
+# AUTO_SHARDING=1（または SHARD_COUNT の指定）で AutoShardedBot を使い、1つのプロセスで複数のシャードを扱う。
+# BOT_WORKERS を2以上にすると、起動したプロセスはランチャーになり、シャードを分割してワーカープロセスを起動する。
+# ランチャーはDiscordに接続せず、Webサーバーとして各ワーカーの状態とメトリクスを集約して返す。
+# サーバーごとの設定・一時BANはSQLiteで全プロセスが共有し、各ワーカーは担当するサーバーの分だけを読み込む。
+# ----------------------------------------------------------------------
+AUTO_SHARDING = env_flag("AUTO_SHARDING")
+# ランチャーが起動するワーカープロセス数（1ならランチャーを使わず、このプロセスでBotを動かす）
+BOT_WORKERS = max(1, int(os.environ.get("BOT_WORKERS", 1)))
+# ワーカーの番号とランチャーのPID（ワーカーを起動するときにランチャーが設定する）
+BOT_WORKER_ID = int(os.environ["BOT_WORKER_ID"]) if os.environ.get("BOT_WORKER_ID") else None
+BOT_LAUNCHER_PID = int(os.environ["BOT_LAUNCHER_PID"]) if os.environ.get("BOT_LAUNCHER_PID") else None
+
+
+def parse_shard_ids(value: str) -> Optional[list[int]]:
+    """"0-3,8" のような指定をシャード番号のリストにします。空なら None を返します。"""
+    shard_ids = set()
+    for part in value.replace(" ", "").split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        shard_ids.update(range(int(start), int(end or start) + 1))
+    return sorted(shard_ids) if shard_ids else None
+
+
+def format_shard_ids(shard_ids: list[int]) -> str:
+    """連続したシャード番号を "0-3,8" の形にまとめます。"""
+    parts = []
+    for shard_id in sorted(shard_ids):
+        if parts and parts[-1][1] == shard_id - 1:
+            parts[-1][1] = shard_id
+        else:
+            parts.append([shard_id, shard_id])
+    return ",".join(str(start) if start == end else f"{start}-{end}" for start, end in parts)
+
+
+# シャードの総数と、このプロセスが担当するシャード番号。未指定なら Discord の推奨数ですべてのシャードを担当する
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = parse_shard_ids(os.environ.get("SHARD_IDS", ""))
+if SHARD_IDS is not None and (SHARD_COUNT is None or SHARD_IDS[-1] >= SHARD_COUNT):
+    print("WARNING: SHARD_IDS には SHARD_COUNT 未満の番号を、SHARD_COUNT と合わせて指定してください。SHARD_IDS を無視します。")
+    SHARD_IDS = None
+
+if BOT_WORKER_ID is not None:
+    PROCESS_ROLE = "worker"
+elif BOT_WORKERS > 1:
+    PROCESS_ROLE = "launcher"
+else:
+    PROCESS_ROLE = "standalone"
+
+# 担当するシャード（None ならすべて）。サーバーIDからシャードを求めて、読み込む設定を絞り込む
+OWNED_SHARD_IDS = frozenset(SHARD_IDS) if SHARD_IDS is not None else None
+
+
+def owns_guild(guild_id: int) -> bool:
+    """このプロセスが担当するシャードのサーバーなら True を返します（シャードを分割していなければ常に True）。"""
+    if OWNED_SHARD_IDS is None:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in OWNED_SHARD_IDS
+
+
+# ----------------------------------------------------------------------
+# ★ ローカルストレージ (SQLite) ヘルパー
+# ----------------------------------------------------------------------
+
+class SQLiteStore:
+    """
+    SQLiteファイルへのアクセスを専用スレッドで直列化し、イベントループをブロックせずに実行します。
+    
+    サブクラスは setup() でテーブルを作成し、run() に「接続を第1引数に取る関数」を渡して操作します。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def setup(self, conn: sqlite3.Connection):
+        """初回接続時に呼ばれます。テーブルやインデックスを作成してください。"""
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self.setup(conn)
+        conn.commit()
+        return conn
+
+    def _call(self, fn, args):
+        if self._conn is None:
+            self._conn = self._connect()
+        return fn(self._conn, *args)
+
+    def run_sync(self, fn, *args):
+        """専用スレッドで fn(conn, *args) を実行し、完了まで待ちます（起動処理などの同期コード用）。"""
+        return self._executor.submit(self._call, fn, args).result()
+
+    async def run(self, fn, *args):
+        """専用スレッドで fn(conn, *args) を実行し、結果を返します。"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args)
+
+
+# ----------------------------------------------------------------------
+# ★ レート制限ポリシーの保存 (サーバーごと)
+# /ratelimit で設定したポリシーをSQLiteに保存し、起動時（ワーカーの再起動時を含む）に読み込み直す。
+# ----------------------------------------------------------------------
+RATE_LIMIT_POLICY_DB_PATH = os.path.join(BOT_DATA_DIR, "rate_limit_policies.db")
+
+
+class RateLimitPolicyStore(SQLiteStore):
+    """レート制限ポリシーのSQLite層。scope は "guild" / "channel" / "role"（"guild" の target_id は0）。"""
+
+    def setup(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_policies ("
+            "guild_id INTEGER NOT NULL, scope TEXT NOT NULL, target_id INTEGER NOT NULL, windows TEXT NOT NULL, "
+            "PRIMARY KEY (guild_id, scope, target_id))"
+        )
+
+    def _load(self, conn: sqlite3.Connection) -> list[tuple]:
+        return conn.execute("SELECT guild_id, scope, target_id, windows FROM rate_limit_policies").fetchall()
+
+    def _save(self, conn: sqlite3.Connection, guild_id: int, scope: str, target_id: int, policy: Optional[tuple]):
+        if policy is None:
+            conn.execute(
+                "DELETE FROM rate_limit_policies WHERE guild_id = ? AND scope = ? AND target_id = ?",
+                (guild_id, scope, target_id)
+            )
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit_policies (guild_id, scope, target_id, windows) VALUES (?, ?, ?, ?)",
+                (guild_id, scope, target_id, json.dumps([list(window) for window in policy]))
+            )
+        conn.commit()
+
+    async def load_into(self, engine: RateLimitPolicyEngine) -> int:
+        """担当するサーバーのポリシーを engine に設定し、読み込んだ件数を返します。"""
+        count = 0
+        for guild_id, scope, target_id, windows in await self.run(self._load):
+            if not owns_guild(guild_id):
+                continue
+            policy = tuple(RateLimitWindow(limit, window_seconds) for limit, window_seconds in json.loads(windows))
+            engine.set_policy(
+                guild_id, policy,
+                channel_id=target_id if scope == "channel" else None,
+                role_id=target_id if scope == "role" else None
+            )
+            count += 1
+        return count
+
+    async def save(self, guild_id: int, policy: Optional[tuple], channel_id: Optional[int] = None, role_id: Optional[int] = None):
+        """ポリシーを保存します。policy に None を指定すると削除します。"""
+        if channel_id is not None:
+            scope, target_id = "channel", channel_id
+        elif role_id is not None:
+            scope, target_id = "role", role_id
+        else:
+            scope, target_id = "guild", 0
+        await self.run(self._save, guild_id, scope, target_id, policy)
+
+
+rate_limit_policy_store = RateLimitPolicyStore(RATE_LIMIT_POLICY_DB_PATH)
+
+
+# ----------------------------------------------------------------------
+# ★ 禁止ワードリストの保存 (サーバーごと)
+# サーバーごとの禁止ワードをSQLiteに保存し、変更のたびにバージョンを1つ進める。
+# 照合器はサーバーごとに保持し、そのサーバーのリストが変わったときだけ更新する。
+# 他のプロセスやツールがファイルを直接書き換えた場合も、定期的にバージョンを確認して読み込み直す。
+# まだリストを編集していないサーバーには DEFAULT_BANNED_WORDS の照合器を共有で使う。
+# ----------------------------------------------------------------------
+BANNED_WORDS_DB_PATH = os.path.join(BOT_DATA_DIR, "banned_words.db")
+# 他のプロセスによる変更を確認する間隔（秒）
+BANNED_WORDS_RELOAD_INTERVAL_SECONDS = int(os.environ.get("BANNED_WORDS_RELOAD_INTERVAL_SECONDS", 30))
+# 1サーバーあたりの禁止ワードの最大数と、/blockword import で受け付けるファイルの最大サイズ
+BANNED_WORDS_MAX_PER_GUILD = int(os.environ.get("BANNED_WORDS_MAX_PER_GUILD", 20000))
+BANNED_WORDS_IMPORT_MAX_BYTES = 1024 * 1024
+
+
+class GuildBannedWords:
+    """1つのサーバーの禁止ワードリストと、その照合器。"""
+    __slots__ = ("words", "version", "filter")
+
+    def __init__(self, words: set[str], version: int, normalizer: TextNormalizer):
+        self.words = words
+        self.version = version
+        self.filter = BannedWordFilter(words, normalizer)
+
+    @classmethod
+    async def build(cls, words: set[str], version: int, normalizer: TextNormalizer) -> "GuildBannedWords":
+        """照合器をイベントループの外（スレッド）で構築します。数万語のリストでも on_message を止めない。"""
+        return await asyncio.to_thread(cls, words, version, normalizer)
+
+
+class BannedWordStore(SQLiteStore):
+    """禁止ワードのSQLite層。"""
+
+    def setup(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS banned_word_lists ("
+            "guild_id INTEGER PRIMARY KEY, version INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS banned_words ("
+            "guild_id INTEGER NOT NULL, word TEXT NOT NULL, PRIMARY KEY (guild_id, word)) WITHOUT ROWID"
+        )
+
+    def _versions(self, conn: sqlite3.Connection) -> dict[int, int]:
+        return dict(conn.execute("SELECT guild_id, version FROM banned_word_lists").fetchall())
+
+    def _load(self, conn: sqlite3.Connection, guild_ids: list[int]) -> dict[int, tuple[int, set[str]]]:
+        """指定したサーバーの {guild_id: (version, words)} を返します。"""
+        result = {}
+        for guild_id in guild_ids:
+            row = conn.execute("SELECT version FROM banned_word_lists WHERE guild_id = ?", (guild_id,)).fetchone()
+            if row is None:
+                continue
+            words = {word for (word,) in conn.execute("SELECT word FROM banned_words WHERE guild_id = ?", (guild_id,))}
+            result[guild_id] = (row[0], words)
+        return result
+
+    def _apply(self, conn: sqlite3.Connection, guild_id: int, added: list[str], removed: list[str]) -> int:
+        """単語の追加・削除を1つのトランザクションで行い、新しいバージョンを返します。"""
+        with conn:
+            conn.executemany("DELETE FROM banned_words WHERE guild_id = ? AND word = ?", [(guild_id, word) for word in removed])
+            conn.executemany("INSERT OR IGNORE INTO banned_words (guild_id, word) VALUES (?, ?)", [(guild_id, word) for word in added])
+            conn.execute(
+                "INSERT INTO banned_word_lists (guild_id, version, updated_at) VALUES (?, 1, ?) "
+                "ON CONFLICT (guild_id) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at",
+                (guild_id, time.time())
+            )
+            return conn.execute("SELECT version FROM banned_word_lists WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+
+    async def versions(self) -> dict[int, int]:
+        return await self.run(self._versions)
+
+    async def load(self, guild_ids: list[int]) -> dict[int, tuple[int, set[str]]]:
+        return await self.run(self._load, guild_ids)
+
+    async def apply(self, guild_id: int, added: list[str], removed: list[str]) -> int:
+        return await self.run(self._apply, guild_id, added, removed)
+
+
+class BannedWordRegistry:
+    """
+    サーバーごとの禁止ワードの照合器を保持します。
+    
+    filter_for() は辞書の参照のみで、on_message から毎回呼び出せます。
+    変更はSQLiteに保存してから、そのサーバーの照合器だけを更新します。
+    """
+
+    def __init__(self, store: BannedWordStore, default_words, normalizer: TextNormalizer):
+        self.store = store
+        self.normalizer = normalizer
+        self.default_words = frozenset(default_words)
+        self.default = GuildBannedWords(set(self.default_words), 0, normalizer)
+        self._guilds: dict[int, GuildBannedWords] = {}
+        self._lock = asyncio.Lock()
+        self._loaded = False
+        self.reloads = 0
+
+    def get(self, guild_id: int) -> GuildBannedWords:
+        return self._guilds.get(guild_id, self.default)
+
+    def filter_for(self, guild_id: int) -> BannedWordFilter:
+        return self._guilds.get(guild_id, self.default).filter
+
+    async def load(self):
+        """保存済みのすべてのリストを読み込みます（初回のみ）。"""
+        async with self._lock:
+            if self._loaded:
+                return
+            changed = await self._reload_changed()
+            self._loaded = True
+            print(f"INFO: 禁止ワードリストを {changed} サーバー分読み込みました。")
+
+    async def reload(self) -> int:
+        """バージョンが変わったサーバーのリストを読み込み直し、読み込んだサーバー数を返します。"""
+        async with self._lock:
+            return await self._reload_changed()
+
+    async def _reload_changed(self) -> int:
+        versions = await self.store.versions()
+        # 他のワーカーが担当するサーバーのリストは読み込まない
+        changed = [
+            guild_id for guild_id, version in versions.items()
+            if owns_guild(guild_id) and (guild_id not in self._guilds or self._guilds[guild_id].version != version)
+        ]
+        if not changed:
+            return 0
+        for guild_id, (version, words) in (await self.store.load(changed)).items():
+            # 構築が終わるまでは古い照合器で照合を続け、完成したものと差し替える
+            self._guilds[guild_id] = await GuildBannedWords.build(words, version, self.normalizer)
+        self.reloads += len(changed)
+        return len(changed)
+
+    def _normalize_word(self, word: str) -> Optional[str]:
+        """登録する形（小文字・前後の空白なし）にします。照合できない単語は None を返します。"""
+        word = word.lower().strip()
+        if not word or not self.normalizer.normalize(word):
+            return None
+        return word
+
+    async def update(self, guild_id: int, add=(), remove=(), replace: bool = False) -> tuple[list[str], list[str], list[str]]:
+        """
+        禁止ワードを追加・削除し、(追加した単語, 削除した単語, 登録できなかった単語) を返します。
+        
+        replace=True の場合は、現在のリストを add の内容で置き換えます。
+        """
+        await self.load()
+        async with self._lock:
+            # 他のプロセスによる変更を取り込んでから差分を計算する
+            await self._reload_changed()
+            current = self.get(guild_id)
+            words = set() if replace else set(current.words)
+            rejected = []
+            for word in add:
+                normalized = self._normalize_word(word)
+                if normalized is None or (normalized not in words and len(words) >= BANNED_WORDS_MAX_PER_GUILD):
+                    rejected.append(word)
+                else:
+                    words.add(normalized)
+            words.difference_update(word.lower().strip() for word in remove)
+
+            added = sorted(words - current.words)
+            removed = sorted(current.words - words)
+            if not added and not removed:
+                return [], [], rejected
+
+            # 初回の変更では、既定のリストから残した単語も含めて保存する
+            stored = added if guild_id in self._guilds else sorted(words)
+            version = await self.store.apply(guild_id, stored, removed)
+            entry = self._guilds.get(guild_id)
+            if entry is None or replace or len(added) + len(removed) > len(words) // 2:
+                self._guilds[guild_id] = await GuildBannedWords.build(words, version, self.normalizer)
+            else:
+                # 差分が小さければ、照合器を作り直さずに追加・削除する
+                for word in removed:
+                    entry.filter.remove(word)
+                for word in added:
+                    entry.filter.add(word)
+                entry.words = words
+                entry.version = version
+            return added, removed, rejected
+
+    def stats(self) -> dict:
+        return {
+            "guilds": len(self._guilds),
+            "words": sum(len(entry.words) for entry in self._guilds.values()),
+            "reloads": self.reloads,
+        }
+
+
+banned_words = BannedWordRegistry(BannedWordStore(BANNED_WORDS_DB_PATH), DEFAULT_BANNED_WORDS, text_normalizer)
+
+
+@tasks.loop(seconds=BANNED_WORDS_RELOAD_INTERVAL_SECONDS)
+async def reload_banned_words():
+    """他のプロセスによる禁止ワードリストの変更を取り込みます。"""
+    try:
+        changed = await banned_words.reload()
+    except Exception as e:
+        print(f"ERROR: 禁止ワードリストの再読み込みに失敗しました: {e}")
+        return
+    if changed:
+        print(f"INFO: 禁止ワードリストの変更を {changed} サーバー分読み込みました。")
+
+# Botの設定 (Intentsの設定が必要)
+# メンバーリストの取得とプレゼンス（ステータス）の取得のために、Intentを設定
+intents = discord.Intents.default()
+intents.message_content = True 
+intents.members = True     # on_messageでメンバーの権限をチェックするために必要
+intents.presences = True   # メンバーのオンライン状態（Botステータス確認）のために必要
+intents.bans = True        # BAN/UNBAN操作のために必要
+
+# Discord REST APIのリクエスト数とレート制限(429)の発生数を記録する
+discord_http_requests = Counter("discord_http_requests_total", "Discord REST APIへのリクエスト数", ("method", "status"))
+discord_rate_limits = Counter("discord_rate_limited_total", "Discord REST APIのレート制限(429)の発生数", ("method", "scope"))
+
+
+async def on_discord_http_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+    status = params.response.status
+    discord_http_requests.labels(params.method, status).inc()
+    if status == 429:
+        discord_rate_limits.labels(params.method, params.response.headers.get("X-RateLimit-Scope", "unknown")).inc()
+
+
+discord_http_trace = aiohttp.TraceConfig()
+discord_http_trace.on_request_end.append(on_discord_http_request_end)
+
+if AUTO_SHARDING or SHARD_COUNT is not None:
+    # SHARD_COUNT が未指定なら Discord の推奨数、SHARD_IDS が未指定ならすべてのシャードに接続する
+    bot = commands.AutoShardedBot(
+        command_prefix='!', intents=intents, http_trace=discord_http_trace,
+        shard_count=SHARD_COUNT, shard_ids=SHARD_IDS
+    )
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, http_trace=discord_http_trace)
+
+
+# ----------------------------------------------------------------------
+# Geminiクライアントの初期化とフォールバックリストの作成
+# ----------------------------------------------------------------------
+
+# 利用可能なAPIキーのリストと名前
+API_KEY_CONFIGS = [
+    (GEMINI_API_KEY_PRIMARY, 'Primary'),
+    (GEMINI_API_KEY_SECONDARY, 'Secondary'),
+    (GEMINI_API_KEY_THIRD, 'Third'),
+    (GEMINI_API_KEY_FOURTH, 'Fourth'),
+]
+
+gemini_clients = []
+
+def initialize_gemini_clients():
+    """設定されたAPIキーに基づいてGeminiクライアントを初期化し、リストに格納します。"""
+    global gemini_clients
+    clients = []
+    
+    for api_key, name in API_KEY_CONFIGS:
+        if api_key:
+            try:
+                client = genai.Client(api_key=api_key)
+                clients.append({'client': client, 'name': name})
+                print(f"Gemini Client ({name}) の初期化に成功しました。")
+            except Exception as e:
+                print(f"WARNING: Gemini Client ({name}) の初期化に失敗しました: {e}")
+            
+    gemini_clients = clients
+    return len(gemini_clients) > 0
+
+initialize_gemini_clients() # Bot起動時にクライアントを初期化
+
+
+# ----------------------------------------------------------------------
+# ★ Gemini呼び出しの非同期化と同時実行数の制御
+# 同期APIをコルーチン内で呼ぶとイベントループ全体（ゲートウェイ/on_message/Webサーバー）が
+# 応答待ちの間停止するため、非同期API (client.aio) を使用する。
+# ----------------------------------------------------------------------
+GEMINI_MODEL = 'gemini-2.5-flash'
+# 同時に実行できるGeminiリクエストの最大数
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 4))
+# 1リクエストあたりのタイムアウト（秒）
+GEMINI_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_REQUEST_TIMEOUT_SECONDS", 60))
+
+gemini_semaphore = asyncio.Semaphore(max(1, GEMINI_MAX_CONCURRENCY))
+
+
+# ----------------------------------------------------------------------
+# ★ Gemini APIキーのスケジューラー
+# キーごとの429/クォータエラー、クールダウン、処理中リクエスト数、EWMAレイテンシを追跡し、
+# リクエストごとに最も健全なキーから順に試行する。
+# ----------------------------------------------------------------------
+# 429（レート制限）を受けたキーを休ませる基本時間（秒）。連続するたびに倍増する
+GEMINI_KEY_COOLDOWN_SECONDS = float(os.environ.get("GEMINI_KEY_COOLDOWN_SECONDS", 30))
+GEMINI_KEY_MAX_COOLDOWN_SECONDS = float(os.environ.get("GEMINI_KEY_MAX_COOLDOWN_SECONDS", 600))
+# この回数だけ連続で失敗したキーはサーキットブレーカーを開いて一定時間除外する
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("GEMINI_CIRCUIT_FAILURE_THRESHOLD", 3))
+GEMINI_CIRCUIT_OPEN_SECONDS = float(os.environ.get("GEMINI_CIRCUIT_OPEN_SECONDS", 120))
+# レイテンシのEWMA平滑化係数と、未計測キーに仮定するレイテンシ（秒）
+GEMINI_LATENCY_EWMA_ALPHA = 0.3
+GEMINI_DEFAULT_LATENCY_SECONDS = 3.0
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """APIエラーがレート制限/クォータ超過によるものかを判定します。"""
+    if not isinstance(error, APIError):
+        return False
+    return error.code == 429 or error.status == "RESOURCE_EXHAUSTED"
+
+
+class GeminiKeyState:
+    """1つのAPIキーの健全性の状態。"""
+    __slots__ = (
+        "name", "in_flight", "ewma_latency", "consecutive_failures",
+        "consecutive_rate_limits", "cooldown_until", "circuit_open_until",
+        "successes", "failures", "rate_limits", "last_error", "probe_circuit_until",
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight = 0
+        self.ewma_latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.consecutive_rate_limits = 0
+        self.cooldown_until = 0.0
+        self.circuit_open_until = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limits = 0
+        self.last_error: Optional[str] = None
+        # 定期確認（on_probe）で開いたサーキットの終了時刻。生成の失敗で開き直された場合は一致しなくなる
+        self.probe_circuit_until = 0.0
+
+    def available_at(self) -> float:
+        """このキーが再び利用可能になる時刻 (time.monotonic 基準)。"""
+        return max(self.cooldown_until, self.circuit_open_until)
+
+    def score(self) -> float:
+        """小さいほど健全。レイテンシ × (処理中件数 + 1) × (連続失敗数 + 1) で評価する。"""
+        latency = self.ewma_latency if self.ewma_latency is not None else GEMINI_DEFAULT_LATENCY_SECONDS
+        return latency * (self.in_flight + 1) * (self.consecutive_failures + 1)
+
+
+class GeminiKeyScheduler:
+    """APIキーごとの健全性を追跡し、リクエストごとのキーの試行順を決定します。"""
+
+    def __init__(self):
+        self.states: dict[str, GeminiKeyState] = {}
+        self._round_robin = 0
+
+    def state(self, name: str) -> GeminiKeyState:
+        key_state = self.states.get(name)
+        if key_state is None:
+            key_state = self.states[name] = GeminiKeyState(name)
+        return key_state
+
+    def order(self, clients: list[dict]) -> list[dict]:
+        """
+        クライアントのリストを試行順に並べて返します。
+        
+        利用可能なキーは最小負荷（スコア）順、同点ならラウンドロビンで分散します。
+        クールダウン中/サーキットが開いているキーは、利用可能なキーが1つもない場合のみ
+        復帰が早い順に末尾へ追加されます。
+        """
+        if not clients:
+            return []
+
+        now = time.monotonic()
+        count = len(clients)
+        offset = self._round_robin % count
+        self._round_robin += 1
+
+        available = []
+        unavailable = []
+        for index, client_info in enumerate(clients):
+            key_state = self.state(client_info['name'])
+            rotation = (index - offset) % count
+            if key_state.available_at() <= now:
+                available.append((key_state.score(), rotation, client_info))
+            else:
+                unavailable.append((key_state.available_at(), rotation, client_info))
+
+        available.sort(key=lambda item: (item[0], item[1]))
+        ordered = [item[2] for item in available]
+        if not ordered:
+            unavailable.sort(key=lambda item: (item[0], item[1]))
+            ordered = [item[2] for item in unavailable]
+        return ordered
+
+    def on_start(self, name: Optional[str]):
+        if name is None:
+            return
+        self.state(name).in_flight += 1
+
+    def on_cancel(self, name: Optional[str]):
+        if name is None:
+            return
+        key_state = self.state(name)
+        key_state.in_flight = max(0, key_state.in_flight - 1)
+
+    def on_success(self, name: Optional[str], latency: float):
+        if name is None:
+            return
+        key_state = self.state(name)
+        key_state.in_flight = max(0, key_state.in_flight - 1)
+        key_state.successes += 1
+        key_state.consecutive_failures = 0
+        key_state.consecutive_rate_limits = 0
+        key_state.circuit_open_until = 0.0
+        if key_state.ewma_latency is None:
+            key_state.ewma_latency = latency
+        else:
+            key_state.ewma_latency += GEMINI_LATENCY_EWMA_ALPHA * (latency - key_state.ewma_latency)
+
+    def on_failure(self, name: Optional[str], error: BaseException):
+        if name is None:
+            return
+        now = time.monotonic()
+        key_state = self.state(name)
+        key_state.in_flight = max(0, key_state.in_flight - 1)
+        key_state.failures += 1
+        key_state.consecutive_failures += 1
+        key_state.last_error = f"{type(error).__name__}: {error}"[:200]
+
+        if is_rate_limit_error(error):
+            # 429が連続するほどクールダウンを延長する（指数バックオフ）
+            key_state.rate_limits += 1
+            key_state.consecutive_rate_limits += 1
+            cooldown = min(
+                GEMINI_KEY_COOLDOWN_SECONDS * (2 ** (key_state.consecutive_rate_limits - 1)),
+                GEMINI_KEY_MAX_COOLDOWN_SECONDS
+            )
+            key_state.cooldown_until = now + cooldown
+            print(f"WARNING: {name} キーがレート制限に達しました。{cooldown:.0f}秒間使用を控えます。")
+
+        if key_state.consecutive_failures >= GEMINI_CIRCUIT_FAILURE_THRESHOLD:
+            # 半開状態で再び失敗した場合も、ここで再度サーキットが開く
+            key_state.circuit_open_until = now + GEMINI_CIRCUIT_OPEN_SECONDS
+            print(f"WARNING: {name} キーが{key_state.consecutive_failures}回連続で失敗したため、"
+                  f"{GEMINI_CIRCUIT_OPEN_SECONDS:.0f}秒間サーキットを開きます。")
+
+    def on_probe(self, name: str, status: str, interval: float):
+        """定期確認の結果を反映します。無効なキーは次の確認まで、レート制限中のキーはクールダウンの間除外します。"""
+        now = time.monotonic()
+        key_state = self.state(name)
+        if status == "ok":
+            # 認証が通ったキーは、確認で開いたサーキットだけを閉じる。生成の失敗で開いたサーキットと
+            # 429のクールダウンは維持する（models.get が通っても生成が成功するとは限らない）
+            if key_state.probe_circuit_until and key_state.circuit_open_until == key_state.probe_circuit_until:
+                key_state.circuit_open_until = 0.0
+            key_state.probe_circuit_until = 0.0
+        elif status == "invalid":
+            # 生成の失敗で開いているサーキットのほうが長ければ、そちらを優先する
+            if now + interval > key_state.circuit_open_until:
+                key_state.circuit_open_until = key_state.probe_circuit_until = now + interval
+        elif status == "rate_limited":
+            key_state.cooldown_until = max(key_state.cooldown_until, now + GEMINI_KEY_COOLDOWN_SECONDS)
+
+
+gemini_key_scheduler = GeminiKeyScheduler()
+
+
+# ----------------------------------------------------------------------
+# ★ Gemini APIキーの定期確認
+# gemini_clients のクライアントを使い回し、モデル情報の取得 (models.get) で各キーを定期的に確認する。
+# 生成は行わないため、応答生成のクォータはほとんど消費しない。
+# 結果（有効性・応答時間・最後のエラー）はキャッシュし、/genai とヘルスチェックはこれを表示する。
+# 無効なキーとレート制限中のキーは gemini_key_scheduler に伝え、/ai の試行順から外す。
+# ----------------------------------------------------------------------
+GEMINI_PROBE_INTERVAL_SECONDS = float(os.environ.get("GEMINI_PROBE_INTERVAL_SECONDS", 300))
+GEMINI_PROBE_TIMEOUT_SECONDS = 10
+# /genai refresh:True による確認の最短間隔（秒）。連打でリクエストを浪費しないように
+GEMINI_PROBE_MIN_REFRESH_SECONDS = 30
+
+GEMINI_PROBE_LABELS = {
+    "unknown": "⏳ 未確認",
+    "ok": "✅ 有効",
+    "invalid": "❌ 無効/認証失敗",
+    "rate_limited": "⚠️ レート制限中",
+    "error": "⚠️ 接続エラー",
+}
+
+
+class GeminiKeyProbe:
+    """1つのAPIキーの最新の確認結果。"""
+    __slots__ = ("name", "status", "latency", "last_error", "checked_at", "last_ok_at")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.status = "unknown"
+        self.latency: Optional[float] = None
+        self.last_error: Optional[str] = None
+        # UNIX時刻
+        self.checked_at: Optional[float] = None
+        self.last_ok_at: Optional[float] = None
+
+
+def classify_probe_error(error: BaseException) -> str:
+    if is_rate_limit_error(error):
+        return "rate_limited"
+    if isinstance(error, APIError) and error.code in (400, 401, 403, 404):
+        # キーの無効・権限不足・モデルが見つからない場合は、/ai でも必ず失敗する
+        return "invalid"
+    return "error"
+
+
+class GeminiKeyProber:
+    """APIキーを定期的に確認し、結果をキャッシュします。"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.probes: dict[str, GeminiKeyProbe] = {}
+        self.last_run_at: Optional[float] = None
+        self._running: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None and gemini_clients:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                print(f"ERROR: Gemini APIキーの確認中に予期せぬエラーが発生しました: {e}")
+            await asyncio.sleep(self.interval)
+
+    def probe_for(self, name: str) -> GeminiKeyProbe:
+        probe = self.probes.get(name)
+        if probe is None:
+            probe = self.probes[name] = GeminiKeyProbe(name)
+        return probe
+
+    def can_refresh(self) -> bool:
+        return self.last_run_at is None or time.time() - self.last_run_at >= GEMINI_PROBE_MIN_REFRESH_SECONDS
+
+    async def probe_all(self):
+        """すべてのキーを並行して確認します。確認中に呼ばれた場合は、実行中の確認の完了を待ちます。"""
+        if self._running is None or self._running.done():
+            self._running = asyncio.ensure_future(
+                asyncio.gather(*(self._probe(client_info) for client_info in gemini_clients))
+            )
+        await asyncio.shield(self._running)
+        self.last_run_at = time.time()
+
+    async def _probe(self, client_info: dict):
+        name = client_info['name']
+        probe = self.probe_for(name)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(
+                client_info['client'].aio.models.get(model=GEMINI_MODEL),
+                timeout=GEMINI_PROBE_TIMEOUT_SECONDS
+            )
+        except Exception as e:
+            status = classify_probe_error(e)
+            probe.last_error = f"{type(e).__name__}: {e}"[:200]
+            if probe.status != status:
+                print(f"WARNING: Gemini APIキー {name} の確認に失敗しました ({status}): {probe.last_error}")
+            probe.status = status
+            probe.latency = None
+            gemini_key_scheduler.on_probe(name, status, self.interval)
+        else:
+            if probe.status not in ("ok", "unknown"):
+                print(f"INFO: Gemini APIキー {name} が再び利用可能になりました。")
+            probe.status = "ok"
+            probe.latency = time.monotonic() - started
+            probe.last_ok_at = time.time()
+            gemini_key_scheduler.on_probe(name, "ok", self.interval)
+        probe.checked_at = time.time()
+
+
+gemini_key_prober = GeminiKeyProber(GEMINI_PROBE_INTERVAL_SECONDS)
+
+
+def format_elapsed(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f}秒前"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}分前"
+    return f"{seconds / 3600:.1f}時間前"
+
+
+def build_genai_status_embed() -> discord.Embed:
+    """キャッシュされた確認結果と、キーごとの利用状況から /genai の Embed を作成します。"""
+    now = time.time()
+    monotonic_now = time.monotonic()
+    description = f"現在**{len(gemini_clients)}**個のキーが設定されています。\n\n"
+
+    # API使用状況に関する注釈を追加
+    description += (
+        "**【重要】残りの使用回数（クォータ）について:**\n"
+        "Gemini APIのSDKでは、現在の**残りの使用回数を直接取得することはできません。**\n"
+        "クォータの正確な情報は、Google AI StudioまたはGoogle Cloud Consoleの課金ダッシュボードでご確認ください。\n"
+        f"以下のステータスは、約{GEMINI_PROBE_INTERVAL_SECONDS / 60:.0f}分ごとの定期確認の結果です。\n\n"
+    )
+
+    if AI_CACHE_ENABLED:
+        description += f"**応答キャッシュ:** {ai_response_cache.stats_text()}\n\n"
+
+    valid_key_count = 0
+    for client_info in gemini_clients:
+        name = client_info['name']
+        probe = gemini_key_prober.probe_for(name)
+        key_state = gemini_key_scheduler.state(name)
+        if probe.status == "ok":
+            valid_key_count += 1
+
+        line = f"**{name}**: {GEMINI_PROBE_LABELS[probe.status]}"
+        if probe.latency is not None:
+            line += f" ({probe.latency * 1000:.0f}ms)"
+        if probe.checked_at is not None:
+            line += f" ・ {format_elapsed(now - probe.checked_at)}に確認"
+        line += f"\n　応答: 成功 {key_state.successes} / 失敗 {key_state.failures} / 429 {key_state.rate_limits}"
+        if key_state.ewma_latency is not None:
+            line += f" / 平均 {key_state.ewma_latency:.1f}秒"
+        wait = key_state.available_at() - monotonic_now
+        if wait > 0:
+            line += f"\n　⏸ あと{wait:.0f}秒間は使用を控えています"
+        if probe.status != "ok" and probe.last_error:
+            line += f"\n　最後のエラー: `{probe.last_error[:100]}`"
+        description += line + "\n"
+
+    embed = discord.Embed(
+        title="🤖 Gemini API 接続ステータス",
+        description=description[:4096],
+        color=discord.Color.blue() if valid_key_count > 0 else discord.Color.red()
+    )
+    if gemini_key_prober.last_run_at is not None:
+        embed.set_footer(text=f"最終確認: {format_elapsed(now - gemini_key_prober.last_run_at)}")
+    return embed
+
+
+# --------------------------
+# --- コマンド群: /genai コマンド ---
+# --------------------------
+
+@bot.tree.command(name="genai", description="Gemini APIキーの有効性を確認し、クォータの情報を表示します。")
+@discord.app_commands.describe(refresh="今すぐすべてのキーを確認し直します（30秒に1回まで）。")
+async def genai_status(interaction: discord.Interaction, refresh: bool = False):
+    """Gemini APIキーの有効性、クォータに関する情報を表示します。"""
+    if not gemini_clients:
+        embed = discord.Embed(
+            title="Gemini APIステータス",
+            description="⚠️ Gemini APIキーが設定されていません。環境変数を確認してください。",
+            color=discord.Color.red()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    if refresh:
+        if not gemini_key_prober.can_refresh():
+            await interaction.response.send_message(
+                f"⚠️ 確認は{GEMINI_PROBE_MIN_REFRESH_SECONDS}秒に1回までです。前回の結果を表示します。",
+                embed=build_genai_status_embed(),
+                ephemeral=True
+            )
+            return
+        await interaction.response.defer(ephemeral=True)
+        await gemini_key_prober.probe_all()
+        await interaction.followup.send(embed=build_genai_status_embed(), ephemeral=True)
+        return
+
+    await interaction.response.send_message(embed=build_genai_status_embed(), ephemeral=True)
+
+
+# ----------------------------------------------------------------------
+# ★ ヘッジリクエスト（オプトイン）
+# 最初のキーが p95 レイテンシ以内に応答しない場合、次のキーにも同じリクエストを送り、
+# 先に完了した方を採用して遅い方をキャンセルする。
+# ----------------------------------------------------------------------
+GEMINI_HEDGE_ENABLED = env_flag("GEMINI_HEDGE_ENABLED")
+# ヘッジを発行する遅延の基準となるパーセンタイル
+GEMINI_HEDGE_PERCENTILE = float(os.environ.get("GEMINI_HEDGE_PERCENTILE", 0.95))
+# ヘッジ遅延の下限と、サンプル不足時に使う既定値（秒）
+GEMINI_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get("GEMINI_HEDGE_MIN_DELAY_SECONDS", 0.5))
+GEMINI_HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get("GEMINI_HEDGE_DEFAULT_DELAY_SECONDS", 5.0))
+# 全リクエストに対するヘッジの最大比率（クォータ消費を抑えるため）
+GEMINI_HEDGE_MAX_RATIO = float(os.environ.get("GEMINI_HEDGE_MAX_RATIO", 0.1))
+# 一度に発行できるヘッジの最大数（トークンバケットの容量）
+GEMINI_HEDGE_BURST = float(os.environ.get("GEMINI_HEDGE_BURST", 3))
+# p95算出に使う直近のレイテンシのサンプル数と、算出に必要な最小サンプル数
+GEMINI_HEDGE_SAMPLE_SIZE = 200
+GEMINI_HEDGE_MIN_SAMPLES = 20
+
+
+class GeminiHedgePolicy:
+    """
+    ヘッジ遅延とヘッジの発行可否を管理します。
+    
+    リクエストごとに GEMINI_HEDGE_MAX_RATIO 分のトークンが貯まり、ヘッジ1回で1トークンを
+    消費するため、ヘッジの発行数は全リクエストの一定比率以内に抑えられます。
+    """
+
+    def __init__(self):
+        self.latencies = deque(maxlen=GEMINI_HEDGE_SAMPLE_SIZE)
+        self.tokens = GEMINI_HEDGE_BURST
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record_latency(self, latency: float):
+        self.latencies.append(latency)
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < GEMINI_HEDGE_MIN_SAMPLES:
+            return GEMINI_HEDGE_DEFAULT_DELAY_SECONDS
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * GEMINI_HEDGE_PERCENTILE))
+        return max(GEMINI_HEDGE_MIN_DELAY_SECONDS, ordered[index])
+
+    def on_request(self):
+        self.requests += 1
+        self.tokens = min(GEMINI_HEDGE_BURST, self.tokens + GEMINI_HEDGE_MAX_RATIO)
+
+    def try_acquire(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.hedges += 1
+        return True
+
+
+gemini_hedge_policy = GeminiHedgePolicy()
+
+def build_gemini_request(prompt: str) -> dict:
+    """generate_content / generate_content_stream に渡す引数を作成します。"""
+    # 必須: ユーザーの質問とシステムプロンプトの両方を設定
+    contents = [
+        {"role": "user", "parts": [{"text": prompt}]}
+    ]
+    return {
+        "model": GEMINI_MODEL,
+        "contents": contents,
+        # ★ システムプロンプトを設定
+        "config": {"system_instruction": AI_SYSTEM_PROMPT},
+    }
+
+
+gemini_request_duration = Histogram(
+    "gemini_request_duration_seconds", "Gemini APIの呼び出し時間（キー・結果別）", ("key", "outcome")
+)
+
+
+def gemini_outcome(error: BaseException) -> str:
+    """メトリクスに記録する失敗の種類を返します。"""
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if is_rate_limit_error(error):
+        return "rate_limited"
+    return "error"
+
+
+async def generate_gemini_content(
+    client: genai.Client,
+    prompt: str,
+    key_name: Optional[str] = None,
+    acquired: Optional[asyncio.Event] = None
+) -> str:
+    """
+    Geminiの非同期APIで応答を生成し、テキストを返します。
+    
+    同時実行数は gemini_semaphore で制限され、タイムアウト時は asyncio.TimeoutError を送出します。
+    key_name を指定すると、結果が gemini_key_scheduler に記録されます。
+    acquired を指定すると、gemini_semaphore を獲得してAPIを呼び出す直前にセットされます。
+    """
+    async with gemini_semaphore:
+        if acquired is not None:
+            acquired.set()
+        gemini_key_scheduler.on_start(key_name)
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                client.aio.models.generate_content(**build_gemini_request(prompt)),
+                timeout=GEMINI_REQUEST_TIMEOUT_SECONDS
+            )
+        except asyncio.CancelledError:
+            gemini_key_scheduler.on_cancel(key_name)
+            gemini_request_duration.labels(key_name or "unknown", "cancelled").observe(time.monotonic() - started)
+            raise
+        except Exception as e:
+            gemini_key_scheduler.on_failure(key_name, e)
+            gemini_request_duration.labels(key_name or "unknown", gemini_outcome(e)).observe(time.monotonic() - started)
+            raise
+        latency = time.monotonic() - started
+        gemini_key_scheduler.on_success(key_name, latency)
+        gemini_request_duration.labels(key_name or "unknown", "success").observe(latency)
+        gemini_hedge_policy.record_latency(latency)
+
+    return response.text.strip()
+
+
+async def stream_gemini_content(client: genai.Client, prompt: str, key_name: Optional[str] = None):
+    """
+    Geminiのストリーミング APIで応答を生成し、受信したテキストの断片を順に返す非同期ジェネレーターです。
+    
+    受信は別のタスク（receive_gemini_stream）で行い、断片をキューに積みます。呼び出し側が
+    Discordのメッセージを編集している間も受信は進み、ストリームが終わった時点で
+    gemini_semaphore を解放して呼び出し時間を記録します（Discordへの反映にかかった時間は含めない）。
+    各断片の受信が GEMINI_REQUEST_TIMEOUT_SECONDS を超えた場合は asyncio.TimeoutError を送出します。
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    receiver = asyncio.create_task(receive_gemini_stream(client, prompt, key_name, queue))
+    try:
+        while True:
+            piece = await queue.get()
+            if piece is None:
+                break
+            yield piece
+        # 受信中に発生したエラー（タイムアウト・APIエラー）はここで送出される
+        await receiver
+    finally:
+        if not receiver.done():
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+
+
+async def receive_gemini_stream(client: genai.Client, prompt: str, key_name: Optional[str], queue: asyncio.Queue):
+    """ストリーミング応答を受信して queue に積み、終了時（失敗時も）に None を積みます。"""
+    try:
+        async with gemini_semaphore:
+            gemini_key_scheduler.on_start(key_name)
+            started = time.monotonic()
+            try:
+                stream = await asyncio.wait_for(
+                    client.aio.models.generate_content_stream(**build_gemini_request(prompt)),
+                    timeout=GEMINI_REQUEST_TIMEOUT_SECONDS
+                )
+                iterator = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), timeout=GEMINI_REQUEST_TIMEOUT_SECONDS)
+                    except StopAsyncIteration:
+                        break
+                    if chunk.text:
+                        queue.put_nowait(chunk.text)
+            except asyncio.CancelledError:
+                gemini_key_scheduler.on_cancel(key_name)
+                gemini_request_duration.labels(key_name or "unknown", "cancelled").observe(time.monotonic() - started)
+                raise
+            except Exception as e:
+                gemini_key_scheduler.on_failure(key_name, e)
+                gemini_request_duration.labels(key_name or "unknown", gemini_outcome(e)).observe(time.monotonic() - started)
+                raise
+            latency = time.monotonic() - started
+            gemini_key_scheduler.on_success(key_name, latency)
+            gemini_request_duration.labels(key_name or "unknown", "success").observe(latency)
+    finally:
+        queue.put_nowait(None)
+
+
+async def generate_gemini_content_hedged(
+    client_info: dict,
+    backup_info: Optional[dict],
+    prompt: str,
+    attempted: set
+) -> tuple[str, dict]:
+    """
+    client_info のキーで応答を生成し、(応答テキスト, 実際に応答したクライアント) を返します。
+    
+    ヘッジが有効で backup_info が指定されている場合、ヘッジ遅延を過ぎても応答がなければ
+    backup_info のキーにも同じリクエストを送り、先に成功した方を採用します。
+    ヘッジを発行したキーの名前は attempted に追加されます。両方失敗した場合は
+    最初のキーの例外を送出します。
+    """
+    acquired = asyncio.Event()
+    primary = asyncio.create_task(
+        generate_gemini_content(client_info['client'], prompt, client_info['name'], acquired=acquired)
+    )
+    if not GEMINI_HEDGE_ENABLED or backup_info is None:
+        return await primary, client_info
+
+    owners = {primary: client_info}
+    pending = {primary}
+    try:
+        gemini_hedge_policy.on_request()
+        # ヘッジ遅延（APIの呼び出し時間のp95）は gemini_semaphore の待ち時間を含めずに数える。
+        # 混雑で待たされているだけのリクエストがヘッジを出し、さらに枠を埋めるのを防ぐ
+        waiter = asyncio.create_task(acquired.wait())
+        try:
+            await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        if not primary.done():
+            await asyncio.wait({primary}, timeout=gemini_hedge_policy.hedge_delay())
+        if primary.done() or not gemini_hedge_policy.try_acquire():
+            return await primary, client_info
+
+        print(f"INFO: {client_info['name']} キーの応答が遅いため、{backup_info['name']} キーにヘッジリクエストを送信します。")
+        attempted.add(backup_info['name'])
+        backup = asyncio.create_task(
+            generate_gemini_content(backup_info['client'], prompt, backup_info['name'])
+        )
+        owners[backup] = backup_info
+        pending = {primary, backup}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is backup:
+                        gemini_hedge_policy.hedge_wins += 1
+                    return task.result(), owners[task]
+        # 両方とも失敗した場合は最初のキーのエラーを報告する
+        raise primary.exception()
+    finally:
+        # 負けた（または未完了の）リクエストはキャンセルする
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+# ----------------------------------------------------------------------
+# ★ /ai 応答キャッシュ
+# 正規化したプロンプト + モデル + システムプロンプトのハッシュをキーに、
+# メモリ上のLRU（TTL付き）と任意のSQLite層で応答を保持する。
+# ----------------------------------------------------------------------
+AI_CACHE_ENABLED = env_flag("AI_CACHE_ENABLED", True)
+AI_CACHE_MAX_ENTRIES = int(os.environ.get("AI_CACHE_MAX_ENTRIES", 512))
+AI_CACHE_TTL_SECONDS = float(os.environ.get("AI_CACHE_TTL_SECONDS", 3600))
+# 再起動後もキャッシュを保持するためのSQLite層（既定では無効）
+AI_CACHE_DISK_ENABLED = env_flag("AI_CACHE_DISK_ENABLED")
+AI_CACHE_DISK_MAX_ENTRIES = int(os.environ.get("AI_CACHE_DISK_MAX_ENTRIES", 10000))
+AI_CACHE_DB_PATH = os.path.join(BOT_DATA_DIR, "ai_cache.db")
+# キャッシュから応答した場合に「使用キー」として表示するラベル
+AI_CACHE_LABEL = "キャッシュ"
+
+
+class AIResponseDiskCache(SQLiteStore):
+    """/ai 応答キャッシュのSQLite層。"""
+
+    # この回数の書き込みごとに期限切れ・上限超過の行を削除する
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path: str, max_entries: int):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self._writes = 0
+
+    def setup(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS ai_response_cache ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_expires ON ai_response_cache(expires_at)")
+        self._prune(conn)
+
+    def _prune(self, conn: sqlite3.Connection):
+        conn.execute("DELETE FROM ai_response_cache WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM ai_response_cache WHERE key NOT IN "
+            "(SELECT key FROM ai_response_cache ORDER BY created_at DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def _get(self, conn: sqlite3.Connection, key: str):
+        return conn.execute(
+            "SELECT response, expires_at FROM ai_response_cache WHERE key = ? AND expires_at > ?",
+            (key, time.time())
+        ).fetchone()
+
+    def _put(self, conn: sqlite3.Connection, key: str, response: str, expires_at: float):
+        conn.execute(
+            "INSERT OR REPLACE INTO ai_response_cache (key, response, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            (key, response, time.time(), expires_at)
+        )
+        self._writes += 1
+        if self._writes % self.PRUNE_INTERVAL == 0:
+            self._prune(conn)
+        conn.commit()
+
+    async def get(self, key: str) -> Optional[tuple[str, float]]:
+        return await self.run(self._get, key)
+
+    async def put(self, key: str, response: str, expires_at: float):
+        await self.run(self._put, key, response, expires_at)
+
+
+class AIResponseCache:
+    """/ai 応答のLRUキャッシュ（TTL付き、任意でSQLite層を併用）。"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, disk: Optional[AIResponseDiskCache] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk = disk
+        # {key: (expires_at, response)} 末尾ほど最近使用された
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(prompt: str) -> str:
+        """プロンプトを正規化（NFKC・大文字小文字・空白）し、モデルとシステムプロンプトを含めたキーを作成します。"""
+        normalized = " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+        system_hash = hashlib.sha256(AI_SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{GEMINI_MODEL}\0{system_hash}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, expires_at: float, response: str):
+        self.entries[key] = (expires_at, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+
+        if self.disk is not None:
+            try:
+                row = await self.disk.get(key)
+            except Exception as e:
+                print(f"ERROR: 応答キャッシュ(SQLite)の読み込みに失敗しました: {e}")
+                row = None
+            if row is not None:
+                response, expires_at = row
+                self._remember(key, expires_at, response)
+                self.disk_hits += 1
+                return response
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: str):
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, expires_at, response)
+        if self.disk is not None:
+            try:
+                await self.disk.put(key, response, expires_at)
+            except Exception as e:
+                print(f"ERROR: 応答キャッシュ(SQLite)への書き込みに失敗しました: {e}")
+
+    def stats_text(self) -> str:
+        total = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / total * 100 if total else 0.0
+        return (
+            f"ヒット: {self.hits} (ディスク: {self.disk_hits}) / ミス: {self.misses} "
+            f"(ヒット率 {hit_rate:.1f}%) / メモリ件数: {len(self.entries)}/{self.max_entries}"
+        )
+
+
+ai_response_cache = AIResponseCache(
+    AI_CACHE_MAX_ENTRIES,
+    AI_CACHE_TTL_SECONDS,
+    AIResponseDiskCache(AI_CACHE_DB_PATH, AI_CACHE_DISK_MAX_ENTRIES) if AI_CACHE_DISK_ENABLED else None
+)
+
+
+# ----------------------------------------------------------------------
+# ★ /ai 応答の分割送信とストリーミング表示
+# ----------------------------------------------------------------------
+# 1メッセージあたりの最大文字数（Discordの上限2000文字に余裕を持たせる）
+AI_MESSAGE_CHUNK_SIZE = 1900
+# ストリーミングで応答を段階的に表示する（既定では無効）
+# ストリーミング中はヘッジリクエスト（GEMINI_HEDGE_ENABLED）を使わない。途中まで表示した応答を
+# 別のキーの応答に差し替えられないため、失敗したときだけ次のキーにフォールバックする
+AI_STREAMING_ENABLED = env_flag("AI_STREAMING_ENABLED")
+if AI_STREAMING_ENABLED and GEMINI_HEDGE_ENABLED:
+    print("INFO: AI_STREAMING_ENABLED が有効なため、/ai ではヘッジリクエストを使用しません（GEMINI_HEDGE_ENABLED は無視されます）。")
+# ストリーミング中にメッセージを編集する最小間隔（秒）。Discordの編集レート制限に合わせる
+AI_STREAM_EDIT_INTERVAL_SECONDS = float(os.environ.get("AI_STREAM_EDIT_INTERVAL_SECONDS", 1.2))
+# ストリーミングが途中で失敗した場合に、表示済みの応答へ追記する注記
+AI_STREAM_ABORT_NOTE = "⚠️ *応答が途中で中断されました。*"
+
+CODE_FENCE = "```"
+
+
+def find_message_split_point(text: str, limit: int) -> int:
+    """text[:limit] の中で、段落 > コードブロック境界 > 改行 > 空白 の順にきれいな分割位置を探します。"""
+    window = text[:limit]
+    # あまりに短いチャンクにならないよう、前半には分割しない
+    minimum = limit // 2
+    for separator in ("\n\n", "\n" + CODE_FENCE, "\n", " "):
+        position = window.rfind(separator)
+        if position >= minimum:
+            # 段落/改行/空白は区切り文字の直後、コードブロックはフェンス行の直前で分割する
+            return position + (1 if separator.endswith(CODE_FENCE) else len(separator))
+    return limit
+
+
+def update_code_fence(open_fence: Optional[str], text: str) -> Optional[str]:
+    """text を読み終えた時点で開いているコードブロックのフェンス行（例: "```python"）を返します。"""
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith(CODE_FENCE):
+            open_fence = None if open_fence else stripped
+    return open_fence
+
+
+def split_discord_message(text: str, limit: int = AI_MESSAGE_CHUNK_SIZE) -> list[str]:
+    """
+    長いテキストをDiscordに送信できる長さのチャンクに分割します。
+    
+    コードブロックの途中で分割した場合は、チャンクの末尾でフェンスを閉じ、
+    次のチャンクの先頭で同じ言語指定のフェンスを開き直します。
+    """
+    chunks = []
+    open_fence = None
+    remaining = text
+    while remaining:
+        prefix = open_fence + "\n" if open_fence else ""
+        if len(prefix) + len(remaining) <= limit:
+            chunks.append(prefix + remaining)
+            break
+
+        # 閉じフェンスを追加する余地を残して分割位置を決める
+        budget = limit - len(prefix) - len("\n" + CODE_FENCE)
+        cut = find_message_split_point(remaining, budget)
+        piece = remaining[:cut]
+        remaining = remaining[cut:]
+
+        open_fence = update_code_fence(open_fence, piece)
+        if open_fence:
+            chunks.append(prefix + piece.rstrip("\n") + "\n" + CODE_FENCE)
+        else:
+            chunks.append(prefix + piece.rstrip())
+            remaining = remaining.lstrip("\n")
+    return chunks
+
+
+def build_ai_reply_header(prompt: str, key_name: str) -> str:
+    """/ai 応答メッセージの先頭部分を作成します。"""
+    return f"**質問:** {prompt}\n(キー: {key_name})\n\n**AI応答:**\n"
+
+
+async def send_ai_reply(interaction: discord.Interaction, prompt: str, key_name: str, text: str) -> list:
+    """/ai の応答を必要に応じて分割し、フォローアップメッセージとして送信します。"""
+    messages = []
+    for chunk in split_discord_message(build_ai_reply_header(prompt, key_name) + text):
+        messages.append(await interaction.followup.send(chunk))
+    return messages
+
+
+class StreamingReplyWriter:
+    """
+    ストリーミング中のGemini応答を、編集間隔を守りながらDiscordメッセージへ反映します。
+    
+    1メッセージに収まらなくなった時点で、きれいな区切り位置で次のメッセージに切り替えます。
+    """
+
+    def __init__(self, interaction: discord.Interaction, header: str):
+        self.interaction = interaction
+        self.header = header
+        self.text = ""
+        self.messages = []
+        self._contents = []
+        self._last_flush = 0.0
+
+    async def stream(self, pieces) -> str:
+        """非同期イテレーター pieces のテキストを表示し、完了した応答全体を返します。"""
+        try:
+            async for piece in pieces:
+                self.text += piece
+                if time.monotonic() - self._last_flush >= AI_STREAM_EDIT_INTERVAL_SECONDS:
+                    await self.flush()
+        finally:
+            await pieces.aclose()
+        self.text = self.text.strip()
+        if not self.text:
+            # 空の応答では「…」だけのメッセージを残さない
+            await self.discard()
+            return ""
+        await self.flush()
+        return self.text
+
+    async def flush(self, suffix: str = ""):
+        """現在までのテキストを送信済みメッセージに反映し、あふれた分は新しいメッセージで送信します。"""
+        chunks = split_discord_message(self.header + (self.text or "…") + suffix)
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                if self._contents[index] != chunk:
+                    await self.messages[index].edit(content=chunk)
+                    self._contents[index] = chunk
+            else:
+                self.messages.append(await self.interaction.followup.send(chunk))
+                self._contents.append(chunk)
+        self._last_flush = time.monotonic()
+
+    async def abort(self, note: str):
+        """途中まで表示した応答に中断の注記を追加します。"""
+        if self.messages:
+            try:
+                await self.flush(suffix=f"\n\n{note}")
+            except discord.HTTPException:
+                pass
+
+    async def discard(self):
+        """送信済みのメッセージを削除します。"""
+        messages, self.messages, self._contents = self.messages, [], []
+        for message in messages:
+            try:
+                await message.delete()
+            except discord.HTTPException:
+                pass
+
+
+# ----------------------------------------------------------------------
+# DMログ送信ヘルパー関数
+# ログはキューに積むだけで、送信はバックグラウンドのタスクがまとめて行う。
+# 複数のログを1通のDM（本文 + 最大10個のEmbed）にまとめ、上限に達するか一定時間が経過すると送信する。
+# キューが一杯になったら優先度の低いログから破棄し、破棄した件数は次のDMで報告する。
+# ----------------------------------------------------------------------
+LOG_PRIORITY_LOW = 0     # 定常的な記録（/ai の試行・成功など）
+LOG_PRIORITY_NORMAL = 1  # モデレーション操作・エラー
+LOG_PRIORITY_HIGH = 2    # 起動通知・レイド検知など、必ず届けたいもの
+
+# 最初のログを受け取ってから送信するまでの最大待ち時間（秒）
+DM_LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get("DM_LOG_FLUSH_INTERVAL_SECONDS", 2.0))
+# 送信待ちのログを保持する最大数
+DM_LOG_QUEUE_SIZE = int(os.environ.get("DM_LOG_QUEUE_SIZE", 500))
+# Discordのメッセージの上限（本文の文字数、Embedの数、Embedの合計文字数）
+DISCORD_MESSAGE_MAX_LENGTH = 2000
+DISCORD_MAX_EMBEDS_PER_MESSAGE = 10
+DISCORD_MAX_EMBED_TOTAL_LENGTH = 6000
+DISCORD_MAX_FILES_PER_MESSAGE = 10
+
+
+class AdminLogEntry(NamedTuple):
+    """送信待ちのDMログ1件。"""
+    content: str
+    embed: Optional[discord.Embed]
+    priority: int
+    file: Optional[discord.File] = None
+
+
+class AdminLogDispatcher:
+    """
+    管理者向けのDMログをキューに溜め、バックグラウンドのタスクでまとめて送信します。
+    
+    submit() は待機せずに戻るため、on_message などの処理がログの送信を待つことはありません。
+    送信先のDMチャンネルは初回に取得したものを使い回します。
+    """
+    label = "DMログ"
+
+    def __init__(self, target_id: int, max_queue: int, flush_interval: float):
+        # 送信先のID（このクラスではユーザーID、サブクラスではチャンネルID）
+        self.target_id = target_id
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self._queue: deque[AdminLogEntry] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._channel: Optional[discord.abc.Messageable] = None
+        self.sent_messages = 0
+        self.sent_entries = 0
+        self.dropped = 0
+        # 前回の送信以降に破棄した件数（次のDMで報告する）
+        self._dropped_since_report = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def submit(self, content: str, embed: Optional[discord.Embed] = None, priority: int = LOG_PRIORITY_NORMAL,
+               file: Optional[discord.File] = None):
+        """ログを送信キューに追加します。"""
+        if not self.target_id:
+            return
+        if len(self._queue) >= self.max_queue and not self._make_room(priority):
+            self._record_drop()
+            return
+        self._queue.append(AdminLogEntry(content, embed, priority, file))
+        self._wakeup.set()
+        self._ensure_running()
+
+    def _record_drop(self):
+        self.dropped += 1
+        self._dropped_since_report += 1
+
+    def _make_room(self, priority: int) -> bool:
+        """優先度が priority 以下のログのうち、最も優先度が低く古いものを1件破棄します。"""
+        lowest = min(entry.priority for entry in self._queue)
+        if lowest > priority:
+            return False
+        for index, entry in enumerate(self._queue):
+            if entry.priority == lowest:
+                del self._queue[index]
+                self._record_drop()
+                return True
+        return False
+
+    def _ensure_running(self):
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        except RuntimeError:
+            # イベントループの開始前に呼ばれた場合は、次回の submit() で開始する
+            pass
+
+    def _plan_batch(self) -> tuple[int, bool]:
+        """キューの先頭から1通にまとめられる件数と、その1通が上限に達しているかを返します。"""
+        content_length = 0
+        embed_count = 0
+        embed_length = 0
+        file_count = 0
+        count = 0
+        for entry in self._queue:
+            entry_embeds = 1 if entry.embed is not None else 0
+            entry_embed_length = len(entry.embed) if entry.embed is not None else 0
+            entry_files = 1 if entry.file is not None else 0
+            if count and (
+                content_length + len(entry.content) + 1 > DISCORD_MESSAGE_MAX_LENGTH
+                or embed_count + entry_embeds > DISCORD_MAX_EMBEDS_PER_MESSAGE
+                or embed_length + entry_embed_length > DISCORD_MAX_EMBED_TOTAL_LENGTH
+                or file_count + entry_files > DISCORD_MAX_FILES_PER_MESSAGE
+            ):
+                return count, True
+            content_length += len(entry.content) + 1
+            embed_count += entry_embeds
+            embed_length += entry_embed_length
+            file_count += entry_files
+            count += 1
+        return count, embed_count >= DISCORD_MAX_EMBEDS_PER_MESSAGE or file_count >= DISCORD_MAX_FILES_PER_MESSAGE
+
+    def _take_batch(self) -> list[AdminLogEntry]:
+        count, _ = self._plan_batch()
+        return [self._queue.popleft() for _ in range(count)]
+
+    async def _get_channel(self) -> discord.abc.Messageable:
+        if self._channel is None:
+            # Botのキャッシュになければフェッチする（初回のみ）
+            user = bot.get_user(self.target_id) or await bot.fetch_user(self.target_id)
+            self._channel = user.dm_channel or await user.create_dm()
+        return self._channel
+
+    def _report_not_found(self):
+        print(f"ERROR: ユーザーID {self.target_id} が見つかりませんでした。DMログを送信できません。")
+
+    async def _send(self, batch: list[AdminLogEntry]):
+        lines = [entry.content for entry in batch if entry.content]
+        if self._dropped_since_report:
+            lines.insert(0, f"⚠️ ログが多すぎるため {self._dropped_since_report} 件を省略しました。")
+            self._dropped_since_report = 0
+        content = "\n".join(lines)
+        if len(content) > DISCORD_MESSAGE_MAX_LENGTH:
+            content = content[:DISCORD_MESSAGE_MAX_LENGTH - 3] + "..."
+        embeds = [entry.embed for entry in batch if entry.embed is not None]
+        files = [entry.file for entry in batch if entry.file is not None]
+        channel = await self._get_channel()
+        await channel.send(content=content or None, embeds=embeds, files=files)
+        self.sent_messages += 1
+        self.sent_entries += len(batch)
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # 最初のログから一定時間待ち、その間に届いたログを1通にまとめる（上限に達したらすぐに送信）
+            deadline = loop.time() + self.flush_interval
+            while not self._plan_batch()[1]:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            batch = self._take_batch()
+            try:
+                await self._send(batch)
+            except discord.NotFound:
+                self._report_not_found()
+            except Exception as e:
+                print(f"ERROR: {self.label}の送信中に予期せぬエラーが発生しました ({len(batch)}件): {e}")
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "sent_messages": self.sent_messages,
+            "sent_entries": self.sent_entries,
+            "dropped": self.dropped,
+        }
+
+
+admin_log_dispatcher = AdminLogDispatcher(TARGET_USER_ID_FOR_LOGS, DM_LOG_QUEUE_SIZE, DM_LOG_FLUSH_INTERVAL_SECONDS)
+
+
+def send_dm_log(message: str, embed: Optional[discord.Embed] = None, priority: int = LOG_PRIORITY_NORMAL):
+    """指定されたユーザーへのDMログを送信キューに追加します（送信の完了は待ちません）。"""
+    admin_log_dispatcher.submit(message, embed, priority)
+
+
+# ----------------------------------------------------------------------
+# ★ 監査ログ (SQLite)
+# BAN・禁止ワードによる削除・スパムの一括削除などのモデレーション履歴を、追記専用のテーブルに保存する。
+# record() はメモリ上のバッファに追加するだけで、書き込みはバックグラウンドのタスクがまとめて行う。
+# ----------------------------------------------------------------------
+AUDIT_LOG_ENABLED = env_flag("AUDIT_LOG_ENABLED", True)
+AUDIT_LOG_DB_PATH = os.path.join(BOT_DATA_DIR, "audit_log.db")
+# バッファの内容を書き込む間隔（秒）と、すぐに書き込む件数
+AUDIT_LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get("AUDIT_LOG_FLUSH_INTERVAL_SECONDS", 1.0))
+AUDIT_LOG_BATCH_SIZE = 500
+# 書き込み待ちの最大件数（ディスクが詰まった場合にメモリを使い切らないように）
+AUDIT_LOG_MAX_PENDING = 20000
+# /audit の1ページあたりの件数
+AUDIT_PAGE_SIZE = 10
+
+# 記録する操作の種類と表示名
+AUDIT_ACTIONS = {
+    "timeban": "一時BAN",
+    "unban": "BAN解除",
+    "raid_ban": "レイドBAN",
+    "raid_start": "レイド検知",
+    "raid_end": "レイド解除",
+    "spam_purge": "レート超過削除",
+    "banned_word": "禁止ワード削除",
+    "near_duplicate": "類似投稿削除",
+    "purge": "一括削除",
+    "message_delete": "メッセージ削除",
+    "message_edit": "メッセージ編集",
+    "message_bulk_delete": "メッセージ一括削除",
+    "nickname_set": "ニックネーム設定",
+    "nickname_reset": "ニックネームリセット",
+    "blockword_add": "禁止ワード追加",
+    "blockword_remove": "禁止ワード削除",
+    "blockword_import": "禁止ワード一括登録",
+    "ratelimit_set": "レート制限設定",
+    "ratelimit_clear": "レート制限解除",
+}
+
+
+class AuditLogEntry(NamedTuple):
+    """監査ログの1件。"""
+    id: int
+    created_at: float
+    guild_id: int
+    action: str
+    user_id: Optional[int]
+    actor_id: Optional[int]
+    channel_id: Optional[int]
+    detail: dict
+
+
+class AuditLogStore(SQLiteStore):
+    """監査ログのSQLite層。行の更新・削除は行わず、追記のみを行います。"""
+
+    def setup(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS audit_log ("
+            "id INTEGER PRIMARY KEY, created_at REAL NOT NULL, guild_id INTEGER NOT NULL, "
+            "action TEXT NOT NULL, user_id INTEGER, actor_id INTEGER, channel_id INTEGER, detail TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_guild_time ON audit_log(guild_id, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_guild_user_time ON audit_log(guild_id, user_id, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_guild_action_time ON audit_log(guild_id, action, created_at)")
+
+    def _insert(self, conn: sqlite3.Connection, rows: list[tuple]):
+        conn.executemany(
+            "INSERT INTO audit_log (created_at, guild_id, action, user_id, actor_id, channel_id, detail) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.commit()
+
+    def _query(
+        self, conn: sqlite3.Connection, guild_id: int, user_id: Optional[int], action: Optional[str],
+        before: Optional[tuple[float, int]], limit: int
+    ) -> list[tuple]:
+        sql = "SELECT id, created_at, guild_id, action, user_id, actor_id, channel_id, detail FROM audit_log"
+        if user_id is not None:
+            # 1ユーザー分の記録は操作の種類ごとの記録より常に少ないため、ユーザーの索引を使わせる
+            sql += " INDEXED BY idx_audit_guild_user_time"
+        sql += " WHERE guild_id = ?"
+        params: list = [guild_id]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        if action is not None:
+            sql += " AND action = ?"
+            params.append(action)
+        if before is not None:
+            # キーセット方式のページング（OFFSET を使わないため、深いページでも速度が落ちない）
+            sql += " AND (created_at, id) < (?, ?)"
+            params.extend(before)
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        return conn.execute(sql, params).fetchall()
+
+    async def insert(self, rows: list[tuple]):
+        await self.run(self._insert, rows)
+
+    async def query(self, guild_id: int, user_id: Optional[int] = None, action: Optional[str] = None,
+                    before: Optional[tuple[float, int]] = None, limit: int = AUDIT_PAGE_SIZE) -> list[tuple]:
+        return await self.run(self._query, guild_id, user_id, action, before, limit)
+
+
+class AuditLog:
+    """
+    監査ログの記録と検索を行います。
+    
+    record() は待機せずに戻り、記録はバッファに溜めて一定間隔または一定件数ごとにまとめて書き込みます。
+    検索の前にはバッファを書き込むため、直前の操作も検索結果に含まれます。
+    """
+
+    def __init__(self, store: AuditLogStore, flush_interval: float, batch_size: int, max_pending: int):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending: list[tuple] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+
+    def record(
+        self, guild_id: int, action: str, user_id: Optional[int] = None, actor_id: Optional[int] = None,
+        channel_id: Optional[int] = None, **detail
+    ):
+        """操作を記録します。detail には JSON に変換できる値を指定してください。"""
+        if not AUDIT_LOG_ENABLED:
+            return
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append((
+            time.time(), guild_id, action, user_id, actor_id, channel_id,
+            json.dumps(detail, ensure_ascii=False) if detail else None
+        ))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        except RuntimeError:
+            # イベントループの開始前に呼ばれた場合は、次回の record() で開始する
+            pass
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """バッファの内容を書き込みます。"""
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await self.store.insert(rows)
+            self.written += len(rows)
+        except Exception as e:
+            self.dropped += len(rows)
+            print(f"ERROR: 監査ログの書き込みに失敗しました ({len(rows)}件): {e}")
+
+    async def query(
+        self, guild_id: int, user_id: Optional[int] = None, action: Optional[str] = None,
+        before: Optional[tuple[float, int]] = None, limit: int = AUDIT_PAGE_SIZE
+    ) -> list[AuditLogEntry]:
+        """新しい順に記録を返します。before に前のページの最後の (created_at, id) を指定すると続きを返します。"""
+        await self.flush()
+        rows = await self.store.query(guild_id, user_id, action, before, limit)
+        return [AuditLogEntry(*row[:7], json.loads(row[7]) if row[7] else {}) for row in rows]
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "written": self.written, "dropped": self.dropped}
+
+
+audit_log = AuditLog(
+    AuditLogStore(AUDIT_LOG_DB_PATH),
+    AUDIT_LOG_FLUSH_INTERVAL_SECONDS,
+    AUDIT_LOG_BATCH_SIZE,
+    AUDIT_LOG_MAX_PENDING
+)
+
+
+# ----------------------------------------------------------------------
+# ★ 一時BANの自動解除スケジューラー
+# 一時BANはSQLiteに保存し、再起動後も自動解除の予定を引き継ぐ（停止中に期限が来たものは起動時に解除する）。
+# 解除予定はヒープで管理し、1つのタスクが最も早い予定の時刻まで待機して順に解除する。
+# 取り消し・再設定の際はヒープから削除せず、取り出したときに最新の予定と照合して読み飛ばす。
+# ----------------------------------------------------------------------
+TIME_BAN_DB_PATH = os.path.join(BOT_DATA_DIR, "time_bans.db")
+# 一時的なエラーで解除できなかった場合に再試行するまでの時間（秒）。続けて失敗するたびに倍にする
+TIME_BAN_RETRY_SECONDS = 300
+TIME_BAN_MAX_RETRY_SECONDS = 6 * 3600
+# Discord APIのエラーコード「Missing Access」（Botがサーバーに参加していない）
+DISCORD_ERROR_MISSING_ACCESS = 50001
+# 時計のずれに備え、長い待機でもこの間隔（秒）で予定を確認し直す
+TIME_BAN_MAX_SLEEP_SECONDS = 3600
+
+
+class TimeBan(NamedTuple):
+    """一時BANの1件。時刻はUNIX時刻（秒）です。"""
+    guild_id: int
+    user_id: int
+    unban_at: float
+    banned_at: float
+    actor_id: Optional[int]
+
+
+class TimeBanStore(SQLiteStore):
+    """一時BANのSQLite層。"""
+
+    def setup(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS time_bans ("
+            "guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, unban_at REAL NOT NULL, "
+            "banned_at REAL NOT NULL, actor_id INTEGER, PRIMARY KEY (guild_id, user_id))"
+        )
+
+    def _load(self, conn: sqlite3.Connection) -> list[TimeBan]:
+        rows = conn.execute("SELECT guild_id, user_id, unban_at, banned_at, actor_id FROM time_bans").fetchall()
+        return [TimeBan(*row) for row in rows]
+
+    def _save(self, conn: sqlite3.Connection, ban: TimeBan):
+        conn.execute(
+            "INSERT OR REPLACE INTO time_bans (guild_id, user_id, unban_at, banned_at, actor_id) VALUES (?, ?, ?, ?, ?)",
+            ban
+        )
+        conn.commit()
+
+    def _delete(self, conn: sqlite3.Connection, guild_id: int, user_id: int):
+        conn.execute("DELETE FROM time_bans WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        conn.commit()
+
+    async def load(self) -> list[TimeBan]:
+        return await self.run(self._load)
+
+    async def save(self, ban: TimeBan):
+        await self.run(self._save, ban)
+
+    async def delete(self, guild_id: int, user_id: int):
+        await self.run(self._delete, guild_id, user_id)
+
+
+class TimeBanScheduler:
+    """
+    一時BANの自動解除を、ヒープと1つの待機タスクで管理します。
+    
+    schedule() で予定を追加・上書きし、cancel() で取り消します。いずれもSQLiteに即座に保存されます。
+    """
+
+    def __init__(self, store: TimeBanStore):
+        self.store = store
+        # {(guild_id, user_id): 最新の予定}
+        self._bans: dict[tuple[int, int], TimeBan] = {}
+        # (unban_at, guild_id, user_id) のヒープ。古くなった要素も含む
+        self._heap: list[tuple[float, int, int]] = []
+        self._wakeup = asyncio.Event()
+        # {(guild_id, user_id): 連続して解除に失敗した回数}
+        self._failures: dict[tuple[int, int], int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._bans)
+
+    def get(self, guild_id: int, user_id: int) -> Optional[TimeBan]:
+        return self._bans.get((guild_id, user_id))
+
+    def pending(self, guild_id: Optional[int] = None) -> list[TimeBan]:
+        """解除予定を早い順に返します。"""
+        bans = [ban for ban in self._bans.values() if guild_id is None or ban.guild_id == guild_id]
+        return sorted(bans, key=lambda ban: ban.unban_at)
+
+    async def load(self):
+        """保存済みの予定を読み込みます（初回のみ）。"""
+        async with self._load_lock:
+            if self._loaded:
+                return
+            # 他のワーカーが担当するサーバーの予定には触れない（解除できずに削除してしまうため）
+            bans = [ban for ban in await self.store.load() if owns_guild(ban.guild_id)]
+            for ban in bans:
+                # 読み込み前に schedule() された予定のほうが新しい
+                if (ban.guild_id, ban.user_id) not in self._bans:
+                    self._push(ban)
+            self._loaded = True
+            overdue = sum(1 for ban in bans if ban.unban_at <= time.time())
+            print(f"INFO: 一時BANの解除予定を {len(bans)} 件読み込みました（期限切れ: {overdue} 件）。")
+
+    def start(self):
+        """解除タスクを開始します（実行中なら何もしない）。"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            self._task.add_done_callback(self._on_task_done)
+
+    @staticmethod
+    def _on_task_done(task: asyncio.Task):
+        # 解除タスクが止まると次の on_ready まで一件も解除されないため、必ずログに残す
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            print(f"ERROR: 一時BANの解除タスクが異常終了しました: {exc!r}")
+
+    def _push(self, ban: TimeBan):
+        self._bans[(ban.guild_id, ban.user_id)] = ban
+        # 取り消し・再設定で古くなった要素が増えすぎたらヒープを作り直す
+        if len(self._heap) > 2 * len(self._bans) + 64:
+            self._heap = [(item.unban_at, item.guild_id, item.user_id) for item in self._bans.values()]
+            heapq.heapify(self._heap)
+        else:
+            heapq.heappush(self._heap, (ban.unban_at, ban.guild_id, ban.user_id))
+        self._wakeup.set()
+
+    async def schedule(self, guild_id: int, user_id: int, unban_at: datetime, actor_id: Optional[int] = None) -> Optional[TimeBan]:
+        """解除予定を追加します。既に予定がある場合は上書きし、以前の予定を返します。"""
+        await self.load()
+        previous = self._bans.get((guild_id, user_id))
+        ban = TimeBan(
+            guild_id, user_id, unban_at.timestamp(),
+            previous.banned_at if previous else time.time(),
+            actor_id
+        )
+        await self.store.save(ban)
+        self._failures.pop((guild_id, user_id), None)
+        self._push(ban)
+        return previous
+
+    async def cancel(self, guild_id: int, user_id: int) -> Optional[TimeBan]:
+        """解除予定を取り消し、取り消した予定を返します。"""
+        await self.load()
+        ban = self._bans.pop((guild_id, user_id), None)
+        self._failures.pop((guild_id, user_id), None)
+        if ban is not None:
+            await self.store.delete(guild_id, user_id)
+            self._wakeup.set()
+        return ban
+
+    def _is_stale(self, item: tuple[float, int, int]) -> bool:
+        ban = self._bans.get((item[1], item[2]))
+        return ban is None or ban.unban_at != item[0]
+
+    async def _run(self):
+        await self.load()
+        while True:
+            while self._heap and self._is_stale(self._heap[0]):
+                heapq.heappop(self._heap)
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                # 予定の追加・取り消しがあれば起きて、先頭の予定を確認し直す
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, TIME_BAN_MAX_SLEEP_SECONDS))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, guild_id, user_id = heapq.heappop(self._heap)
+            # 解除中に on_member_unban で取り消されないよう、先に予定から外す
+            ban = self._bans.pop((guild_id, user_id))
+            try:
+                done = await unban_expired_time_ban(ban)
+            except Exception as e:
+                # 原因が分からない失敗でも予定は消さず、再試行する
+                print(f"ERROR: 自動BAN解除中に予期せぬエラーが発生しました: {e}")
+                done = False
+            if done:
+                self._failures.pop((guild_id, user_id), None)
+                if (guild_id, user_id) not in self._bans:
+                    try:
+                        await self.store.delete(guild_id, user_id)
+                    except Exception as e:
+                        # 解除は済んでいるが、保存先に残ると再起動後に読み込まれるため後でやり直す
+                        print(f"ERROR: User ID {user_id} の一時BAN予定の削除に失敗しました: {e}")
+                        self._push(ban._replace(unban_at=time.time() + TIME_BAN_RETRY_SECONDS))
+            elif (guild_id, user_id) not in self._bans:
+                failures = self._failures[(guild_id, user_id)] = self._failures.get((guild_id, user_id), 0) + 1
+                delay = min(TIME_BAN_RETRY_SECONDS * 2 ** (failures - 1), TIME_BAN_MAX_RETRY_SECONDS)
+                print(f"WARNING: User ID {user_id} の自動BAN解除を{delay}秒後に再試行します（{failures}回目の失敗）。")
+                retry = ban._replace(unban_at=time.time() + delay)
+                try:
+                    await self.store.save(retry)
+                except Exception as e:
+                    # 保存できなくてもメモリ上の予定は残し、解除タスクは止めない
+                    print(f"ERROR: User ID {user_id} の再試行予定の保存に失敗しました: {e}")
+                self._push(retry)
+
+
+time_ban_scheduler = TimeBanScheduler(TimeBanStore(TIME_BAN_DB_PATH))
+
+
+async def unban_expired_time_ban(ban: TimeBan) -> bool:
+    """
+    期限が来た一時BANを解除します。
+    
+    完了した（または再試行しても意味がない）場合は True、一時的なエラーで再試行すべき場合は False を返します。
+    """
+    guild_id = ban.guild_id
+    user_id = ban.user_id
+    duration_seconds = ban.unban_at - ban.banned_at
+
+    # サーバーがキャッシュにない（障害中・シャードの準備中・再接続中）場合も、APIで直接解除を試みる
+    guild = bot.get_guild(guild_id)
+    guild_name = guild.name if guild else f"ID {guild_id}"
+
+    try:
+        if guild is not None:
+            await guild.unban(discord.Object(id=user_id), reason="自動タイムBAN解除")
+        else:
+            await bot.http.unban(user_id, guild_id, reason="自動タイムBAN解除")
+    except discord.NotFound:
+        # ユーザーがBANリストにいない、またはサーバーが削除されている場合は何もしない
+        print(f"INFO: User ID {user_id} は既にBANリストにいませんでした（サーバー: {guild_name}）。自動BAN解除処理をスキップ。")
+        return True
+    except discord.Forbidden as e:
+        if guild is None and e.code == DISCORD_ERROR_MISSING_ACCESS:
+            # Botがサーバーから退出している。再試行しても解除できない
+            print(f"ERROR: Botが Guild ID {guild_id} に参加していないため、User ID {user_id} の自動BAN解除を中止しました。")
+            return True
         print(f"ERROR: 権限不足により User ID {user_id} の自動BAN解除に失敗しました。Botの「メンバーをBAN」権限を確認してください。")
-    except Exception as e:
-        print(f"FATAL ERROR: 自動BAN解除中に予期せぬエラーが発生しました: {e}")
+        return False
+    except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"WARNING: User ID {user_id} の自動BAN解除に失敗しました（サーバー: {guild_name}）: {e}")
+        return False
+
+    # ログと通知
+    print(f"SUCCESS: User ID {user_id} のBANが {guild_name} で自動解除されました。")
+
+    # DMログ通知
+    embed = discord.Embed(
+        title="✅ 自動タイムBAN解除ログ",
+        description=f"ユーザーID `{user_id}` のBANがサーバー `{guild_name}` で自動解除されました。",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="解除されたユーザー", value=f"<@{user_id}>", inline=False)
+    embed.add_field(name="BAN期間", value=f"{duration_seconds / 3600:.2f} 時間", inline=False)
+    embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
+
+    send_dm_log(f"**🟢 自動BAN解除:** User ID `{user_id}` のBANが自動解除されました。", embed=embed)
+    audit_log.record(guild_id, "unban", user_id=user_id, hours=round(duration_seconds / 3600, 2))
+    return True
+
+from discord import app_commands
+
+# ----------------------------------------------------------------------
+# ★ 監視設定（サーバーごと）
+# 監視対象チャンネルとログ送信先をサーバーごとにSQLiteへ保存し、起動時に一度だけ読み込む。
+# イベント処理ではメモリ上の辞書だけを参照し、変更時のみ書き込む。
+# ----------------------------------------------------------------------
+MONITORING_DB_PATH = os.path.join(BOT_DATA_DIR, "monitoring.db")
+
+
+class GuildMonitoringConfig:
+    """1つのサーバーの監視設定。"""
+    __slots__ = ("channels", "log_channel_id")
+
+    def __init__(self):
+        self.channels: set[int] = set()
+        self.log_channel_id: Optional[int] = None
+
+
+class MonitoringConfigStore(SQLiteStore):
+    """監視設定のSQLite層。"""
+
+    def setup(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS monitoring_channels ("
+            "guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, PRIMARY KEY (guild_id, channel_id))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS monitoring_log_targets ("
+            "guild_id INTEGER PRIMARY KEY, log_channel_id INTEGER NOT NULL)"
+        )
+
+    def _load(self, conn: sqlite3.Connection) -> tuple[list, list]:
+        channels = conn.execute("SELECT guild_id, channel_id FROM monitoring_channels").fetchall()
+        targets = conn.execute("SELECT guild_id, log_channel_id FROM monitoring_log_targets").fetchall()
+        return channels, targets
+
+    def _add_channel(self, conn: sqlite3.Connection, guild_id: int, channel_id: int):
+        conn.execute("INSERT OR IGNORE INTO monitoring_channels (guild_id, channel_id) VALUES (?, ?)", (guild_id, channel_id))
+        conn.commit()
+
+    def _remove_channel(self, conn: sqlite3.Connection, guild_id: int, channel_id: int):
+        conn.execute("DELETE FROM monitoring_channels WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id))
+        conn.commit()
+
+    def _set_log_channel(self, conn: sqlite3.Connection, guild_id: int, log_channel_id: int):
+        conn.execute(
+            "INSERT OR REPLACE INTO monitoring_log_targets (guild_id, log_channel_id) VALUES (?, ?)",
+            (guild_id, log_channel_id)
+        )
+        conn.commit()
+
+    async def load(self) -> tuple[list, list]:
+        return await self.run(self._load)
+
+    async def add_channel(self, guild_id: int, channel_id: int):
+        await self.run(self._add_channel, guild_id, channel_id)
+
+    async def remove_channel(self, guild_id: int, channel_id: int):
+        await self.run(self._remove_channel, guild_id, channel_id)
+
+    async def set_log_channel(self, guild_id: int, log_channel_id: int):
+        await self.run(self._set_log_channel, guild_id, log_channel_id)
+
+
+class MonitoringConfig:
+    """
+    サーバーごとの監視設定をメモリ上に保持します。
+    
+    is_monitored() と log_channel_for() は辞書の参照のみで、I/Oを行いません。
+    変更はSQLiteに即座に保存されます。
+    """
+
+    def __init__(self, store: MonitoringConfigStore):
+        self.store = store
+        self._guilds: dict[int, GuildMonitoringConfig] = {}
+        # 監視対象チャンネルID → サーバーID（イベントごとの判定用）
+        self._channel_guilds: dict[int, int] = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """保存済みの設定を読み込みます（初回のみ）。"""
+        async with self._load_lock:
+            if self._loaded:
+                return
+            channels, targets = await self.store.load()
+            channels = [(guild_id, channel_id) for guild_id, channel_id in channels if owns_guild(guild_id)]
+            targets = [(guild_id, log_channel_id) for guild_id, log_channel_id in targets if owns_guild(guild_id)]
+            for guild_id, channel_id in channels:
+                self._guilds.setdefault(guild_id, GuildMonitoringConfig()).channels.add(channel_id)
+                self._channel_guilds[channel_id] = guild_id
+            for guild_id, log_channel_id in targets:
+                # 読み込み前に設定された送信先のほうが新しい
+                config = self._guilds.setdefault(guild_id, GuildMonitoringConfig())
+                if config.log_channel_id is None:
+                    config.log_channel_id = log_channel_id
+            self._loaded = True
+            print(f"INFO: 監視設定を読み込みました（サーバー: {len(self._guilds)} 件、監視チャンネル: {len(channels)} 件）。")
+
+    def is_monitored(self, channel_id: int) -> bool:
+        return channel_id in self._channel_guilds
+
+    def log_channel_for(self, guild_id: int) -> Optional[int]:
+        config = self._guilds.get(guild_id)
+        return config.log_channel_id if config is not None else None
+
+    def guild(self, guild_id: int) -> Optional[GuildMonitoringConfig]:
+        return self._guilds.get(guild_id)
+
+    async def add_channel(self, guild_id: int, channel_id: int) -> bool:
+        """監視対象に追加します。既に追加済みなら False を返します。"""
+        await self.load()
+        config = self._guilds.setdefault(guild_id, GuildMonitoringConfig())
+        if channel_id in config.channels:
+            return False
+        await self.store.add_channel(guild_id, channel_id)
+        config.channels.add(channel_id)
+        self._channel_guilds[channel_id] = guild_id
+        return True
+
+    async def remove_channel(self, guild_id: int, channel_id: int) -> bool:
+        """監視対象から外します。監視対象でなければ False を返します。"""
+        await self.load()
+        config = self._guilds.get(guild_id)
+        if config is None or channel_id not in config.channels:
+            return False
+        await self.store.remove_channel(guild_id, channel_id)
+        config.channels.discard(channel_id)
+        self._channel_guilds.pop(channel_id, None)
+        return True
+
+    async def set_log_channel(self, guild_id: int, log_channel_id: int):
+        await self.load()
+        await self.store.set_log_channel(guild_id, log_channel_id)
+        self._guilds.setdefault(guild_id, GuildMonitoringConfig()).log_channel_id = log_channel_id
+
+
+monitoring_config = MonitoringConfig(MonitoringConfigStore(MONITORING_DB_PATH))
+
+
+# ----------------------------------------------------------------------
+# ★ 監視チャンネルのメッセージ記録
+# discord.py のメッセージキャッシュ (max_messages) は全チャンネル共通で古いものから押し出されるため、
+# 少し前の投稿が削除・編集されると内容をログに残せない。監視対象チャンネルの投稿だけを
+# 小さなレコードとして保持し、raw イベントのログ出力で参照する。
+# 使用量はおおよそのバイト数で管理し、上限を超えたら最も長く参照されていないものから捨てる。
+# ----------------------------------------------------------------------
+MESSAGE_SNAPSHOT_BUDGET_BYTES = int(os.environ.get("MESSAGE_SNAPSHOT_BUDGET_BYTES", 16 * 1024 * 1024))
+# OrderedDict の1項目あたりのおおよその使用量（キーと連結リストのノード）
+MESSAGE_SNAPSHOT_ENTRY_OVERHEAD = 120
+
+
+class MessageSnapshot:
+    """削除・編集ログのために保持するメッセージの内容。"""
+    __slots__ = ("message_id", "guild_id", "channel_id", "author_id", "author_name", "content", "attachments", "size")
+
+    def __init__(self, message_id: int, guild_id: Optional[int], channel_id: int, author_id: int,
+                 author_name: str, content: str, attachments: tuple):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        # 添付ファイルは名前のみ保持する（削除後はURLが無効になるため）
+        self.attachments = attachments
+        self.size = (
+            sys.getsizeof(self) + sys.getsizeof(content) + sys.getsizeof(author_name)
+            + sys.getsizeof(attachments) + sum(sys.getsizeof(name) for name in attachments)
+            + MESSAGE_SNAPSHOT_ENTRY_OVERHEAD
+        )
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "MessageSnapshot":
+        return cls(
+            message.id, message.guild.id if message.guild else None, message.channel.id,
+            message.author.id, str(message.author), message.content,
+            tuple(attachment.filename for attachment in message.attachments),
+        )
+
+    @property
+    def created_at(self) -> datetime:
+        return discord.utils.snowflake_time(self.message_id)
+
+
+class MessageSnapshotCache:
+    """メッセージID → MessageSnapshot の LRU キャッシュ。合計サイズを budget_bytes 以内に保ちます。"""
+
+    def __init__(self, budget_bytes: int = MESSAGE_SNAPSHOT_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self._snapshots: OrderedDict[int, MessageSnapshot] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.total_evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def put(self, snapshot: MessageSnapshot):
+        """スナップショットを登録（同じIDがあれば置き換え）し、上限を超えた分を古いものから捨てます。"""
+        self._remove(snapshot.message_id)
+        if snapshot.size > self.budget_bytes:
+            return
+        self._snapshots[snapshot.message_id] = snapshot
+        self._bytes += snapshot.size
+        while self._bytes > self.budget_bytes:
+            _, evicted = self._snapshots.popitem(last=False)
+            self._bytes -= evicted.size
+            self.total_evicted += 1
+
+    def get(self, message_id: int) -> Optional[MessageSnapshot]:
+        snapshot = self._snapshots.get(message_id)
+        if snapshot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._snapshots.move_to_end(message_id)
+        return snapshot
+
+    def pop(self, message_id: int) -> Optional[MessageSnapshot]:
+        """削除されたメッセージの記録を取り出します。"""
+        snapshot = self._remove(message_id)
+        if snapshot is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return snapshot
+
+    def _remove(self, message_id: int) -> Optional[MessageSnapshot]:
+        snapshot = self._snapshots.pop(message_id, None)
+        if snapshot is not None:
+            self._bytes -= snapshot.size
+        return snapshot
+
+    def discard_channel(self, channel_id: int) -> int:
+        """監視対象から外れたチャンネルの記録をすべて捨て、捨てた件数を返します。"""
+        message_ids = [message_id for message_id, snapshot in self._snapshots.items() if snapshot.channel_id == channel_id]
+        for message_id in message_ids:
+            self._remove(message_id)
+        return len(message_ids)
+
+    def stats(self) -> dict:
+        return {
+            "snapshots": len(self._snapshots),
+            "memory_bytes": self._bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_evicted": self.total_evicted,
+        }
+
+
+message_snapshots = MessageSnapshotCache()
+
+
+def format_snapshot_content(snapshot: Optional[MessageSnapshot], content: Optional[str] = None) -> str:
+    """ログの埋め込みに表示する本文（添付ファイル名を含む）を作成します。"""
+    if snapshot is None and content is None:
+        return "（記録なし: Botの起動前または記録の上限を超えた古いメッセージです）"
+    text = content if content is not None else snapshot.content
+    text = text or "（なし）"
+    if snapshot is not None and snapshot.attachments and content is None:
+        text += "\n📎 " + ", ".join(snapshot.attachments)
+    # 埋め込みのフィールドは1024文字まで
+    return text if len(text) <= 1024 else text[:1021] + "..."
+
+
+# ----------------------------------------------------------------------
+# 監視ログの送信
+# 削除・編集のログは送信先チャンネルごとのキューに積み、1通に最大10個のEmbedをまとめて送信する。
+# 一括削除は件数によらず、要約のEmbedと全件を書き出したテキストファイルの1件にまとめる。
+# ----------------------------------------------------------------------
+MONITORING_LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get("MONITORING_LOG_FLUSH_INTERVAL_SECONDS", 2.0))
+MONITORING_LOG_QUEUE_SIZE = int(os.environ.get("MONITORING_LOG_QUEUE_SIZE", 1000))
+# 一括削除の要約Embedに表示するメッセージ数（全件は添付ファイルに書き出す）
+BULK_DELETE_PREVIEW_LINES = 5
+
+
+class MonitoringLogDispatcher(AdminLogDispatcher):
+    """監視ログを送信先チャンネルへまとめて送信します。"""
+    label = "監視ログ"
+
+    async def _get_channel(self) -> discord.abc.Messageable:
+        if self._channel is None:
+            self._channel = bot.get_channel(self.target_id) or await bot.fetch_channel(self.target_id)
+        return self._channel
+
+    def _report_not_found(self):
+        print(f"ERROR: 監視ログの送信先チャンネル {self.target_id} が見つかりませんでした。")
+        # 次回は取得し直す（チャンネルが再作成された場合など）
+        self._channel = None
+
+
+# 送信先チャンネルID → MonitoringLogDispatcher
+monitoring_log_dispatchers: dict[int, MonitoringLogDispatcher] = {}
+
+
+def submit_monitoring_log(guild_id: int, embed: discord.Embed, file: Optional[discord.File] = None) -> bool:
+    """監視ログをサーバーのログ送信先のキューに追加します。送信先が設定されていなければ False を返します。"""
+    log_channel_id = monitoring_config.log_channel_for(guild_id)
+    if log_channel_id is None:
+        return False
+    dispatcher = monitoring_log_dispatchers.get(log_channel_id)
+    if dispatcher is None:
+        dispatcher = MonitoringLogDispatcher(
+            log_channel_id, MONITORING_LOG_QUEUE_SIZE, MONITORING_LOG_FLUSH_INTERVAL_SECONDS
+        )
+        monitoring_log_dispatchers[log_channel_id] = dispatcher
+    dispatcher.submit("", embed, file=file)
+    return True
+
+
+def log_monitored_delete(guild_id: int, channel_id: int, message_id: int, snapshot: Optional[MessageSnapshot]):
+    """監視対象チャンネルのメッセージ削除を監視ログに追加します。"""
+    author = f"<@{snapshot.author_id}> ({snapshot.author_name})" if snapshot else "不明"
+    embed = discord.Embed(
+        title="🗑 メッセージ削除",
+        description=f"**ユーザー:** {author}\n"
+                    f"**元チャンネル:** <#{channel_id}>",
+        color=discord.Color.red()
+    )
+    embed.add_field(name="内容", value=format_snapshot_content(snapshot), inline=False)
+    embed.set_footer(text=f"メッセージID: {message_id}")
+    embed.timestamp = discord.utils.snowflake_time(message_id)
+
+    if not submit_monitoring_log(guild_id, embed):
+        return
+    audit_log.record(
+        guild_id, "message_delete", user_id=snapshot.author_id if snapshot else None, channel_id=channel_id,
+        message_id=message_id, content=snapshot.content[:500] if snapshot else None
+    )
+
+
+def format_bulk_delete_line(message_id: int, snapshot: Optional[MessageSnapshot]) -> str:
+    """一括削除の書き出しファイルの1行を作成します。"""
+    created_at = discord.utils.snowflake_time(message_id).strftime("%Y-%m-%d %H:%M:%S")
+    if snapshot is None:
+        return f"[{created_at}] (記録なし) message_id={message_id}"
+    line = f"[{created_at}] {snapshot.author_name} ({snapshot.author_id}): {snapshot.content}"
+    if snapshot.attachments:
+        line += f" [添付: {', '.join(snapshot.attachments)}]"
+    return line
+
+
+def log_monitored_bulk_delete(guild_id: int, channel_id: int, deleted: list[tuple[int, Optional[MessageSnapshot]]]):
+    """一括削除されたメッセージを、要約のEmbedと全件のテキストファイル1件として監視ログに追加します。"""
+    if not deleted:
+        return
+    deleted.sort(key=lambda item: item[0])
+    lines = [format_bulk_delete_line(message_id, snapshot) for message_id, snapshot in deleted]
+
+    authors: dict[int, int] = {}
+    for _, snapshot in deleted:
+        if snapshot is not None:
+            authors[snapshot.author_id] = authors.get(snapshot.author_id, 0) + 1
+    top_authors = sorted(authors.items(), key=lambda item: item[1], reverse=True)[:5]
+    unknown = len(deleted) - sum(authors.values())
+
+    embed = discord.Embed(
+        title="🧹 メッセージ一括削除",
+        description=f"**元チャンネル:** <#{channel_id}>\n**件数:** {len(deleted)}件"
+                    + (f"（うち内容の記録なし: {unknown}件）" if unknown else ""),
+        color=discord.Color.dark_red()
+    )
+    if top_authors:
+        embed.add_field(
+            name="投稿者",
+            value="\n".join(f"<@{author_id}>: {count}件" for author_id, count in top_authors),
+            inline=False
+        )
+    preview = "\n".join(line[:200] for line in lines[:BULK_DELETE_PREVIEW_LINES])
+    if len(lines) > BULK_DELETE_PREVIEW_LINES:
+        preview += f"\n…ほか {len(lines) - BULK_DELETE_PREVIEW_LINES} 件（添付ファイルを参照）"
+    embed.add_field(name="内容", value=preview[:1024], inline=False)
+    embed.timestamp = datetime.now(timezone.utc)
+
+    first_id = deleted[0][0]
+    file = discord.File(
+        io.BytesIO("\n".join(lines).encode("utf-8")),
+        filename=f"bulk_delete_{channel_id}_{first_id}.txt"
+    )
+    if not submit_monitoring_log(guild_id, embed, file):
+        return
+    audit_log.record(
+        guild_id, "message_bulk_delete", channel_id=channel_id, count=len(deleted),
+        authors={str(author_id): count for author_id, count in top_authors}
+    )
+
+
+def log_monitored_edit(guild_id: int, channel_id: int, message_id: int,
+                       before: Optional[MessageSnapshot], after: discord.Message):
+    """監視対象チャンネルのメッセージ編集を監視ログに追加します。"""
+    # メッセージリンク生成
+    message_link = f"https://discord.com/channels/{guild_id}/{channel_id}/{message_id}"
+
+    embed = discord.Embed(
+        title="✏ メッセージ編集",
+        description=(
+            f"**ユーザー:** {after.author.mention}\n"
+            f"**元チャンネル:** <#{channel_id}>\n"
+            f"**[メッセージリンク]({message_link})**"
+        ),
+        color=discord.Color.orange()
+    )
+    embed.add_field(name="編集前", value=format_snapshot_content(before), inline=False)
+    embed.add_field(name="編集後", value=format_snapshot_content(None, after.content), inline=False)
+    embed.timestamp = after.edited_at
+
+    if not submit_monitoring_log(guild_id, embed):
+        return
+    audit_log.record(
+        guild_id, "message_edit", user_id=after.author.id, channel_id=channel_id,
+        message_id=message_id, before=before.content[:500] if before else None, after=after.content[:500]
+    )
 
-from discord import app_commands
 
 # ---------------------------
 # /monitoring コマンド群
@@ -312,13 +4495,15 @@ from discord import app_commands
 @app_commands.checks.has_permissions(administrator=True)
 async def monitoring_add(interaction: discord.Interaction):
     channel_id = interaction.channel_id
-    monitoring_channels.add(channel_id)
 
-    await interaction.response.send_message(
-        f"📷 このチャンネル（<#{channel_id}>）を **監視対象に追加**しました。",
-        ephemeral=False
-    )
+    if await monitoring_config.add_channel(interaction.guild_id, channel_id):
+        msg = f"📷 このチャンネル（<#{channel_id}>）を **監視対象に追加**しました。"
+        if monitoring_config.log_channel_for(interaction.guild_id) is None:
+            msg += "\n⚠ ログ送信先が未設定です。`/monitoring_send` で設定してください。"
+    else:
+        msg = "⚠ このチャンネルは既に監視対象です。"
 
+    await interaction.response.send_message(msg, ephemeral=False)
 
 
 @bot.tree.command(name="monitoring_remove", description="このチャンネルを監視対象から外します。")
@@ -326,8 +4511,8 @@ async def monitoring_add(interaction: discord.Interaction):
 async def monitoring_remove(interaction: discord.Interaction):
     channel_id = interaction.channel_id
 
-    if channel_id in monitoring_channels:
-        monitoring_channels.remove(channel_id)
+    if await monitoring_config.remove_channel(interaction.guild_id, channel_id):
+        message_snapshots.discard_channel(channel_id)
         msg = "🗑 このチャンネルを監視対象から削除しました。"
     else:
         msg = "⚠ このチャンネルは監視対象ではありません。"
@@ -338,8 +4523,7 @@ async def monitoring_remove(interaction: discord.Interaction):
 @bot.tree.command(name="monitoring_send", description="このチャンネルをログ送信先に設定します。")
 @app_commands.checks.has_permissions(administrator=True)
 async def monitoring_send(interaction: discord.Interaction):
-    global monitoring_log_channel_id
-    monitoring_log_channel_id = interaction.channel_id
+    await monitoring_config.set_log_channel(interaction.guild_id, interaction.channel_id)
 
     await interaction.response.send_message(
         f"📡 このチャンネル（{interaction.channel.mention}）を **ログ送信先** に設定しました。",
@@ -359,22 +4543,67 @@ async def monitoring_send(interaction: discord.Interaction):
 # Discordイベントとスラッシュコマンド
 # ----------------------------------------------------------------------
 
+@bot.event
+async def setup_hook():
+    """
+    ログイン後、ゲートウェイに接続する前に1度だけ実行されます。
+    
+    保存済みのサーバーごとの設定をここで読み込んでおき、接続直後に届くメッセージから適用されるようにする。
+    """
+    # 保存済みの一時BANの解除予定（解除の開始は on_ready で行う）
+    try:
+        await time_ban_scheduler.load()
+    except Exception as e:
+        print(f"ERROR: 一時BANの解除予定の読み込みに失敗しました: {e}")
+    try:
+        await monitoring_config.load()
+    except Exception as e:
+        print(f"ERROR: 監視設定の読み込みに失敗しました: {e}")
+    try:
+        await banned_words.load()
+    except Exception as e:
+        print(f"ERROR: 禁止ワードリストの読み込みに失敗しました: {e}")
+    try:
+        loaded = await rate_limit_policy_store.load_into(spam_tracking)
+        print(f"INFO: レート制限ポリシーを {loaded} 件読み込みました。")
+    except Exception as e:
+        print(f"ERROR: レート制限ポリシーの読み込みに失敗しました: {e}")
+
+
 @bot.event
 async def on_ready():
     """BotがDiscordに接続したときに実行されます。"""
     print(f'Logged in as {bot.user} (ID: {bot.user.id})')
+    health_reporter.set_gateway_connected(True)
+    # 再接続（セッションの再作成）の場合、切断中のメッセージは直近メッセージのバッファに記録されていない
+    recent_messages.mark_gap(current_snowflake())
+
+    # 定期タスクの開始（再接続で on_ready が再度呼ばれても二重起動しない）
+    if not sweep_rate_limit_state.is_running():
+        sweep_rate_limit_state.start()
+    if not raid_mode_watchdog.is_running():
+        raid_mode_watchdog.start()
+
+    # 保存済みの一時BAN（setup_hook で読み込み済み）について、停止中に期限が来たものを含めて自動解除を再開する
+    time_ban_scheduler.start()
+    if not reload_banned_words.is_running():
+        reload_banned_words.start()
     
     JST = timezone(timedelta(hours=+9), 'JST')
     current_time_jst = datetime.now(JST).strftime("%Y/%m/%d %H:%M:%S %Z")
     
-    # 1. コマンドの同期
-    try:
-        synced = await bot.tree.sync()
-        log_sync = f"DEBUG: {len(synced)}個のコマンドを同期しました。"
-        print(log_sync)
-    except Exception as e:
-        log_sync = f"DEBUG: コマンドの同期中にエラーが発生しました: {e}"
+    # 1. コマンドの同期（複数のワーカーで動かす場合は、ワーカー0だけが行う）
+    if BOT_WORKER_ID:
+        log_sync = f"DEBUG: ワーカー{BOT_WORKER_ID}のため、コマンドの同期はワーカー0に任せます。"
         print(log_sync)
+    else:
+        try:
+            synced = await bot.tree.sync()
+            log_sync = f"DEBUG: {len(synced)}個のコマンドを同期しました。"
+            print(log_sync)
+        except Exception as e:
+            log_sync = f"DEBUG: コマンドの同期中にエラーが発生しました: {e}"
+            print(log_sync)
         
     # 2. ログイン通知のEmbed作成
     embed = discord.Embed(
@@ -384,6 +4613,11 @@ async def on_ready():
     )
     embed.add_field(name="接続ユーザー", value=f"{bot.user.name} (ID: {bot.user.id})", inline=False)
     embed.add_field(name="時刻 (JST)", value=current_time_jst, inline=False)
+    if isinstance(bot, commands.AutoShardedBot):
+        shards = f"{format_shard_ids(list(bot.shards))} / 全{bot.shard_count}シャード"
+        if BOT_WORKER_ID is not None:
+            shards = f"ワーカー{BOT_WORKER_ID}: {shards}"
+        embed.add_field(name="シャード", value=shards, inline=False)
 
     # 3. ログイン通知の送信 (チャンネルとDMの両方)
     
@@ -401,72 +4635,100 @@ async def on_ready():
 
     # b. DMログ送信先への送信
     dm_message = f"**Bot起動ログ**\n時刻: {current_time_jst}\n有効キー数: {len(gemini_clients)}個\n{log_sync}"
-    await send_dm_log(dm_message, embed=embed)
+    send_dm_log(dm_message, embed=embed, priority=LOG_PRIORITY_HIGH)
         
     print('------')
 
 
 @bot.event
-async def on_message_delete(message: discord.Message):
-    if message.author.bot:
-        return
-    if message.guild is None:
-        return
-    if message.channel.id not in monitoring_channels:
-        return
-    if monitoring_log_channel_id is None:
-        return
+async def on_disconnect():
+    """Gatewayから切断されたときに、準備完了の判定に反映します（通常は自動で再接続されます）。"""
+    health_reporter.set_gateway_connected(False)
+    recent_messages.mark_gap(current_snowflake())
 
-    log_channel = bot.get_channel(monitoring_log_channel_id)
-    if log_channel is None:
-        return
-
-    embed = discord.Embed(
-        title="🗑 メッセージ削除",
-        description=f"**ユーザー:** {message.author.mention}\n"
-                    f"**元チャンネル:** {message.channel.mention}",
-        color=discord.Color.red()
-    )
-    embed.add_field(name="内容", value=message.content or "（なし）", inline=False)
-    embed.timestamp = message.created_at
 
-    await log_channel.send(embed=embed)
+@bot.event
+async def on_resumed():
+    health_reporter.set_gateway_connected(True)
+    # 再開までに届かなかったメッセージがあり得るため、再開以降だけを網羅しているものとする
+    recent_messages.mark_gap(current_snowflake())
 
 
 @bot.event
-async def on_message_edit(before: discord.Message, after: discord.Message):
-    if before.author.bot:
+@instrument_event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    """監視対象チャンネルのメッセージ削除を、キャッシュにない古いメッセージも含めて記録します。"""
+    if payload.guild_id is None or not monitoring_config.is_monitored(payload.channel_id):
         return
-    if before.guild is None:
+    if payload.cached_message is not None and payload.cached_message.author.bot:
         return
-    if before.channel.id not in monitoring_channels:
+    snapshot = message_snapshots.pop(payload.message_id)
+    if snapshot is None and payload.cached_message is not None:
+        snapshot = MessageSnapshot.from_message(payload.cached_message)
+    log_monitored_delete(payload.guild_id, payload.channel_id, payload.message_id, snapshot)
+
+
+@bot.event
+@instrument_event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    """監視対象チャンネルで一括削除されたメッセージを記録します。"""
+    if payload.guild_id is None or not monitoring_config.is_monitored(payload.channel_id):
         return
-    if before.content == after.content:
+    cached = {message.id: message for message in payload.cached_messages}
+    deleted = []
+    for message_id in payload.message_ids:
+        message = cached.get(message_id)
+        if message is not None and message.author.bot:
+            continue
+        snapshot = message_snapshots.pop(message_id)
+        if snapshot is None and message is not None:
+            snapshot = MessageSnapshot.from_message(message)
+        deleted.append((message_id, snapshot))
+    log_monitored_bulk_delete(payload.guild_id, payload.channel_id, deleted)
+
+
+@bot.event
+@instrument_event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    """監視対象チャンネルのメッセージ編集を、編集前の内容とともに記録します。"""
+    if payload.guild_id is None or not monitoring_config.is_monitored(payload.channel_id):
         return
-    if monitoring_log_channel_id is None:
+    after = payload.message
+    # 埋め込みの展開など、ユーザーによる編集ではない更新は edited_at が付かない
+    if after.author.bot or after.edited_at is None:
         return
 
-    log_channel = bot.get_channel(monitoring_log_channel_id)
-    if log_channel is None:
+    before = message_snapshots.get(payload.message_id)
+    if before is None and payload.cached_message is not None:
+        before = MessageSnapshot.from_message(payload.cached_message)
+    # 次の編集に備えて最新の内容を記録する
+    message_snapshots.put(MessageSnapshot.from_message(after))
+
+    # 本文が変わらない更新は記録しない
+    if before is not None and before.content == after.content:
         return
+    log_monitored_edit(payload.guild_id, payload.channel_id, payload.message_id, before, after)
 
-    # メッセージリンク生成
-    message_link = f"https://discord.com/channels/{before.guild.id}/{before.channel.id}/{before.id}"
 
-    embed = discord.Embed(
-        title="✏ メッセージ編集",
-        description=(
-            f"**ユーザー:** {before.author.mention}\n"
-            f"**元チャンネル:** {before.channel.mention}\n"
-            f"**[メッセージリンク]({message_link})**"
-        ),
-        color=discord.Color.orange()
-    )
-    embed.add_field(name="編集前", value=before.content or "（なし）", inline=False)
-    embed.add_field(name="編集後", value=after.content or "（なし）", inline=False)
-    embed.timestamp = after.edited_at
+@bot.event
+@instrument_event
+async def on_member_join(member: discord.Member):
+    """メンバーの参加を記録し、短時間に大量の参加があればレイドモードを開始します。"""
+    if member.bot or not RAID_DETECTION_ENABLED:
+        return
+    raid_reason = raid_detector.record_join(member)
+    if raid_reason is not None:
+        start_raid_mode(member.guild, raid_reason)
 
-    await log_channel.send(embed=embed)
+
+@bot.event
+@instrument_event
+async def on_member_unban(guild: discord.Guild, user: discord.User):
+    """一時BAN中のユーザーが手動で解除された場合は、自動解除の予定を取り消します。"""
+    if time_ban_scheduler.get(guild.id, user.id) is None:
+        return
+    await time_ban_scheduler.cancel(guild.id, user.id)
+    print(f"INFO: User ID {user.id} のBANが手動で解除されたため、自動解除の予定を取り消しました。")
 
 
 # ----------------------------------------------------------------------
@@ -474,6 +4736,7 @@ async def on_message_edit(before: discord.Message, after: discord.Message):
 # ----------------------------------------------------------------------
 
 @bot.event
+@instrument_event
 async def on_message(message: discord.Message):
     """メッセージが送信されたときに実行され、スパムチェックを行います。"""
     
@@ -486,8 +4749,20 @@ async def on_message(message: discord.Message):
         await bot.process_commands(message)
         return
         
+    # スパム一括削除で履歴を取得せずに済むよう、直近のメッセージを記録しておく
+    recent_messages.record(message.channel.id, message.id, message.author.id)
+    # 監視対象チャンネルでは、削除・編集ログのために内容を記録しておく
+    if monitoring_config.is_monitored(message.channel.id):
+        message_snapshots.put(MessageSnapshot.from_message(message))
+
     # 2. 管理者権限チェック
     is_administrator = message.author.guild_permissions.administrator
+
+    # サーバー全体のレイド検知（新規アカウントの投稿数・同じ内容の投稿者数）
+    if not is_administrator and RAID_DETECTION_ENABLED:
+        raid_reason = raid_detector.record_message(message)
+        if raid_reason is not None:
+            start_raid_mode(message.guild, raid_reason)
     
     # ----------------------------------------------------------------------
     # ★ ユーザーごとのレート制限スパムチェック（非管理者のみ）
@@ -496,21 +4771,13 @@ async def on_message(message: discord.Message):
         now = datetime.now(timezone.utc)
         user_id = message.author.id
 
-        # 投稿履歴の更新と古いタイムスタンプの削除
-        if user_id not in spam_tracking:
-            spam_tracking[user_id] = []
-        
-        # 現在のメッセージのタイムスタンプを追加
-        spam_tracking[user_id].append(now)
-
-        time_limit = now - timedelta(seconds=RATE_LIMIT_WINDOW_SECONDS)
-        # 60秒より古いメッセージ履歴を削除
-        spam_tracking[user_id] = [
-            ts for ts in spam_tracking[user_id] if ts > time_limit
-        ]
+        # 投稿履歴を記録し、このサーバー/チャンネル/ロールのポリシーで超過しているか確認する
+        violation = spam_tracking.check(message.guild.id, message.channel.id, message.author)
 
-        # 3. レート制限の確認 (30コメント/60秒を超過した場合)
-        if len(spam_tracking[user_id]) > RATE_LIMIT_MESSAGES:
+        # 3. レート制限の確認 (既定: 30コメント/60秒を超過した場合)
+        if violation is not None:
+            window_seconds = violation.window.window_seconds
+            time_limit = now - timedelta(seconds=window_seconds)
             try:
                 # 4. スパムメッセージを一括削除
                 # Botが「メッセージの管理」と「メッセージ履歴を読む」権限を持っているか確認
@@ -519,50 +4786,50 @@ async def on_message(message: discord.Message):
                     
                     messages_to_delete = []
                     
-                    # タイムウィンドウ内のメッセージをフェッチして削除対象を特定
-                    # limit=200で直近200件をチェックし、パフォーマンスと精度を両立
-                    async for msg in message.channel.history(limit=200, after=time_limit):
-                        if msg.author.id == user_id:
-                            messages_to_delete.append(msg)
+                    # まず直近メッセージの記録から削除対象を特定する（REST呼び出し不要）
+                    cached_ids = recent_messages.recent_by_author(
+                        message.channel.id, user_id, discord.utils.time_snowflake(time_limit)
+                    )
+                    if cached_ids is not None:
+                        # 記録したIDから部分メッセージを作る（discord.pyのメッセージキャッシュ全体は走査しない）
+                        messages_to_delete = [
+                            message if message_id == message.id else message.channel.get_partial_message(message_id)
+                            for message_id in cached_ids
+                        ]
+                    else:
+                        # 記録が期間を網羅していない場合のみ、タイムウィンドウ内のメッセージをフェッチ
+                        # limit=200で直近200件をチェックし、パフォーマンスと精度を両立
+                        async for msg in message.channel.history(limit=200, after=time_limit):
+                            if msg.author.id == user_id:
+                                messages_to_delete.append(msg)
                     
-                    # トリガーとなったメッセージが履歴に載っていなければ確実に追加
-                    if message not in messages_to_delete:
+                    # トリガーとなったメッセージが含まれていなければ確実に追加
+                    if all(m.id != message.id for m in messages_to_delete):
                         messages_to_delete.append(message)
                     
                     # 削除対象を投稿が古い順にソート (delete_messagesの挙動のため)
-                    messages_to_delete.sort(key=lambda m: m.created_at)
+                    messages_to_delete.sort(key=lambda m: m.id)
 
                     if messages_to_delete:
-                        deleted_count = 0
-                        # List comprehensionsでコンテンツを抽出
-                        deleted_contents = [m.content for m in messages_to_delete]
+                        # List comprehensionsでコンテンツを抽出（部分メッセージは、監視対象チャンネルで記録した内容があればそれを使う）
+                        monitored = monitoring_config.is_monitored(message.channel.id)
+                        deleted_contents = [
+                            m.content if isinstance(m, discord.Message)
+                            else (getattr(message_snapshots.get(m.id), "content", "") if monitored else "")
+                            for m in messages_to_delete
+                        ]
                         
-                        try:
-                            # 2週間以内のメッセージを効率的に一括削除（100件まで）
-                            if (datetime.now(timezone.utc) - messages_to_delete[0].created_at) < timedelta(days=14):
-                                await message.channel.delete_messages(messages_to_delete)
-                                deleted_count = len(messages_to_delete)
-                            else:
-                                # 2週間より古いメッセージが含まれる可能性がある場合は個別削除
-                                for msg in messages_to_delete:
-                                    await msg.delete()
-                                    deleted_count += 1
-                        except discord.Forbidden:
-                             # 一括削除の権限がない場合、個別に削除を試みる
-                             for msg in messages_to_delete:
-                                 try:
-                                     await msg.delete()
-                                     deleted_count += 1
-                                 except (discord.Forbidden, discord.HTTPException):
-                                     continue
-                        except Exception as http_e:
-                            print(f"ERROR: メッセージの一括削除中に予期せぬHTTPエラーが発生しました: {http_e}")
-                            pass
+                        # 2週間以内のメッセージは100件ずつ一括削除、古いものは個別に削除
+                        purge_result = await message_deletion_engine.delete(message.channel, messages_to_delete)
+                        deleted_count = purge_result.deleted
+
+                        # 削除したメッセージが再び削除対象にならないよう記録から外す
+                        recent_messages.forget(message.channel.id, [m.id for m in messages_to_delete])
 
                         # 5. 警告メッセージの送信（メンション付き）
                         warning_text = (
                             f"🚨 **{message.author.mention}** さん、ご注意ください！\n"
-                            f"短時間（{RATE_LIMIT_WINDOW_SECONDS}秒以内）に{RATE_LIMIT_MESSAGES}件以上のメッセージを投稿しました。\n"
+                            f"短時間（{window_seconds}秒以内）に{violation.window.limit}件以上のメッセージを投稿しました。\n"
                             f"スパム行為と見なされるため、**直近の{deleted_count}件のメッセージはすべて削除されました。**\n"
                             f"続けて投稿するとミュートなどの処置が取られる可能性があります。"
                         )
@@ -577,18 +4844,26 @@ async def on_message(message: discord.Message):
                         )
                         embed.add_field(name="チャンネル", value=message.channel.mention, inline=False)
                         embed.add_field(name="送信者", value=f"{message.author.name} (ID: {message.author.id})", inline=False)
-                        embed.add_field(name="超過回数", value=f"直近 {RATE_LIMIT_WINDOW_SECONDS}秒で {len(spam_tracking[user_id])} 回", inline=True)
+                        embed.add_field(name="超過回数", value=f"直近 {window_seconds}秒で {violation.count} 回", inline=True)
                         embed.add_field(name="削除件数", value=f"{deleted_count} 件", inline=True)
                         
-                        log_contents = "\n".join([f"`{c[:50]}...`" for c in deleted_contents[:5]])
+                        # 記録から特定した部分メッセージは内容が分からないことがある
+                        log_contents = "\n".join([f"`{c[:50]}...`" if c else "(内容なし)" for c in deleted_contents[:5]])
                         embed.add_field(name="削除されたメッセージ (一部)", value=log_contents or "内容なし", inline=False)
                         
                         embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
                         
-                        await send_dm_log(f"**💥 レート超過一括削除:** {message.author.name} がスパム行為を行いました。", embed=embed)
+                        audit_log.record(
+                            message.guild.id, "spam_purge", user_id=user_id, channel_id=message.channel.id,
+                            deleted=deleted_count, count=violation.count, window=violation.window.describe()
+                        )
+
+                        # レイドモード中は個別のログを送らず、解除時の要約にまとめる
+                        if not raid_detector.suppress_log(message.guild.id):
+                            send_dm_log(f"**💥 レート超過一括削除:** {message.author.name} がスパム行為を行いました。", embed=embed)
 
                         # 履歴をリセットして、連鎖的な警告を防ぐ
-                        spam_tracking[user_id] = []
+                        spam_tracking.reset(violation)
                         
                         return # 削除されたため、以降の処理は不要
                     
@@ -605,15 +4880,15 @@ async def on_message(message: discord.Message):
     # ★ 禁止ワードチェック（非管理者のみ）
     # ----------------------------------------------------------------------
     
-    # グローバルで定義されたBANNED_WORDSリストを使用
-    if not is_administrator and BANNED_WORDS:
-        content_lower = message.content.lower()
+    # このサーバーの禁止ワードリストを使用（未編集のサーバーは既定のリスト）
+    word_filter = banned_words.filter_for(message.guild.id)
+    if not is_administrator and word_filter:
         detected_word = None
         
-        for word in BANNED_WORDS:
-            if word in content_lower:
-                detected_word = word
-                break
+        # 正規化したメッセージから、すべての禁止ワードを1回の走査で検出する
+        matches = word_filter.find_all(message.content)
+        if matches:
+            detected_word = matches[0].word
                 
         # 禁止ワードが検出された場合の処理
         if detected_word:
@@ -638,12 +4913,20 @@ async def on_message(message: discord.Message):
                 
                 embed.add_field(name="チャンネル", value=message.channel.mention, inline=False)
                 embed.add_field(name="送信者", value=f"{message.author.name} (ID: {message.author.id})", inline=False)
-                embed.add_field(name="検出ワード", value=f"`{detected_word}`", inline=False)
+                detected_words = ", ".join(
+                    f"`{match.word}` → `{message.content[match.start:match.end][:50]}`" for match in matches[:10]
+                )
+                embed.add_field(name="検出ワード", value=detected_words, inline=False)
                 # メッセージ内容を埋め込みに直接格納（最大1024文字）
                 content_preview = message.content[:1000] + ('...' if len(message.content) > 1000 else '')
                 embed.add_field(name="削除されたメッセージ内容", value=content_preview, inline=False)
                 
-                await send_dm_log(f"**🔴 自動削除 (禁止ワード):** {message.author.name} が禁止ワードを使用しました。", embed=embed)
+                if not raid_detector.suppress_log(message.guild.id):
+                    send_dm_log(f"**🔴 自動削除 (禁止ワード):** {message.author.name} が禁止ワードを使用しました。", embed=embed)
+                audit_log.record(
+                    message.guild.id, "banned_word", user_id=message.author.id, channel_id=message.channel.id,
+                    words=sorted({match.word for match in matches}), content=message.content[:500]
+                )
                 
                 return # 削除が成功したので、以降の処理は不要
 
@@ -652,6 +4935,21 @@ async def on_message(message: discord.Message):
             except Exception as e:
                 print(f"ERROR: メッセージの自動削除中に予期せぬエラーが発生しました: {e}")
 
+    # ----------------------------------------------------------------------
+    # ★ 類似メッセージ（コピペ）の連投チェック（非管理者のみ）
+    # ----------------------------------------------------------------------
+    if not is_administrator and NEAR_DUPLICATE_ENABLED:
+        cluster = near_duplicate_index.add(
+            message.guild.id, message.channel.id, message.id, message.author.id, message.content
+        )
+        if cluster is not None and len(cluster.authors) >= NEAR_DUPLICATE_THRESHOLD:
+            try:
+                await handle_near_duplicates(message, cluster)
+                if NEAR_DUPLICATE_ACTION == "delete":
+                    return # 削除されたため、以降の処理は不要
+            except Exception as e:
+                print(f"ERROR: 類似メッセージの処理中に予期せぬエラーが発生しました: {e}")
+
     # スラッシュコマンドやその他の通常のコマンド処理
     await bot.process_commands(message)
 
@@ -693,45 +4991,41 @@ async def timeban_command(interaction: discord.Interaction, member: discord.Memb
         )
         return
 
-    delay_seconds = hours * 3600
     unban_time_utc = datetime.now(timezone.utc) + timedelta(hours=hours)
     unban_time_jst = unban_time_utc.astimezone(timezone(timedelta(hours=+9), 'JST'))
     
     guild_id = interaction.guild_id
     user_id = member.id
     
-    # 既存のBANタスクが存在するかチェック（再実行防止と上書き）
-    if guild_id in time_bans and user_id in time_bans[guild_id]:
+    # 既存の解除予定が存在するかチェック（schedule() で新しい予定に上書きされる）
+    previous = time_ban_scheduler.get(guild_id, user_id)
+    if previous is not None:
         await interaction.followup.send(
             f"⚠️ {member.mention} さんは既に一時BAN中です。新しいBAN期間で上書きします。",
             ephemeral=True
         )
-        # 既存のタイマーをキャンセルする処理があれば理想的だが、今回は簡易実装のため省略
         
     try:
         # 3. ユーザーをBAN
         ban_reason = f"一時BAN ({hours}時間, 実行者: {interaction.user.name})"
         await interaction.guild.ban(member, reason=ban_reason, delete_message_days=0)
 
-        # 4. 自動UNBANタスクをスケジュール
-        asyncio.create_task(
-            unban_user_after_delay(guild_id, user_id, delay_seconds)
-        )
-        
-        # 5. 内部状態を更新
-        if guild_id not in time_bans:
-            time_bans[guild_id] = {}
-            
-        time_bans[guild_id][user_id] = unban_time_utc # UTC時刻で保存
+        # 4. 自動UNBANの予定を保存（再起動後も引き継がれる）
+        try:
+            await time_ban_scheduler.schedule(guild_id, user_id, unban_time_utc, actor_id=interaction.user.id)
+        except Exception as e:
+            print(f"ERROR: User ID {user_id} の自動BAN解除予定の保存に失敗しました: {e}")
+            await handle_time_ban_schedule_failure(interaction, member, previous, e)
+            return
 
-        # 6. 成功メッセージをチャンネルに送信
+        # 5. 成功メッセージをチャンネルに送信
         await interaction.followup.send(
             f"🚨 **{member.mention}** さんを **{hours} 時間**（`{unban_time_jst.strftime('%m/%d %H:%M:%S JST')}`）BANしました。\n"
             f"時間が経過すると自動的にBANが解除されます。",
             ephemeral=False
         )
         
-        # 7. 管理者へのログ送信 (DM)
+        # 6. 管理者へのログ送信 (DM)
         embed = discord.Embed(
             title="🚫 一時BAN実行ログ",
             description=f"実行者: {interaction.user.mention} (ID: {interaction.user.id})",
@@ -740,10 +5034,11 @@ async def timeban_command(interaction: discord.Interaction, member: discord.Memb
         embed.add_field(name="対象メンバー", value=f"{member.name} (ID: {member.id})", inline=False)
         embed.add_field(name="BAN期間", value=f"{hours} 時間", inline=True)
         embed.add_field(name="自動解除予定時刻 (JST)", value=unban_time_jst.strftime('%Y/%m/%d %H:%M:%S'), inline=True)
-        embed.set_footer(text="Bot再起動時は自動解除タイマーがリセットされます。")
+        embed.set_footer(text="自動解除の予定は保存されるため、Botを再起動しても引き継がれます。")
         embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
 
-        await send_dm_log(f"**🔴 メンバー一時BAN:** {member.name} が {hours} 時間BANされました。", embed=embed)
+        send_dm_log(f"**🔴 メンバー一時BAN:** {member.name} が {hours} 時間BANされました。", embed=embed)
+        audit_log.record(interaction.guild_id, "timeban", user_id=member.id, actor_id=interaction.user.id, hours=hours)
 
     except discord.Forbidden:
         await interaction.followup.send(
@@ -757,6 +5052,116 @@ async def timeban_command(interaction: discord.Interaction, member: discord.Memb
         )
 
 
+async def handle_time_ban_schedule_failure(
+    interaction: discord.Interaction,
+    member: discord.Member,
+    previous: Optional[TimeBan],
+    error: Exception
+):
+    """
+    BAN後に解除予定を保存できなかった場合の後始末をします。
+    
+    以前の予定があればそれを残し、なければ解除されないBANにならないようBANを取り消します。
+    """
+    if previous is not None:
+        # 以前の予定はメモリ上・保存先ともに残っているので、その時刻に解除される
+        previous_jst = datetime.fromtimestamp(previous.unban_at, timezone(timedelta(hours=+9), 'JST'))
+        await interaction.followup.send(
+            f"⚠️ {member.mention} さんをBANしましたが、新しい解除予定を保存できませんでした: {error}\n"
+            f"以前の予定どおり `{previous_jst.strftime('%m/%d %H:%M:%S JST')}` に解除されます。",
+            ephemeral=True
+        )
+        send_dm_log(f"**⚠️ 一時BAN予定の保存失敗:** User ID `{member.id}` は以前の予定どおり解除されます。エラー: {error}")
+        return
+
+    try:
+        await interaction.guild.unban(member, reason="一時BANの解除予定を保存できなかったため取り消し")
+    except discord.NotFound:
+        pass
+    except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"ERROR: 解除予定のない User ID {member.id} のBANを取り消せませんでした: {e}")
+        await interaction.followup.send(
+            f"❌ {member.mention} さんをBANしましたが、自動解除の予定を保存できず、BANの取り消しにも失敗しました。\n"
+            f"**このBANは自動では解除されません。** 期限が来たら手動で解除してください。",
+            ephemeral=True
+        )
+        send_dm_log(f"**❌ 一時BAN予定の保存失敗:** User ID `{member.id}` のBANは自動解除されません。手動で解除してください。エラー: {error}")
+        return
+
+    await interaction.followup.send(
+        f"❌ 自動解除の予定を保存できなかったため、{member.mention} さんのBANを取り消しました: {error}",
+        ephemeral=True
+    )
+    send_dm_log(f"**⚠️ 一時BAN予定の保存失敗:** User ID `{member.id}` のBANを取り消しました。エラー: {error}")
+
+
+# ----------------------------------------------------------------------
+# ★ コマンド: /timeban_cancel, /timeban_reschedule (一時BANの取り消し・期間変更)
+# BAN中のユーザーはサーバーのメンバーではないため、ユーザー（ID指定可）で受け取る。
+# ----------------------------------------------------------------------
+@bot.tree.command(name="timeban_cancel", description="一時BANを取り消し、今すぐBANを解除します。")
+@discord.app_commands.describe(user="BANを解除するユーザー（IDでも指定できます）。")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def timeban_cancel_command(interaction: discord.Interaction, user: discord.User):
+    await interaction.response.defer(ephemeral=True)
+
+    ban = await time_ban_scheduler.cancel(interaction.guild_id, user.id)
+    if ban is None:
+        await interaction.followup.send(f"⚠️ {user.mention} さんの一時BANの予定はありません。", ephemeral=True)
+        return
+
+    try:
+        await interaction.guild.unban(user, reason=f"一時BANの取り消し (実行者: {interaction.user.name})")
+    except discord.NotFound:
+        pass
+    except discord.Forbidden:
+        await interaction.followup.send(
+            "❌ BANの解除に失敗しました。Botに「メンバーをBAN」権限があることを確認してください（解除予定は取り消されました）。",
+            ephemeral=True
+        )
+        return
+
+    await interaction.followup.send(f"✅ {user.mention} さんの一時BANを取り消し、BANを解除しました。", ephemeral=True)
+    send_dm_log(f"**🟢 一時BAN取り消し:** 管理者 {interaction.user.name} により User ID `{user.id}` のBANが解除されました。")
+    audit_log.record(interaction.guild_id, "unban", user_id=user.id, actor_id=interaction.user.id, cancelled=True)
+
+
+@bot.tree.command(name="timeban_reschedule", description="一時BANの解除時刻を変更します（今から指定した時間後に解除）。")
+@discord.app_commands.describe(
+    user="対象のユーザー（IDでも指定できます）。",
+    hours="今から何時間後に解除するか（1〜168）。"
+)
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def timeban_reschedule_command(
+    interaction: discord.Interaction,
+    user: discord.User,
+    hours: discord.app_commands.Range[int, 1, 7 * 24]
+):
+    await interaction.response.defer(ephemeral=True)
+
+    if time_ban_scheduler.get(interaction.guild_id, user.id) is None:
+        await interaction.followup.send(f"⚠️ {user.mention} さんの一時BANの予定はありません。", ephemeral=True)
+        return
+
+    unban_time_utc = datetime.now(timezone.utc) + timedelta(hours=hours)
+    try:
+        await time_ban_scheduler.schedule(interaction.guild_id, user.id, unban_time_utc, actor_id=interaction.user.id)
+    except Exception as e:
+        print(f"ERROR: User ID {user.id} の解除時刻の変更に失敗しました: {e}")
+        await interaction.followup.send(
+            f"❌ 解除時刻を変更できませんでした（以前の予定のまま解除されます）: {e}",
+            ephemeral=True
+        )
+        return
+    unban_time_jst = unban_time_utc.astimezone(timezone(timedelta(hours=+9), 'JST'))
+    await interaction.followup.send(
+        f"✅ {user.mention} さんのBANは `{unban_time_jst.strftime('%m/%d %H:%M:%S JST')}` に解除されます。",
+        ephemeral=True
+    )
+    send_dm_log(f"**🔁 一時BAN期間変更:** 管理者 {interaction.user.name} により User ID `{user.id}` の解除時刻が {hours} 時間後に変更されました。")
+    audit_log.record(interaction.guild_id, "timeban", user_id=user.id, actor_id=interaction.user.id, hours=hours, rescheduled=True)
+
+
 # ----------------------------------------------------------------------
 # コマンドグループ: /name (ニックネーム管理)
 # ----------------------------------------------------------------------
@@ -826,7 +5231,11 @@ async def name_set_command(interaction: discord.Interaction, member: discord.Mem
         embed.add_field(name="変更後ニックネーム", value=nickname, inline=True)
         embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
 
-        await send_dm_log(f"**🔷 ニックネーム設定:** {member.name} のニックネームが設定されました。", embed=embed)
+        send_dm_log(f"**🔷 ニックネーム設定:** {member.name} のニックネームが設定されました。", embed=embed)
+        audit_log.record(
+            interaction.guild_id, "nickname_set", user_id=member.id, actor_id=interaction.user.id,
+            channel_id=interaction.channel_id, before=old_nickname, after=nickname
+        )
 
     except discord.Forbidden:
         await interaction.followup.send(
@@ -906,7 +5315,11 @@ async def name_reset_command(interaction: discord.Interaction, member: discord.M
         embed.add_field(name="変更後ニックネーム", value="ユーザー名にリセット", inline=True)
         embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
 
-        await send_dm_log(f"**🔄 ニックネームリセット:** {member.name} のニックネームがリセットされました。", embed=embed)
+        send_dm_log(f"**🔄 ニックネームリセット:** {member.name} のニックネームがリセットされました。", embed=embed)
+        audit_log.record(
+            interaction.guild_id, "nickname_reset", user_id=member.id, actor_id=interaction.user.id,
+            channel_id=interaction.channel_id, before=old_nickname
+        )
 
     except discord.Forbidden:
         await interaction.followup.send(
@@ -971,106 +5384,587 @@ async def bot_status_command(interaction: discord.Interaction):
         
         bot_list_lines.append(f"{status_icon} `{display_name}`")
 
-    # 応答メッセージの作成
-    # Embedを使用して見やすく整形
+    # 応答メッセージの作成
+    # Embedを使用して見やすく整形
+    embed = discord.Embed(
+        title=f"🤖 このサーバーのBotステータス (現在 {len(bot_members)} 件)",
+        description="\n".join(bot_list_lines),
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text="オンライン状態はDiscordのステータスに基づいています。")
+    
+    await interaction.followup.send(embed=embed)
+
+
+# ----------------------------------------------------------------------
+# ★ コマンドグループ: /blockword (禁止ワード管理)
+# ----------------------------------------------------------------------
+
+# blockword コマンドグループを定義
+blockword_group = discord.app_commands.Group(name="blockword", description="サーバーの禁止ワードリストを管理します（管理者専用）")
+bot.tree.add_command(blockword_group)
+
+# ----------------------------------------------------------------------
+# サブコマンド: /blockword add (禁止ワード追加)
+# ----------------------------------------------------------------------
+@blockword_group.command(name="add", description="禁止ワードリストに新しい単語を追加します。")
+@discord.app_commands.describe(word="禁止したい単語（大文字小文字は区別されません）。")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def blockword_add_command(interaction: discord.Interaction, word: str):
+    # 小文字にして、前後の空白を削除
+    word_lower = word.lower().strip()
+    
+    if not word_lower:
+        await interaction.response.send_message("❌ 追加する禁止ワードを入力してください。", ephemeral=True)
+        return
+
+    if word_lower in banned_words.get(interaction.guild_id).words:
+        await interaction.response.send_message(f"⚠️ `{word}` はすでに禁止ワードリストに存在しています。", ephemeral=True)
+        return
+
+    added, _, rejected = await banned_words.update(interaction.guild_id, add=[word_lower])
+    if rejected:
+        await interaction.response.send_message(
+            f"❌ `{word}` は記号や空白のみで構成されているか、リストの上限（{BANNED_WORDS_MAX_PER_GUILD}件）に達しているため、"
+            "禁止ワードとして登録できません。",
+            ephemeral=True
+        )
+    elif added:
+        await interaction.response.send_message(
+            f"✅ 禁止ワードリストに `{word_lower}` を追加しました。\n"
+            f"現在のリスト件数: {len(banned_words.get(interaction.guild_id).words)}", 
+            ephemeral=True
+        )
+        send_dm_log(f"**➕ 禁止ワード追加:** 管理者 {interaction.user.name} により `{word_lower}` が追加されました。")
+        audit_log.record(interaction.guild_id, "blockword_add", actor_id=interaction.user.id, word=word_lower)
+    else:
+        await interaction.response.send_message(f"⚠️ `{word}` はすでに禁止ワードリストに存在しています。", ephemeral=True)
+
+# ----------------------------------------------------------------------
+# サブコマンド: /blockword remove (禁止ワード削除)
+# ----------------------------------------------------------------------
+@blockword_group.command(name="remove", description="禁止ワードリストから単語を削除します。")
+@discord.app_commands.describe(word="削除したい禁止ワード。")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def blockword_remove_command(interaction: discord.Interaction, word: str):
+    # 小文字にして、前後の空白を削除
+    word_lower = word.lower().strip()
+
+    _, removed, _ = await banned_words.update(interaction.guild_id, remove=[word_lower])
+    if removed:
+        await interaction.response.send_message(
+            f"✅ 禁止ワードリストから `{word_lower}` を削除しました。\n"
+            f"現在のリスト件数: {len(banned_words.get(interaction.guild_id).words)}", 
+            ephemeral=True
+        )
+        send_dm_log(f"**➖ 禁止ワード削除:** 管理者 {interaction.user.name} により `{word_lower}` が削除されました。")
+        audit_log.record(interaction.guild_id, "blockword_remove", actor_id=interaction.user.id, word=word_lower)
+    else:
+        await interaction.response.send_message(f"⚠️ `{word}` は禁止ワードリストに存在しません。", ephemeral=True)
+
+# ----------------------------------------------------------------------
+# サブコマンド: /blockword list (禁止ワード表示)
+# ----------------------------------------------------------------------
+@blockword_group.command(name="list", description="現在の禁止ワードリストを表示します。")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def blockword_list_command(interaction: discord.Interaction):
+    entry = banned_words.get(interaction.guild_id)
+    
+    if not entry.words:
+        await interaction.response.send_message("現在の禁止ワードリストは空です。", ephemeral=True)
+        return
+        
+    # リストをソートして表示用に整形（Embedの説明文は4096文字まで）
+    sorted_words = sorted(entry.words)
+    lines = []
+    length = 0
+    for word in sorted_words:
+        line = f"- `{word}`"
+        if length + len(line) + 1 > 3900:
+            lines.append(f"…ほか {len(sorted_words) - len(lines)} 件（`/blockword export` で全件を取得できます）")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    
+    embed = discord.Embed(
+        title=f"🛑 現在の禁止ワードリスト ({len(entry.words)} 件)",
+        description="\n".join(lines),
+        color=discord.Color.red()
+    )
+    if entry is banned_words.default:
+        embed.set_footer(text="既定のリストです。追加・削除するとこのサーバー専用のリストとして保存されます。")
+    else:
+        embed.set_footer(text=f"バージョン: {entry.version}")
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+# ----------------------------------------------------------------------
+# サブコマンド: /blockword export (禁止ワードの書き出し)
+# ----------------------------------------------------------------------
+@blockword_group.command(name="export", description="禁止ワードリストをテキストファイルとして書き出します。")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def blockword_export_command(interaction: discord.Interaction):
+    entry = banned_words.get(interaction.guild_id)
+    lines = [f"# guild: {interaction.guild_id}", f"# version: {entry.version}"]
+    lines.extend(sorted(entry.words))
+    file = discord.File(
+        io.BytesIO(("\n".join(lines) + "\n").encode("utf-8")),
+        filename=f"banned_words_{interaction.guild_id}_v{entry.version}.txt"
+    )
+    await interaction.response.send_message(
+        f"📄 禁止ワードリスト（{len(entry.words)} 件、バージョン {entry.version}）を書き出しました。",
+        file=file,
+        ephemeral=True
+    )
+
+# ----------------------------------------------------------------------
+# サブコマンド: /blockword import (禁止ワードの一括登録)
+# ----------------------------------------------------------------------
+@blockword_group.command(name="import", description="テキストファイル（1行に1単語）から禁止ワードを一括で登録します。")
+@discord.app_commands.describe(
+    file="1行に1単語を書いたUTF-8のテキストファイル（# で始まる行は無視されます）。",
+    mode="merge: 現在のリストに追加 / replace: 現在のリストを置き換え"
+)
+@discord.app_commands.choices(mode=[
+    discord.app_commands.Choice(name="merge（追加）", value="merge"),
+    discord.app_commands.Choice(name="replace（置き換え）", value="replace"),
+])
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def blockword_import_command(
+    interaction: discord.Interaction,
+    file: discord.Attachment,
+    mode: Optional[discord.app_commands.Choice[str]] = None
+):
+    replace = mode is not None and mode.value == "replace"
+    if file.size > BANNED_WORDS_IMPORT_MAX_BYTES:
+        await interaction.response.send_message(
+            f"❌ ファイルが大きすぎます（上限: {BANNED_WORDS_IMPORT_MAX_BYTES // 1024} KB）。", ephemeral=True
+        )
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    try:
+        text = (await file.read()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await interaction.followup.send("❌ ファイルをUTF-8のテキストとして読み込めませんでした。", ephemeral=True)
+        return
+    except discord.HTTPException as e:
+        await interaction.followup.send(f"❌ ファイルの取得に失敗しました: {e}", ephemeral=True)
+        return
+
+    words = [line.strip() for line in text.splitlines()]
+    words = [word for word in words if word and not word.startswith("#")]
+    if not words and not replace:
+        await interaction.followup.send("⚠️ ファイルに単語が含まれていません。", ephemeral=True)
+        return
+
+    added, removed, rejected = await banned_words.update(interaction.guild_id, add=words, replace=replace)
+    entry = banned_words.get(interaction.guild_id)
+    lines = [
+        f"✅ 禁止ワードを{'置き換え' if replace else '一括登録'}しました（バージョン {entry.version}）。",
+        f"追加: {len(added)} 件 / 削除: {len(removed)} 件 / 現在のリスト件数: {len(entry.words)}",
+    ]
+    if rejected:
+        preview = ", ".join(f"`{word[:30]}`" for word in rejected[:10])
+        lines.append(f"⚠️ 登録できなかった単語: {len(rejected)} 件（{preview}{' …' if len(rejected) > 10 else ''}）")
+    await interaction.followup.send("\n".join(lines), ephemeral=True)
+
+    if added or removed:
+        send_dm_log(
+            f"**📥 禁止ワード一括登録:** 管理者 {interaction.user.name} により "
+            f"{len(added)} 件が追加、{len(removed)} 件が削除されました（{'replace' if replace else 'merge'}）。"
+        )
+        audit_log.record(
+            interaction.guild_id, "blockword_import", actor_id=interaction.user.id,
+            mode="replace" if replace else "merge", added=len(added), removed=len(removed), version=entry.version
+        )
+
+
+# ----------------------------------------------------------------------
+# ★ コマンドグループ: /ratelimit (レート制限ポリシー管理)
+# ----------------------------------------------------------------------
+
+ratelimit_group = discord.app_commands.Group(name="ratelimit", description="サーバー/チャンネル/ロールごとのレート制限を管理します（管理者専用）")
+bot.tree.add_command(ratelimit_group)
+
+
+def describe_rate_limit_target(channel: Optional[discord.abc.GuildChannel], role: Optional[discord.Role]) -> str:
+    if channel is not None:
+        return f"チャンネル {channel.mention}"
+    if role is not None:
+        return f"ロール {role.mention}"
+    return "サーバー全体"
+
+
+# ----------------------------------------------------------------------
+# サブコマンド: /ratelimit show (ポリシー表示)
+# ----------------------------------------------------------------------
+@ratelimit_group.command(name="show", description="このサーバーのレート制限ポリシーを表示します。")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def ratelimit_show_command(interaction: discord.Interaction):
+    policies = spam_tracking.guild_policies(interaction.guild_id)
+
+    lines = [f"**既定値:** {describe_rate_limit_policy(spam_tracking.default_policy)}"]
+    if policies is not None and policies.guild is not None:
+        lines.append(f"**サーバー全体:** {describe_rate_limit_policy(policies.guild)}")
+    if policies is not None:
+        for channel_id, policy in policies.channels.items():
+            lines.append(f"**チャンネル** <#{channel_id}>: {describe_rate_limit_policy(policy)}")
+        for role_id, policy in policies.roles.items():
+            lines.append(f"**ロール** <@&{role_id}>: {describe_rate_limit_policy(policy)}")
+
     embed = discord.Embed(
-        title=f"🤖 このサーバーのBotステータス (現在 {len(bot_members)} 件)",
-        description="\n".join(bot_list_lines),
+        title="⏱️ レート制限ポリシー",
+        description="\n".join(lines),
         color=discord.Color.blue()
     )
-    embed.set_footer(text="オンライン状態はDiscordのステータスに基づいています。")
-    
-    await interaction.followup.send(embed=embed)
+    embed.set_footer(text="優先順位: チャンネル > ロール（上位のロール優先） > サーバー全体 > 既定値")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
 # ----------------------------------------------------------------------
-# ★ コマンドグループ: /blockword (禁止ワード管理)
+# サブコマンド: /ratelimit set (ポリシー設定)
 # ----------------------------------------------------------------------
+@ratelimit_group.command(name="set", description="レート制限ポリシーを設定します（チャンネル/ロール未指定ならサーバー全体）。")
+@discord.app_commands.describe(
+    limit="時間枠内に許容するメッセージ数。",
+    window="時間枠（秒）。",
+    burst_limit="（任意）短時間のバースト制限で許容するメッセージ数。",
+    burst_window="（任意）バースト制限の時間枠（秒）。",
+    channel="（任意）このチャンネルだけに適用する場合に指定します。",
+    role="（任意）このロールを持つメンバーに適用する場合に指定します。"
+)
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def ratelimit_set_command(
+    interaction: discord.Interaction,
+    limit: discord.app_commands.Range[int, 1, 1000],
+    window: discord.app_commands.Range[int, 1, 3600],
+    burst_limit: Optional[discord.app_commands.Range[int, 1, 1000]] = None,
+    burst_window: Optional[discord.app_commands.Range[int, 1, 3600]] = None,
+    channel: Optional[discord.TextChannel] = None,
+    role: Optional[discord.Role] = None
+):
+    if channel is not None and role is not None:
+        await interaction.response.send_message("❌ チャンネルとロールは同時に指定できません。", ephemeral=True)
+        return
+    if (burst_limit is None) != (burst_window is None):
+        await interaction.response.send_message("❌ バースト制限は `burst_limit` と `burst_window` の両方を指定してください。", ephemeral=True)
+        return
+    if burst_window is not None and burst_window >= window:
+        await interaction.response.send_message("❌ バースト制限の時間枠は、通常の時間枠より短くしてください。", ephemeral=True)
+        return
+
+    policy = (RateLimitWindow(limit, window),)
+    if burst_limit is not None:
+        policy = (RateLimitWindow(burst_limit, burst_window),) + policy
+
+    channel_id = channel.id if channel else None
+    role_id = role.id if role else None
+    try:
+        await rate_limit_policy_store.save(interaction.guild_id, policy, channel_id=channel_id, role_id=role_id)
+    except Exception as e:
+        print(f"ERROR: レート制限ポリシーの保存に失敗しました: {e}")
+        await interaction.response.send_message("❌ 設定の保存に失敗しました。時間をおいて再度お試しください。", ephemeral=True)
+        return
+    spam_tracking.set_policy(interaction.guild_id, policy, channel_id=channel_id, role_id=role_id)
+    target = describe_rate_limit_target(channel, role)
+    await interaction.response.send_message(
+        f"✅ {target}のレート制限を **{describe_rate_limit_policy(policy)}** に設定しました。",
+        ephemeral=True
+    )
+    send_dm_log(f"**⏱️ レート制限設定:** 管理者 {interaction.user.name} により {target} が `{describe_rate_limit_policy(policy)}` に設定されました。")
+    audit_log.record(
+        interaction.guild_id, "ratelimit_set", actor_id=interaction.user.id,
+        channel_id=channel_id, target=target, policy=describe_rate_limit_policy(policy)
+    )
 
-# blockword コマンドグループを定義
-blockword_group = discord.app_commands.Group(name="blockword", description="サーバーの禁止ワードリストを管理します（管理者専用）")
-bot.tree.add_command(blockword_group)
 
 # ----------------------------------------------------------------------
-# サブコマンド: /blockword add (禁止ワード追加)
+# サブコマンド: /ratelimit clear (ポリシー解除)
 # ----------------------------------------------------------------------
-@blockword_group.command(name="add", description="禁止ワードリストに新しい単語を追加します。")
-@discord.app_commands.describe(word="禁止したい単語（大文字小文字は区別されません）。")
+@ratelimit_group.command(name="clear", description="レート制限ポリシーの設定を解除します（チャンネル/ロール未指定ならサーバー全体）。")
+@discord.app_commands.describe(
+    channel="（任意）設定を解除するチャンネル。",
+    role="（任意）設定を解除するロール。"
+)
 @discord.app_commands.checks.has_permissions(administrator=True)
-async def blockword_add_command(interaction: discord.Interaction, word: str):
-    global BANNED_WORDS
-    
-    # 小文字にして、前後の空白を削除
-    word_lower = word.lower().strip()
-    
-    if not word_lower:
-        await interaction.response.send_message("❌ 追加する禁止ワードを入力してください。", ephemeral=True)
+async def ratelimit_clear_command(
+    interaction: discord.Interaction,
+    channel: Optional[discord.TextChannel] = None,
+    role: Optional[discord.Role] = None
+):
+    if channel is not None and role is not None:
+        await interaction.response.send_message("❌ チャンネルとロールは同時に指定できません。", ephemeral=True)
         return
 
-    if word_lower in BANNED_WORDS:
-        await interaction.response.send_message(f"⚠️ `{word}` はすでに禁止ワードリストに存在しています。", ephemeral=True)
-    else:
-        BANNED_WORDS.add(word_lower)
-        await interaction.response.send_message(
-            f"✅ 禁止ワードリストに `{word_lower}` を追加しました。\n現在のリスト件数: {len(BANNED_WORDS)}", 
-            ephemeral=True
-        )
-        await send_dm_log(f"**➕ 禁止ワード追加:** 管理者 {interaction.user.name} により `{word_lower}` が追加されました。")
+    channel_id = channel.id if channel else None
+    role_id = role.id if role else None
+    try:
+        await rate_limit_policy_store.save(interaction.guild_id, None, channel_id=channel_id, role_id=role_id)
+    except Exception as e:
+        print(f"ERROR: レート制限ポリシーの保存に失敗しました: {e}")
+        await interaction.response.send_message("❌ 設定の保存に失敗しました。時間をおいて再度お試しください。", ephemeral=True)
+        return
+    spam_tracking.set_policy(interaction.guild_id, None, channel_id=channel_id, role_id=role_id)
+    target = describe_rate_limit_target(channel, role)
+    await interaction.response.send_message(f"✅ {target}のレート制限の設定を解除しました。", ephemeral=True)
+    send_dm_log(f"**⏱️ レート制限解除:** 管理者 {interaction.user.name} により {target} の設定が解除されました。")
+    audit_log.record(
+        interaction.guild_id, "ratelimit_clear", actor_id=interaction.user.id,
+        channel_id=channel_id, target=target
+    )
+
 
 # ----------------------------------------------------------------------
-# サブコマンド: /blockword remove (禁止ワード削除)
+# ★ コマンド: /purge (メッセージ一括削除)
 # ----------------------------------------------------------------------
-@blockword_group.command(name="remove", description="禁止ワードリストから単語を削除します。")
-@discord.app_commands.describe(word="削除したい禁止ワード。")
+# /purge で削除できる最大件数と、メンバー指定時に遡る履歴の最大件数
+PURGE_MAX_MESSAGES = 2000
+PURGE_MEMBER_SCAN_LIMIT = 5000
+
+@bot.tree.command(name="purge", description="このチャンネルの直近のメッセージを一括削除します。")
+@discord.app_commands.describe(
+    count="削除するメッセージ数（1〜2000）。",
+    member="（任意）このメンバーのメッセージだけを削除します。"
+)
 @discord.app_commands.checks.has_permissions(administrator=True)
-async def blockword_remove_command(interaction: discord.Interaction, word: str):
-    global BANNED_WORDS
-    
-    # 小文字にして、前後の空白を削除
-    word_lower = word.lower().strip()
+async def purge_command(
+    interaction: discord.Interaction,
+    count: discord.app_commands.Range[int, 1, PURGE_MAX_MESSAGES],
+    member: Optional[discord.Member] = None
+):
+    await interaction.response.defer(ephemeral=True)
 
-    if word_lower in BANNED_WORDS:
-        BANNED_WORDS.remove(word_lower)
-        await interaction.response.send_message(
-            f"✅ 禁止ワードリストから `{word_lower}` を削除しました。\n現在のリスト件数: {len(BANNED_WORDS)}", 
+    perms = interaction.channel.permissions_for(interaction.guild.me)
+    if not (perms.manage_messages and perms.read_message_history):
+        await interaction.followup.send(
+            "❌ Botに「メッセージの管理」と「メッセージ履歴を読む」権限がありません。Botのロール権限を確認してください。",
             ephemeral=True
         )
-        await send_dm_log(f"**➖ 禁止ワード削除:** 管理者 {interaction.user.name} により `{word_lower}` が削除されました。")
-    else:
-        await interaction.response.send_message(f"⚠️ `{word}` は禁止ワードリストに存在しません。", ephemeral=True)
+        return
+
+    started = time.monotonic()
+    messages_to_delete = []
+    scan_limit = count if member is None else PURGE_MEMBER_SCAN_LIMIT
+    async for msg in interaction.channel.history(limit=scan_limit):
+        if member is None or msg.author.id == member.id:
+            messages_to_delete.append(msg)
+            if len(messages_to_delete) >= count:
+                break
+
+    result = await message_deletion_engine.delete(interaction.channel, messages_to_delete)
+    recent_messages.forget(interaction.channel_id, [m.id for m in messages_to_delete])
+    elapsed = time.monotonic() - started
+
+    target = f"{member.mention} さんの" if member else ""
+    await interaction.followup.send(
+        f"🧹 {target}メッセージを **{result.deleted} 件** 削除しました（対象 {result.requested} 件, {elapsed:.1f}秒）。"
+        + (f"\n⚠️ {result.failed} 件は削除できませんでした。" if result.failed else ""),
+        ephemeral=True
+    )
+
+    # 管理者へのログ送信 (DM)
+    embed = discord.Embed(
+        title="🧹 メッセージ一括削除ログ",
+        description=f"実行者: {interaction.user.mention} (ID: {interaction.user.id})",
+        color=discord.Color.orange()
+    )
+    embed.add_field(name="チャンネル", value=interaction.channel.mention, inline=False)
+    if member is not None:
+        embed.add_field(name="対象メンバー", value=f"{member.name} (ID: {member.id})", inline=False)
+    embed.add_field(name="削除件数", value=f"{result.deleted} / {result.requested} 件", inline=True)
+    embed.add_field(
+        name="API呼び出し",
+        value=f"一括削除 {result.bulk_requests} 回 / 個別削除 {result.single_requests} 回",
+        inline=True
+    )
+    embed.add_field(name="所要時間", value=f"{elapsed:.1f} 秒", inline=True)
+    embed.timestamp = datetime.now(timezone(timedelta(hours=+9), 'JST'))
+
+    send_dm_log(f"**🧹 メッセージ一括削除:** {interaction.user.name} が {result.deleted} 件のメッセージを削除しました。", embed=embed)
+    audit_log.record(
+        interaction.guild_id, "purge", user_id=member.id if member else None, actor_id=interaction.user.id,
+        channel_id=interaction.channel_id, deleted=result.deleted, requested=result.requested
+    )
+
 
 # ----------------------------------------------------------------------
-# サブコマンド: /blockword list (禁止ワード表示)
+# ★ コマンド: /audit (監査ログの検索)
 # ----------------------------------------------------------------------
-@blockword_group.command(name="list", description="現在の禁止ワードリストを表示します。")
+
+def format_audit_entry(entry: AuditLogEntry) -> str:
+    """監査ログの1件を、Embedに表示する1〜2行のテキストにします。"""
+    parts = [f"<t:{int(entry.created_at)}:f> **{AUDIT_ACTIONS.get(entry.action, entry.action)}**"]
+    if entry.user_id:
+        parts.append(f"対象: <@{entry.user_id}>")
+    if entry.actor_id:
+        parts.append(f"実行者: <@{entry.actor_id}>")
+    if entry.channel_id:
+        parts.append(f"<#{entry.channel_id}>")
+    line = " / ".join(parts)
+    if entry.detail:
+        detail = ", ".join(f"{key}={value}" for key, value in entry.detail.items())
+        line += f"\n　`{detail[:150]}`"
+    return line
+
+
+class AuditPageView(discord.ui.View):
+    """/audit の結果を「前へ」「次へ」ボタンでページ送りします。"""
+
+    def __init__(self, owner_id: int, guild_id: int, user_id: Optional[int], action: Optional[str]):
+        super().__init__(timeout=300)
+        self.owner_id = owner_id
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.action = action
+        self.page = 0
+        # 各ページの先頭の位置（前のページの最後の (created_at, id)）
+        self.cursors: list[Optional[tuple[float, int]]] = [None]
+
+    async def load(self) -> discord.Embed:
+        """現在のページを読み込み、ボタンの状態を更新してEmbedを返します。"""
+        entries = await audit_log.query(
+            self.guild_id, self.user_id, self.action, self.cursors[self.page], AUDIT_PAGE_SIZE + 1
+        )
+        has_next = len(entries) > AUDIT_PAGE_SIZE
+        entries = entries[:AUDIT_PAGE_SIZE]
+        if has_next and len(self.cursors) == self.page + 1:
+            self.cursors.append((entries[-1].created_at, entries[-1].id))
+        self.previous_button.disabled = self.page == 0
+        self.next_button.disabled = not has_next
+
+        filters = []
+        if self.user_id is not None:
+            filters.append(f"対象: <@{self.user_id}>")
+        if self.action is not None:
+            filters.append(f"種類: {AUDIT_ACTIONS.get(self.action, self.action)}")
+        embed = discord.Embed(
+            title="📜 監査ログ",
+            description="\n".join(format_audit_entry(entry) for entry in entries) or "該当する記録はありません。",
+            color=discord.Color.dark_teal()
+        )
+        if filters:
+            embed.add_field(name="絞り込み", value=" / ".join(filters), inline=False)
+        embed.set_footer(text=f"ページ {self.page + 1}")
+        return embed
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.owner_id
+
+    @discord.ui.button(label="◀ 前へ", style=discord.ButtonStyle.secondary)
+    async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(0, self.page - 1)
+        await interaction.response.edit_message(embed=await self.load(), view=self)
+
+    @discord.ui.button(label="次へ ▶", style=discord.ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = min(len(self.cursors) - 1, self.page + 1)
+        await interaction.response.edit_message(embed=await self.load(), view=self)
+
+
+@bot.tree.command(name="audit", description="このサーバーの監査ログ（モデレーション履歴）を新しい順に表示します。")
+@discord.app_commands.describe(
+    member="（任意）このユーザーに関する記録だけを表示します。",
+    action="（任意）この種類の操作だけを表示します。"
+)
+@discord.app_commands.choices(action=[
+    discord.app_commands.Choice(name=label, value=key) for key, label in AUDIT_ACTIONS.items()
+])
 @discord.app_commands.checks.has_permissions(administrator=True)
-async def blockword_list_command(interaction: discord.Interaction):
-    
-    if not BANNED_WORDS:
-        await interaction.response.send_message("現在の禁止ワードリストは空です。", ephemeral=True)
+async def audit_command(
+    interaction: discord.Interaction,
+    member: Optional[discord.User] = None,
+    action: Optional[discord.app_commands.Choice[str]] = None
+):
+    if not AUDIT_LOG_ENABLED:
+        await interaction.response.send_message("❌ 監査ログは無効になっています (AUDIT_LOG_ENABLED)。", ephemeral=True)
         return
-        
-    # リストをソートして表示用に整形
-    sorted_words = sorted(list(BANNED_WORDS))
-    
-    # 応答メッセージの作成
-    word_list_text = "\n".join([f"- `{word}`" for word in sorted_words])
-    
+
+    await interaction.response.defer(ephemeral=True)
+    view = AuditPageView(
+        interaction.user.id,
+        interaction.guild_id,
+        member.id if member else None,
+        action.value if action else None
+    )
+    try:
+        embed = await view.load()
+    except Exception as e:
+        print(f"ERROR: 監査ログの検索中にエラーが発生しました: {e}")
+        await interaction.followup.send("❌ 監査ログの検索中にエラーが発生しました。", ephemeral=True)
+        return
+    await interaction.followup.send(embed=embed, view=view, ephemeral=True)
+
+
+# ----------------------------------------------------------------------
+# ★ /profile (イベントループのプロファイル)
+# ----------------------------------------------------------------------
+@bot.tree.command(name="profile", description="イベントループを指定した秒数だけプロファイルし、結果をファイルで返します。")
+@discord.app_commands.describe(seconds=f"プロファイルする秒数（1〜{PROFILER_MAX_SECONDS}）")
+@discord.app_commands.checks.has_permissions(administrator=True)
+async def profile_command(
+    interaction: discord.Interaction,
+    seconds: discord.app_commands.Range[int, 1, PROFILER_MAX_SECONDS] = 10
+):
+    await interaction.response.defer(ephemeral=True)
+    try:
+        counts = await loop_health_monitor.profile(seconds)
+    except RuntimeError as e:
+        await interaction.followup.send(f"❌ {e}", ephemeral=True)
+        return
+
+    # サンプルは待機中に偏るため（LoopHealthMonitor.profile を参照）、処理中・待機中の割合は表示しない
+    total, _, top = summarize_profile(counts)
     embed = discord.Embed(
-        title=f"🛑 現在の禁止ワードリスト ({len(BANNED_WORDS)} 件)",
-        description=word_list_text,
-        color=discord.Color.red()
+        title="🔬 イベントループのプロファイル",
+        description=(
+            f"**時間:** {seconds}秒 / **サンプル数:** {total}\n"
+            f"**遅延:** 直近 {loop_health_monitor.last_lag * 1000:.1f}ms / 最大 {loop_health_monitor.max_lag * 1000:.1f}ms"
+        ),
+        color=discord.Color.teal()
+    )
+    if top:
+        embed.add_field(
+            name="待機中以外で採取された関数（サンプル数）",
+            value="\n".join(f"`{leaf[:80]}`: {count}" for leaf, count in top),
+            inline=False
+        )
+    if loop_health_monitor.slow_callbacks:
+        recent = list(loop_health_monitor.slow_callbacks)[-3:]
+        embed.add_field(
+            name=f"直近の遅いコールバック（計 {len(loop_health_monitor.slow_callbacks)} 件）",
+            value="\n".join(
+                f"{item.duration * 1000:.0f}ms: `{item.stack.rsplit(';', 1)[-1][:80]}`" for item in reversed(recent)
+            ),
+            inline=False
+        )
+    embed.set_footer(
+        text="GILを手放す呼び出しと、長くループを止める処理だけが写ります。"
+             "添付ファイルは collapsed stacks 形式です（flamegraph.pl や speedscope で表示できます）。"
     )
-    embed.set_footer(text="Botが再起動されると、リストは初期設定値に戻ります。")
-    
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    file = discord.File(
+        io.BytesIO(format_collapsed_stacks(counts).encode("utf-8")),
+        filename=f"profile_{int(time.time())}.folded"
+    )
+    await interaction.followup.send(embed=embed, file=file, ephemeral=True)
 
 
 # ----------------------------------------------------------------------
 # コマンドエラーハンドリング (MissingPermissionsを処理)
 # ----------------------------------------------------------------------
+app_command_invocations = Counter("app_commands_total", "スラッシュコマンドの実行数", ("command", "result"))
+
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    app_command_invocations.labels(command.qualified_name, "success").inc()
+
+
 @bot.tree.error
 async def on_app_command_error(interaction: discord.Interaction, error: discord.app_commands.AppCommandError):
+    command_name = interaction.command.qualified_name if interaction.command else "unknown"
+    app_command_invocations.labels(command_name, "error").inc()
     if isinstance(error, discord.app_commands.MissingPermissions):
         # 権限がない場合のエラー処理
         await interaction.response.send_message(
@@ -1117,7 +6011,7 @@ async def ai_command(interaction: discord.Interaction, prompt: str):
             "❌ 応答可能なGemini APIキーが設定されていません。管理者にご連絡ください。", 
             ephemeral=True
         )
-        await send_dm_log(f"**🚨 /ai コマンド失敗:** {user_info}\n理由: 有効なGeminiキーなし。")
+        send_dm_log(f"**🚨 /ai コマンド失敗:** {user_info}\n理由: 有効なGeminiキーなし。")
         return
 
     await interaction.response.defer()
@@ -1125,112 +6019,796 @@ async def ai_command(interaction: discord.Interaction, prompt: str):
     gemini_text = None
     used_client_name = None
     
-    # クライアントのリストを順に試行する（フォールバック）
-    for client_info in gemini_clients:
-        client = client_info['client']
+    # 同じ質問への応答がキャッシュにあれば、APIを呼ばずに応答する
+    cache_key = AIResponseCache.make_key(prompt)
+    cached_text = await ai_response_cache.get(cache_key) if AI_CACHE_ENABLED else None
+    if cached_text is not None:
+        print(f"INFO: 応答キャッシュにヒットしました。{user_info}")
+        gemini_text = cached_text
+        used_client_name = AI_CACHE_LABEL
+        ordered_clients = []
+    else:
+        # 健全性の高いキーから順に試行する（フォールバック）
+        ordered_clients = gemini_key_scheduler.order(gemini_clients)
+    attempted = set()
+    # ストリーミング表示で送信済みのメッセージと、最後に途中まで表示した応答
+    sent_messages = []
+    aborted_writer = None
+    for index, client_info in enumerate(ordered_clients):
         used_client_name = client_info['name']
+        if used_client_name in attempted:
+            # ヘッジリクエストで既に試行済み
+            continue
+        attempted.add(used_client_name)
+        # ヘッジ先の候補は、まだ試行していない次のキー
+        backup_info = next(
+            (c for c in ordered_clients[index + 1:] if c['name'] not in attempted), None
+        )
+        writer = None
         
         try:
-            # 必須: ユーザーの質問とシステムプロンプトの両方を設定
-            contents = [
-                {"role": "user", "parts": [{"text": prompt}]}
-            ]
-            
             log_info = f"INFO: {used_client_name} キーを使用してGemini APIを試行します..."
             print(log_info)
-            await send_dm_log(f"**🟡 試行:** {user_info}\nキー: {used_client_name}\n質問: `{prompt[:100]}...`")
+            send_dm_log(f"**🟡 試行:** {user_info}\nキー: {used_client_name}\n質問: `{prompt[:100]}...`", priority=LOG_PRIORITY_LOW)
             
-            response = client.models.generate_content(
-                model='gemini-2.5-flash',
-                contents=contents,
-                # ★ システムプロンプトを設定
-                config={"system_instruction": AI_SYSTEM_PROMPT} 
-            )
-            
-            gemini_text = response.text.strip()
+            if AI_STREAMING_ENABLED:
+                # 受信した部分から順にメッセージを編集して表示する（ヘッジは行わない）
+                writer = StreamingReplyWriter(interaction, build_ai_reply_header(prompt, used_client_name))
+                gemini_text = await writer.stream(
+                    stream_gemini_content(client_info['client'], prompt, used_client_name)
+                )
+                sent_messages = writer.messages
+            else:
+                gemini_text, answered_info = await generate_gemini_content_hedged(
+                    client_info, backup_info, prompt, attempted
+                )
+                used_client_name = answered_info['name']
             # 応答が成功したらループを抜ける
             break 
 
+        except asyncio.TimeoutError:
+            # タイムアウトした場合は次のキーへ
+            log_warning = f"WARNING: {used_client_name} キーの応答が {GEMINI_REQUEST_TIMEOUT_SECONDS:.0f}秒以内に返りませんでした。"
+            print(log_warning)
+            send_dm_log(f"**⏱️ タイムアウト:** {log_warning}\n次のキーにフォールバックします。")
+            if writer and writer.messages:
+                await writer.abort(AI_STREAM_ABORT_NOTE)
+                aborted_writer = writer
+            continue
+
         except APIError as e:
             # APIエラー（レート制限など）が発生した場合
             log_warning = f"WARNING: {used_client_name} キーでAPIエラーが発生しました: {e}"
             print(log_warning)
-            await send_dm_log(f"**⚠️ APIエラー:** {log_warning}\n次のキーにフォールバックします。")
+            send_dm_log(f"**⚠️ APIエラー:** {log_warning}\n次のキーにフォールバックします。")
+            if writer and writer.messages:
+                await writer.abort(AI_STREAM_ABORT_NOTE)
+                aborted_writer = writer
             continue # 次のクライアントを試行
             
         except Exception as e:
             # その他の予期せぬエラー
             log_error = f"ERROR: {used_client_name} キーで予期せぬエラーが発生しました: {e}"
             print(log_error)
-            await send_dm_log(f"**❌ 致命的エラー:** {log_error}")
+            send_dm_log(f"**❌ 致命的エラー:** {log_error}")
+            if writer and writer.messages:
+                await writer.abort(AI_STREAM_ABORT_NOTE)
+                aborted_writer = writer
             continue
 
     
     # 試行結果の処理
     if gemini_text:
-        # 成功応答
-        if len(gemini_text) > 2000:
-            # メッセージが長すぎる場合は分割して送信
-            initial_response = await interaction.followup.send(
-                f"**質問:** {prompt}\n(キー: {used_client_name})\n\n**AI応答 (1/2):**\n{gemini_text[:1900]}..."
-            )
-            await interaction.channel.send(f"**AI応答 (2/2):**\n...{gemini_text[1900:]}")
-            
-            # 応答メッセージのリンクをDMログに保存
-            message_link = initial_response.jump_url
-            dm_log_message = f"**✅ 応答成功 (分割):** {user_info}\n使用キー: `{used_client_name}`\n[チャットリンク]({message_link})\n質問: `{prompt[:80]}...`"
-            await send_dm_log(dm_log_message)
-            
-        else:
-            # 通常の応答
-            final_response = await interaction.followup.send(
-                f"**質問:** {prompt}\n(キー: {used_client_name})\n\n**AI応答:**\n{gemini_text}"
-            )
-            
-            # 応答メッセージのリンクをDMログに保存
-            message_link = final_response.jump_url
-            dm_log_message = f"**✅ 応答成功:** {user_info}\n使用キー: `{used_client_name}`\n[チャットリンク]({message_link})\n質問: `{prompt[:80]}...`"
-            await send_dm_log(dm_log_message)
+        if AI_CACHE_ENABLED and cached_text is None:
+            await ai_response_cache.put(cache_key, gemini_text)
+
+        # 成功応答（ストリーミング時は送信済み。それ以外は必要に応じて分割して送信）
+        if not sent_messages:
+            sent_messages = await send_ai_reply(interaction, prompt, used_client_name, gemini_text)
+        
+        # 応答メッセージのリンクをDMログに保存
+        message_link = sent_messages[0].jump_url
+        split_label = " (分割)" if len(sent_messages) > 1 else ""
+        dm_log_message = f"**✅ 応答成功{split_label}:** {user_info}\n使用キー: `{used_client_name}`\n[チャットリンク]({message_link})\n質問: `{prompt[:80]}...`"
+        send_dm_log(dm_log_message, priority=LOG_PRIORITY_LOW)
             
     else:
         # すべてのクライアントが失敗した場合
-        await interaction.followup.send(
-            "❌ すべてのGemini APIキーの試行に失敗しました。現在、レート制限などにより応答できません。",
-            ephemeral=True
-        )
-        await send_dm_log(f"**🔴 応答失敗 (全キー):** {user_info}\n質問: `{prompt[:80]}...`\n理由: すべてのキーがAPIエラー。")
+        failure_message = "❌ すべてのGemini APIキーの試行に失敗しました。現在、レート制限などにより応答できません。"
+        if aborted_writer is not None:
+            # 途中まで表示した応答があれば、別のメッセージは送らずにその注記を差し替える
+            await aborted_writer.abort(failure_message)
+        else:
+            await interaction.followup.send(failure_message, ephemeral=True)
+        send_dm_log(f"**🔴 応答失敗 (全キー):** {user_info}\n質問: `{prompt[:80]}...`\n理由: すべてのキーがAPIエラー。")
 
 
 # ----------------------------------------------------------------------
 # Webサーバーのセットアップ (ヘルスチェック用)
 # ----------------------------------------------------------------------
 
+web_pings = Counter("web_pings_total", "ヘルスチェック (/) へのアクセス数")
+
+
 async def handle_ping(request):
     """RenderなどのPaaS環境からのヘルスチェックに応答するハンドラー。"""
+    # アクセスのたびにログを出すと数が多すぎるため、件数はメトリクスで確認する
+    web_pings.inc()
+    return web.Response(text="Bot is running and ready for Gemini requests.")
+
+
+# ----------------------------------------------------------------------
+# /metrics (Prometheus テキスト形式)
+# ----------------------------------------------------------------------
+
+CallbackGauge("discord_gateway_latency_seconds", "Discord Gatewayのハートビートの遅延",
+              lambda: bot.latency if bot.latency == bot.latency and bot.latency != float("inf") else 0.0)
+CallbackGauge("discord_shard_latency_seconds", "シャードごとのGatewayのハートビートの遅延",
+              lambda: {
+                  (shard_id, ): latency if latency == latency and latency != float("inf") else 0.0
+                  for shard_id, latency in bot.latencies
+              } if isinstance(bot, commands.AutoShardedBot) else {}, ("shard",))
+CallbackGauge("guilds", "参加しているサーバー数", lambda: len(bot.guilds))
+CallbackGauge("rate_limit_tracked_keys", "レート制限で追跡中のユーザー数", lambda: spam_tracking.stats()["tracked_keys"])
+CallbackGauge("rate_limit_memory_bytes", "レート制限の追跡に使用しているメモリ（推定）", lambda: spam_tracking.stats()["memory_bytes"])
+CallbackGauge("time_bans_pending", "自動解除を待っている一時BANの数", lambda: len(time_ban_scheduler))
+CallbackGauge("message_snapshots", "保持している監視チャンネルのメッセージ数", lambda: len(message_snapshots))
+CallbackGauge("message_snapshots_memory_bytes", "監視チャンネルのメッセージ記録の使用量（推定）",
+              lambda: message_snapshots.stats()["memory_bytes"])
+CallbackGauge("near_duplicate_entries", "類似メッセージ検知の索引に登録されている投稿数", lambda: near_duplicate_index.stats()["entries"])
+CallbackGauge("ai_cache_entries", "/ai 応答キャッシュ（メモリ）の件数", lambda: len(ai_response_cache.entries))
+CallbackGauge("dm_log_queue", "送信待ちのDMログの数", lambda: len(admin_log_dispatcher))
+CallbackGauge("monitoring_log_queue", "送信待ちの監視ログの数",
+              lambda: sum(len(dispatcher) for dispatcher in monitoring_log_dispatchers.values()))
+CallbackGauge("audit_log_pending", "書き込み待ちの監査ログの数", lambda: audit_log.stats()["pending"])
+CallbackGauge("banned_word_guilds", "専用の禁止ワードリストを持つサーバー数", lambda: banned_words.stats()["guilds"])
+CallbackGauge("gemini_key_in_flight", "Gemini APIキーごとの実行中のリクエスト数",
+              lambda: {(name, ): state.in_flight for name, state in gemini_key_scheduler.states.items()}, ("key",))
+CallbackGauge("gemini_key_up", "Gemini APIキーごとの定期確認の結果 (1=有効)",
+              lambda: {(name, ): int(probe.status == "ok") for name, probe in gemini_key_prober.probes.items()}, ("key",))
+
+
+async def handle_metrics(request):
+    """メトリクスを Prometheus のテキスト形式で返すハンドラー。"""
+    return web.Response(
+        body=metrics_registry.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+def is_debug_request_authorized(request) -> bool:
+    if not DEBUG_ROUTE_TOKEN:
+        return False
+    header = request.headers.get("Authorization", "")
+    return hmac.compare_digest(header.encode(), f"Bearer {DEBUG_ROUTE_TOKEN}".encode())
+
+
+async def handle_debug_loop(request):
+    """イベントループの遅延と、直近の遅いコールバックをJSONで返すハンドラー。"""
+    if not is_debug_request_authorized(request):
+        raise web.HTTPNotFound()
+    return web.json_response(loop_health_monitor.stats())
+
+
+async def handle_debug_profile(request):
+    """?seconds=N の間プロファイラーを実行し、collapsed stacks 形式で返すハンドラー。"""
+    if not is_debug_request_authorized(request):
+        raise web.HTTPNotFound()
+    try:
+        seconds = float(request.query.get("seconds", 10))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
+    if not 0 < seconds <= PROFILER_MAX_SECONDS:
+        raise web.HTTPBadRequest(text=f"seconds must be in (0, {PROFILER_MAX_SECONDS}]")
+    try:
+        counts = await loop_health_monitor.profile(seconds)
+    except RuntimeError as e:
+        raise web.HTTPConflict(text=str(e))
+    return web.Response(text=format_collapsed_stacks(counts), content_type="text/plain")
+
+
+# ----------------------------------------------------------------------
+# ★ ヘルスチェック (/healthz, /readyz, /status)
+# 状態はバックグラウンドのタスクが一定間隔で計算し、応答の本文まで作成しておく。
+# ハンドラーは作成済みの本文を返すだけで、Gemini や Discord への問い合わせは行わない。
+# ----------------------------------------------------------------------
+# 状態を計算し直す間隔（秒）
+HEALTH_REFRESH_INTERVAL_SECONDS = float(os.environ.get("HEALTH_REFRESH_INTERVAL_SECONDS", 1.0))
+# 状態がこの秒数以上更新されていなければ、/healthz も失敗を返す（計算タスクが止まっている）
+HEALTH_STALE_SECONDS = 30
+# Gatewayの切断からこの秒数以内は、再接続中として準備完了のままにする
+READY_DISCONNECT_GRACE_SECONDS = float(os.environ.get("READY_DISCONNECT_GRACE_SECONDS", 30))
+# イベントループの遅延（指数移動平均）がこの秒数を超えたら準備未完了とする
+READY_MAX_LOOP_LAG_SECONDS = float(os.environ.get("READY_MAX_LOOP_LAG_SECONDS", 1.0))
+# 利用可能なGeminiキーが1つもない場合に準備未完了とするか
+READY_REQUIRE_GEMINI = env_flag("READY_REQUIRE_GEMINI", True)
+
+
+class HealthReporter:
+    """Botの状態を定期的に計算し、/healthz・/readyz・/status の応答を作成しておきます。"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.gateway_connected = False
+        self.gateway_changed_at = time.monotonic()
+        self.ready = False
+        self.reasons: list[str] = []
+        self.refreshed_at = 0.0
+        self.status_body = b"{}"
+        self.ready_body = b"{}"
+        # AutoShardedBot の場合、切断中のシャードと切断を検知した時刻
+        self.shard_closed_since: dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self.refresh()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(HEALTH_REFRESH_INTERVAL_SECONDS)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"ERROR: ヘルスチェックの状態の計算中にエラーが発生しました: {e}")
+
+    def set_gateway_connected(self, connected: bool):
+        if connected != self.gateway_connected:
+            self.gateway_connected = connected
+            self.gateway_changed_at = time.monotonic()
+        self.refresh()
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.refreshed_at > HEALTH_STALE_SECONDS
+
+    def _gemini_keys(self, now: float) -> list[dict]:
+        keys = []
+        for client_info in gemini_clients:
+            key_state = gemini_key_scheduler.state(client_info['name'])
+            keys.append({
+                "name": key_state.name,
+                "available": key_state.available_at() <= now,
+                "retry_in_seconds": round(max(0.0, key_state.available_at() - now), 1),
+                "in_flight": key_state.in_flight,
+                "ewma_latency_seconds": round(key_state.ewma_latency, 3) if key_state.ewma_latency is not None else None,
+                "consecutive_failures": key_state.consecutive_failures,
+                "probe_status": gemini_key_prober.probe_for(key_state.name).status,
+            })
+        return keys
+
+    def _shards(self, now: float) -> list[dict]:
+        """シャードごとの接続状態。on_disconnect はどのシャードの切断でも呼ばれるため、シャードの状態を直接見る。"""
+        shards = []
+        for shard_id, shard in sorted(bot.shards.items()):
+            if shard.is_closed():
+                self.shard_closed_since.setdefault(shard_id, now)
+            else:
+                self.shard_closed_since.pop(shard_id, None)
+            latency = shard.latency
+            shards.append({
+                "id": shard_id,
+                "connected": not shard.is_closed(),
+                "latency_seconds": round(latency, 4) if latency == latency and latency != float("inf") else None,
+            })
+        return shards
+
+    def refresh(self):
+        now = time.monotonic()
+        reasons = []
+
+        sharded = isinstance(bot, commands.AutoShardedBot)
+        shards = self._shards(now) if sharded else None
+        if sharded:
+            gateway_connected = bool(shards) and not self.shard_closed_since
+            if not bot.is_ready():
+                reasons.append("gateway_not_ready")
+            elif any(now - since > READY_DISCONNECT_GRACE_SECONDS for since in self.shard_closed_since.values()):
+                reasons.append("shard_disconnected")
+        else:
+            gateway_connected = self.gateway_connected
+            gateway_ready = self.gateway_connected and bot.is_ready() and not bot.is_closed()
+            if not gateway_ready:
+                if not bot.is_ready():
+                    reasons.append("gateway_not_ready")
+                elif now - self.gateway_changed_at > READY_DISCONNECT_GRACE_SECONDS:
+                    reasons.append("gateway_disconnected")
+
+        if loop_health_monitor.ewma_lag > READY_MAX_LOOP_LAG_SECONDS:
+            reasons.append("event_loop_lag")
+
+        gemini_keys = self._gemini_keys(now)
+        gemini_available = sum(1 for key in gemini_keys if key["available"])
+        if READY_REQUIRE_GEMINI and gemini_keys and not gemini_available:
+            reasons.append("no_gemini_key_available")
+
+        latency = bot.latency
+        shard_ids = [shard["id"] for shard in shards] if sharded else (
+            [bot.shard_id] if bot.shard_id is not None else [0]
+        )
+        status = {
+            "ready": not reasons,
+            "reasons": reasons,
+            "uptime_seconds": round(time.time() - self.started_at),
+            "user": str(bot.user) if bot.user else None,
+            "worker_id": BOT_WORKER_ID,
+            "pid": os.getpid(),
+            "gateway": {
+                "connected": gateway_connected,
+                "latency_seconds": round(latency, 4) if latency == latency and latency != float("inf") else None,
+                "since_change_seconds": round(now - self.gateway_changed_at, 1),
+            },
+            "shard_count": bot.shard_count or 1,
+            "shard_ids": shard_ids,
+            "shards": shards,
+            "guild_count": len(bot.guilds),
+            "event_loop": {
+                "lag_ewma_seconds": round(loop_health_monitor.ewma_lag, 4),
+                "lag_max_seconds": round(loop_health_monitor.max_lag, 4),
+                "slow_callbacks": len(loop_health_monitor.slow_callbacks),
+            },
+            "gemini": {"keys": gemini_keys, "available": gemini_available},
+            "time_bans_pending": len(time_ban_scheduler),
+        }
+        self.ready = not reasons
+        self.reasons = reasons
+        self.status_body = json.dumps(status, ensure_ascii=False).encode("utf-8")
+        self.ready_body = json.dumps({"ready": self.ready, "reasons": reasons}).encode("utf-8")
+        self.refreshed_at = now
+
+
+health_reporter = HealthReporter()
+
+HEALTHZ_OK_BODY = b'{"alive": true}'
+HEALTHZ_STALE_BODY = b'{"alive": false, "reason": "health_state_stale"}'
+
+
+# ハンドラーが参照する状態。通常は health_reporter、ランチャーではワーカーの状態を集約したもの
+HEALTH_REPORTER_KEY = web.AppKey("health_reporter", object)
+
+
+async def handle_healthz(request):
+    """プロセスが動作しているか（イベントループが応答し、状態の計算タスクが動いているか）を返します。"""
+    if request.app[HEALTH_REPORTER_KEY].is_stale():
+        return web.Response(body=HEALTHZ_STALE_BODY, status=503, content_type="application/json")
+    return web.Response(body=HEALTHZ_OK_BODY, content_type="application/json")
+
+
+async def handle_readyz(request):
+    """リクエストを受け付けられる状態か（Gateway接続・ループ遅延・Geminiキー）を返します。"""
+    reporter = request.app[HEALTH_REPORTER_KEY]
+    ready = reporter.ready and not reporter.is_stale()
+    return web.Response(body=reporter.ready_body, status=200 if ready else 503, content_type="application/json")
+
+
+async def handle_status(request):
+    """Botの状態の詳細をJSONで返します。"""
+    return web.Response(body=request.app[HEALTH_REPORTER_KEY].status_body, content_type="application/json")
+
+
+# ----------------------------------------------------------------------
+# ★ マルチプロセス構成: ランチャーとワーカー
+# ランチャーはシャードを BOT_WORKERS 個の連続した範囲に分け、それぞれをワーカープロセス（このスクリプト）として起動する。
+# ワーカーはWebサーバーを持たず、状態（/status の内容）とメトリクスを一定間隔で共有のSQLiteに書き込む。
+# ランチャーはそれを読み込んで /healthz・/readyz・/status・/metrics の応答を作成し、終了したワーカーは再起動する。
+# Identify のレート制限に当たらないよう、ワーカーは前のワーカーのGateway接続の完了を待ってから順に起動する。
+# ----------------------------------------------------------------------
+CLUSTER_DB_PATH = os.path.join(BOT_DATA_DIR, "cluster.db")
+# ワーカーが状態を書き込む間隔（秒）
+CLUSTER_PUBLISH_INTERVAL_SECONDS = float(os.environ.get("CLUSTER_PUBLISH_INTERVAL_SECONDS", 2.0))
+# 次のワーカーを起動するまでに、前のワーカーの接続完了を待つ最大時間（秒）
+CLUSTER_WORKER_START_TIMEOUT_SECONDS = 120
+# 終了したワーカーを再起動するまでの待ち時間（秒）。続けて終了するたびに倍にする
+CLUSTER_RESTART_DELAY_SECONDS = 5
+CLUSTER_MAX_RESTART_DELAY_SECONDS = 300
+# この秒数以上動いてから終了した場合は、待ち時間を最初に戻す
+CLUSTER_STABLE_SECONDS = 600
+# 停止時にワーカーの終了を待つ時間（秒）。過ぎたら強制終了する
+CLUSTER_SHUTDOWN_TIMEOUT_SECONDS = 10
+# ワーカーの出力の1行の上限（バイト）
+CLUSTER_OUTPUT_LINE_LIMIT = 1024 * 1024
+
+# ランチャー自身のメトリクス（ワーカーのメトリクスとは別に出力する）
+cluster_metrics_registry = MetricsRegistry()
+cluster_worker_restarts = Counter(
+    "cluster_worker_restarts_total", "ワーカープロセスの再起動回数", ("worker",), registry=cluster_metrics_registry
+)
+
+
+class ClusterWorkerState(NamedTuple):
+    """ワーカーが共有ストアに書き込んだ状態。updated_at はUNIX時刻です。"""
+    worker_id: int
+    pid: int
+    ready: bool
+    connected: bool
+    updated_at: float
+    status: bytes
+    metrics: str
+
+
+class ClusterStateStore(SQLiteStore):
+    """ワーカーの状態を受け渡すSQLite層。"""
+
+    def setup(self, conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cluster_workers ("
+            "worker_id INTEGER PRIMARY KEY, pid INTEGER NOT NULL, ready INTEGER NOT NULL, connected INTEGER NOT NULL, "
+            "updated_at REAL NOT NULL, status BLOB NOT NULL, metrics TEXT NOT NULL)"
+        )
+
+    def _publish(self, conn: sqlite3.Connection, state: ClusterWorkerState):
+        conn.execute(
+            "INSERT OR REPLACE INTO cluster_workers (worker_id, pid, ready, connected, updated_at, status, metrics) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            state
+        )
+        conn.commit()
+
+    def _load(self, conn: sqlite3.Connection) -> dict[int, ClusterWorkerState]:
+        rows = conn.execute(
+            "SELECT worker_id, pid, ready, connected, updated_at, status, metrics FROM cluster_workers"
+        ).fetchall()
+        return {row[0]: ClusterWorkerState(row[0], row[1], bool(row[2]), bool(row[3]), *row[4:]) for row in rows}
+
+    def _clear(self, conn: sqlite3.Connection):
+        conn.execute("DELETE FROM cluster_workers")
+        conn.commit()
+
+    async def publish(self, state: ClusterWorkerState):
+        await self.run(self._publish, state)
+
+    async def load(self) -> dict[int, ClusterWorkerState]:
+        return await self.run(self._load)
+
+    async def clear(self):
+        await self.run(self._clear)
+
+
+cluster_state = ClusterStateStore(CLUSTER_DB_PATH)
+
+
+def merge_worker_metrics(texts: list[tuple[Optional[str], str]]) -> str:
+    """
+    プロセスごとの Prometheus テキストを1つにまとめます。
     
-    JST = timezone(timedelta(hours=+9), 'JST')
-    current_time_jst = datetime.now(JST).strftime("%Y/%m/%d %H:%M:%S %Z")
-    
-    print(
-        f"🌐 [Web Ping] 応答時刻: {current_time_jst} | "
-        f"有効Geminiキー: {len(gemini_clients)}個 | "
-        f"ステータス: OK"
+    texts は (ワーカー番号, テキスト) のリストで、ワーカー番号が None でなければ各サンプルに worker ラベルを付けます。
+    同じメトリクスのサンプルが連続するよう、メトリクスごとに並べ直します。
+    """
+    families: dict[str, list[str]] = {}
+    for worker, text in texts:
+        label = f'worker="{escape_metric_label(worker)}"' if worker is not None else None
+        lines = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split(" ", 3)[2]
+                lines = families.get(name)
+                if lines is None:
+                    lines = families[name] = [line]
+            elif line.startswith("# TYPE "):
+                if lines is not None and len(lines) == 1:
+                    lines.append(line)
+            elif line and lines is not None:
+                if label is None:
+                    lines.append(line)
+                    continue
+                brace = line.find("{")
+                space = line.find(" ")
+                if 0 <= brace < space:
+                    lines.append(f"{line[:brace + 1]}{label},{line[brace + 1:]}")
+                else:
+                    lines.append(f"{line[:space]}{{{label}}}{line[space:]}")
+    return "\n".join(line for lines in families.values() for line in lines) + "\n"
+
+
+class ClusterWorker:
+    """ランチャーが管理するワーカープロセス1つ分。"""
+
+    def __init__(self, worker_id: int, shard_ids: list[int]):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        # 共有ストアから読み込んだ、現在のプロセスの最新の状態
+        self.state: Optional[ClusterWorkerState] = None
+        self.output_task: Optional[asyncio.Task] = None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def heartbeat_age(self) -> Optional[float]:
+        return time.time() - self.state.updated_at if self.state is not None else None
+
+    def is_fresh(self) -> bool:
+        """プロセスが動いていて、最近状態を書き込んでいるか。"""
+        return self.is_alive() and self.state is not None and self.heartbeat_age() <= HEALTH_STALE_SECONDS
+
+
+class ClusterSupervisor:
+    """ワーカープロセスを順に起動して監視し、終了したら再起動します。"""
+
+    def __init__(self):
+        self.shard_count = 0
+        self.workers: list[ClusterWorker] = []
+        self._stopping = False
+
+    def configure(self, shard_count: int, worker_count: int):
+        """シャードをワーカー数で連続した範囲に分けます（ワーカー数はシャード数までに抑える）。"""
+        worker_count = max(1, min(worker_count, shard_count))
+        base, extra = divmod(shard_count, worker_count)
+        self.shard_count = shard_count
+        self.workers = []
+        start = 0
+        for worker_id in range(worker_count):
+            size = base + (1 if worker_id < extra else 0)
+            self.workers.append(ClusterWorker(worker_id, list(range(start, start + size))))
+            start += size
+
+    async def run(self):
+        """すべてのワーカーを起動し、停止されるまで監視します。"""
+        supervisors = []
+        try:
+            for worker in self.workers:
+                supervisors.append(asyncio.create_task(self._supervise(worker)))
+                await self._wait_connected(worker)
+            await asyncio.gather(*supervisors)
+        finally:
+            for task in supervisors:
+                task.cancel()
+            await self.stop()
+
+    async def _wait_connected(self, worker: ClusterWorker):
+        deadline = time.monotonic() + CLUSTER_WORKER_START_TIMEOUT_SECONDS
+        while not (worker.is_fresh() and worker.state.connected):
+            if time.monotonic() >= deadline:
+                print(f"WARNING: ワーカー{worker.worker_id} が{CLUSTER_WORKER_START_TIMEOUT_SECONDS}秒以内に接続を完了しなかったため、"
+                      "次のワーカーを起動します。")
+                return
+            await asyncio.sleep(1)
+        print(f"INFO: ワーカー{worker.worker_id} (シャード {format_shard_ids(worker.shard_ids)}) の接続が完了しました。")
+
+    async def _spawn(self, worker: ClusterWorker):
+        env = dict(os.environ)
+        env.update({
+            "BOT_WORKER_ID": str(worker.worker_id),
+            "BOT_LAUNCHER_PID": str(os.getpid()),
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_IDS": format_shard_ids(worker.shard_ids),
+            "PYTHONUNBUFFERED": "1",
+        })
+        worker.state = None
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, limit=CLUSTER_OUTPUT_LINE_LIMIT
+        )
+        worker.started_at = time.monotonic()
+        worker.output_task = asyncio.create_task(self._relay_output(worker.worker_id, worker.process.stdout))
+        print(f"INFO: ワーカー{worker.worker_id} (PID {worker.process.pid}) を起動しました。"
+              f"シャード: {format_shard_ids(worker.shard_ids)} / 全{self.shard_count}シャード")
+
+    async def _relay_output(self, worker_id: int, stream: asyncio.StreamReader):
+        """ワーカーの出力に番号を付けて、ランチャーの標準出力へ流します。"""
+        prefix = f"[worker {worker_id}] "
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # 上限を超える長さの行は読み飛ばす
+                continue
+            if not line:
+                return
+            print(prefix + line.decode("utf-8", errors="replace").rstrip())
+
+    async def _supervise(self, worker: ClusterWorker):
+        delay = CLUSTER_RESTART_DELAY_SECONDS
+        while True:
+            await self._spawn(worker)
+            returncode = await worker.process.wait()
+            if self._stopping:
+                return
+            if time.monotonic() - worker.started_at >= CLUSTER_STABLE_SECONDS:
+                delay = CLUSTER_RESTART_DELAY_SECONDS
+            worker.restarts += 1
+            cluster_worker_restarts.labels(worker.worker_id).inc()
+            print(f"WARNING: ワーカー{worker.worker_id} (PID {worker.process.pid}) が終了しました（終了コード: {returncode}）。"
+                  f"{delay}秒後に再起動します。")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CLUSTER_MAX_RESTART_DELAY_SECONDS)
+
+    async def stop(self):
+        """すべてのワーカーに終了を要求し、終了しないものは強制終了します。"""
+        self._stopping = True
+        alive = [worker for worker in self.workers if worker.is_alive()]
+        for worker in alive:
+            worker.process.terminate()
+        for worker in alive:
+            try:
+                await asyncio.wait_for(worker.process.wait(), CLUSTER_SHUTDOWN_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                print(f"WARNING: ワーカー{worker.worker_id} が終了しないため、強制終了します。")
+                worker.process.kill()
+                await worker.process.wait()
+
+
+cluster_supervisor = ClusterSupervisor()
+
+CallbackGauge("cluster_worker_up", "ワーカープロセスが動作し、状態を書き込んでいるか (1=動作中)",
+              lambda: {(worker.worker_id, ): int(worker.is_fresh()) for worker in cluster_supervisor.workers},
+              ("worker",), registry=cluster_metrics_registry)
+CallbackGauge("cluster_worker_heartbeat_age_seconds", "ワーカーが最後に状態を書き込んでからの経過時間",
+              lambda: {
+                  (worker.worker_id, ): worker.heartbeat_age() for worker in cluster_supervisor.workers
+                  if worker.state is not None
+              }, ("worker",), registry=cluster_metrics_registry)
+
+
+class ClusterHealthReporter:
+    """ランチャーで各ワーカーの状態を集約し、/healthz・/readyz・/status・/metrics の応答を作成しておきます。"""
+
+    def __init__(self, supervisor: ClusterSupervisor):
+        self.supervisor = supervisor
+        self.started_at = time.time()
+        self.ready = False
+        self.reasons: list[str] = []
+        self.refreshed_at = 0.0
+        self.status_body = b"{}"
+        self.ready_body = b"{}"
+        self.metrics_body = b""
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"ERROR: ワーカーの状態の集約中にエラーが発生しました: {e}")
+            await asyncio.sleep(HEALTH_REFRESH_INTERVAL_SECONDS)
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.refreshed_at > HEALTH_STALE_SECONDS
+
+    async def refresh(self):
+        states = await cluster_state.load()
+        reasons = [] if self.supervisor.workers else ["no_workers"]
+        workers = []
+        metrics_texts = []
+        guild_count = 0
+        for worker in self.supervisor.workers:
+            state = states.get(worker.worker_id)
+            # 再起動前のプロセスが書き込んだ状態は使わない
+            worker.state = state if state is not None and worker.is_alive() and state.pid == worker.process.pid else None
+            status = json.loads(worker.state.status) if worker.state is not None else None
+            if worker.is_fresh():
+                reasons.extend(f"worker_{worker.worker_id}_{reason}" for reason in status.get("reasons", ()))
+                metrics_texts.append((str(worker.worker_id), worker.state.metrics))
+                guild_count += status.get("guild_count", 0)
+            else:
+                reasons.append(f"worker_{worker.worker_id}_down")
+            age = worker.heartbeat_age()
+            workers.append({
+                "worker_id": worker.worker_id,
+                "shard_ids": worker.shard_ids,
+                "pid": worker.process.pid if worker.is_alive() else None,
+                "restarts": worker.restarts,
+                "heartbeat_age_seconds": round(age, 1) if age is not None else None,
+                "status": status,
+            })
+
+        # ランチャー自身のメトリクスは、ワーカーの状態を更新してから出力する
+        metrics_texts.insert(0, (None, cluster_metrics_registry.render()))
+        self.ready = not reasons
+        self.reasons = reasons
+        self.status_body = json.dumps({
+            "mode": "cluster",
+            "ready": self.ready,
+            "reasons": reasons,
+            "uptime_seconds": round(time.time() - self.started_at),
+            "shard_count": self.supervisor.shard_count,
+            "guild_count": guild_count,
+            "workers": workers,
+        }, ensure_ascii=False).encode("utf-8")
+        self.ready_body = json.dumps({"ready": self.ready, "reasons": reasons}).encode("utf-8")
+        self.metrics_body = merge_worker_metrics(metrics_texts).encode("utf-8")
+        self.refreshed_at = time.monotonic()
+
+
+cluster_health_reporter = ClusterHealthReporter(cluster_supervisor)
+
+
+async def handle_cluster_metrics(request):
+    """ランチャーで、各ワーカーのメトリクスを worker ラベル付きでまとめて返すハンドラー。"""
+    return web.Response(
+        body=cluster_health_reporter.metrics_body,
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
     )
 
-    return web.Response(text="Bot is running and ready for Gemini requests.")
 
-def setup_web_server():
-    """Webサーバーを設定し、CORSを適用する関数。"""
+def stop_worker(main_task: asyncio.Task):
+    """ワーカーを停止します。ログイン済みならGatewayから切断して終了し、ログイン前なら起動処理を中断します。"""
+    if bot.user is not None:
+        asyncio.ensure_future(bot.close())
+    else:
+        main_task.cancel()
+
+
+async def run_cluster_publisher(main_task: asyncio.Task):
+    """ワーカーの状態とメトリクスを一定間隔で共有ストアに書き込みます。ランチャーが終了していたら、ワーカーを停止します。"""
+    while not bot.is_closed():
+        if BOT_LAUNCHER_PID is not None and os.getppid() != BOT_LAUNCHER_PID:
+            print("WARNING: ランチャーが終了したため、ワーカーを停止します。")
+            stop_worker(main_task)
+            return
+        try:
+            await cluster_state.publish(ClusterWorkerState(
+                BOT_WORKER_ID, os.getpid(), health_reporter.ready, bot.is_ready(), time.time(),
+                health_reporter.status_body, metrics_registry.render()
+            ))
+        except Exception as e:
+            print(f"ERROR: ワーカーの状態の書き込みに失敗しました: {e}")
+        await asyncio.sleep(CLUSTER_PUBLISH_INTERVAL_SECONDS)
+
+
+async def fetch_recommended_shard_count() -> int:
+    """Discordが推奨するシャード数を取得します（Gatewayには接続しない）。"""
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(DISCORD_TOKEN)
+        shard_count, _, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shard_count
+
+
+async def run_cluster_launcher():
+    """シャードをワーカーに割り当てて起動し、Webサーバーで状態を集約して返します。"""
+    try:
+        shard_count = SHARD_COUNT or await fetch_recommended_shard_count()
+    except Exception as e:
+        print(f"FATAL ERROR: 推奨シャード数を取得できませんでした。SHARD_COUNT を指定してください: {e}")
+        return
+    cluster_supervisor.configure(shard_count, BOT_WORKERS)
+    print(f"INFO: {shard_count}シャードを{len(cluster_supervisor.workers)}個のワーカーで起動します。")
+
+    # 前回の起動時の状態を消してから、集約を始める
+    await cluster_state.clear()
+    cluster_health_reporter.start()
+    web_server_task = asyncio.create_task(start_web_server(cluster=True))
+    # PaaSからの停止要求 (SIGTERM) でも、ワーカーを終了させてから停止する
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        # 停止時は run() の中でワーカーの終了を待ってから戻る
+        await cluster_supervisor.run()
+    except asyncio.CancelledError:
+        print("INFO: ランチャーを停止しました。")
+    finally:
+        web_server_task.cancel()
+
+
+def setup_web_server(cluster: bool = False):
+    """Webサーバーを設定し、CORSを適用する関数。cluster=True ならランチャー用（ワーカーの集約結果を返す）。"""
     app = web.Application()
+    app[HEALTH_REPORTER_KEY] = cluster_health_reporter if cluster else health_reporter
     app.router.add_get('/', handle_ping)
+    app.router.add_get('/metrics', handle_cluster_metrics if cluster else handle_metrics)
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/readyz', handle_readyz)
+    app.router.add_get('/status', handle_status)
+    if not cluster:
+        # プロファイラーは計測するプロセスの中で動かす必要があるため、ランチャーには置かない（ワーカーは /profile で計測する）
+        app.router.add_get('/debug/loop', handle_debug_loop)
+        app.router.add_get('/debug/profile', handle_debug_profile)
     cors = aiohttp_cors.setup(app, defaults={"*": aiohttp_cors.ResourceOptions(allow_credentials=True, allow_methods=["GET"], allow_headers=("X-Requested-With", "Content-Type"),)})
     for route in list(app.router.routes()):
         cors.add(route)
     return app
 
-async def start_web_server():
+async def start_web_server(cluster: bool = False):
     """Webサーバーを非同期で起動する関数。"""
-    web_app = setup_web_server()
+    web_app = setup_web_server(cluster)
     runner = web.AppRunner(web_app)
     await runner.setup()
     site = web.TCPSite(runner, host='0.0.0.0', port=PORT)
@@ -1250,10 +6828,30 @@ async def main():
         print("FATAL ERROR: DISCORD_TOKEN が設定されていません。Botを起動できません。")
         return
 
-    web_server_task = asyncio.create_task(start_web_server())
+    if PROCESS_ROLE == "launcher":
+        await run_cluster_launcher()
+        return
+
+    if PROCESS_ROLE == "worker":
+        # Webサーバーはランチャーが担当する。状態とメトリクスは共有ストア経由で渡す
+        main_task = asyncio.current_task()
+        side_task = asyncio.create_task(run_cluster_publisher(main_task))
+        # ランチャーからの終了要求 (SIGTERM) では、Gatewayから切断してから終了する
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_worker, main_task)
+    else:
+        side_task = asyncio.create_task(start_web_server())
+    if LOOP_MONITOR_ENABLED:
+        loop_health_monitor.start()
+    health_reporter.start()
+    gemini_key_prober.start()
     discord_task = asyncio.create_task(bot.start(DISCORD_TOKEN))
     
-    await asyncio.gather(discord_task, web_server_task)
+    try:
+        await asyncio.gather(discord_task, side_task)
+    except asyncio.CancelledError:
+        if PROCESS_ROLE != "worker":
+            raise
+        print("INFO: ワーカーを停止しました。")
 
 
 if __name__ == '__main__':
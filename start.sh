@@ -8,3 +8,8 @@ python3 natu_bot.py
 #    環境に合わせて 'python' または 'python3' に変更してください。
 # 2. このスクリプトはBotが終了すると自動的に終了します。
 #    Botをバックグラウンドで永続的に実行したい場合は、別のツール(例: nohup, systemd, screen)が必要です。
+# 3. サーバー数が多い場合は、環境変数でシャーディングを有効にできます。
+#    AUTO_SHARDING=1         : 1つのプロセスで複数のシャードを扱います（シャード数はDiscordの推奨値）。
+#    BOT_WORKERS=N (N>=2)    : このプロセスがランチャーになり、シャードをN個のワーカープロセスに分けて起動します。
+#                              Webサーバー (/healthz, /readyz, /status, /metrics) はランチャーだけが起動します。
+#    SHARD_COUNT             : シャードの総数を固定する場合に指定します。